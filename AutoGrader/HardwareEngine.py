@@ -6,31 +6,77 @@ import datetime
 import traceback
 import importlib
 import subprocess
+import json
+import concurrent.futures
+
+from AutoGrader.TaskClock import TaskClock
 
 class HardwareEngine(object):
 
+    DEFAULT_CALLBACK_TIMEOUT_SEC = 300.
+
     def __init__(self, config, file_folder):
         self._initialize_variables(file_folder)
         self._initialize_parsing_config(config)
     
     def grade_task(self, execution_time_sec):
         print('grade_task enter, set timer %f sec' % execution_time_sec)
-        self._reset_devices()
-        self.task_running = True
-        self._start_test()
+        self.task_execution_time_sec = execution_time_sec
+        self.task_id += 1
+        try:
+            ready = self._reset_devices()
+        except:
+            print('grade_task unable to prepare the hardware, full stack trace below')
+            traceback.print_exc()
+            # the hardware may be partially prepared, so all of it is reset
+            self.execution_started = False
+            self.execution_threads = []
+            self.prepared_hardware_names = []
+            self.reset_hardware_names = list(self.hardware_processing_order)
+            ready = False
+        if not ready:
+            print('grade_task aborted, not all hardware is ready')
+            with self.task_running_lock:
+                self.task_running = True
+            self._terminate_hardware_procedure()
+            return
+        with self.task_running_lock:
+            self.task_running = True
+
+        # The timer starts before the execution, so that a termination requested as soon as the
+        # execution starts finds the timer to cancel
         self.aborting_task_timer = threading.Timer(
-                execution_time_sec, self._terminate_hardware_procedure)
+                execution_time_sec, self._on_task_timeout, args=[self.task_id])
         self.aborting_task_timer.start()
+        try:
+            self._start_test()
+        except:
+            print('grade_task unable to start the execution, full stack trace below')
+            traceback.print_exc()
+            self._terminate_hardware_procedure()
 
     #
     # methods to handle devices
     #
     def _reset_devices(self):
-        for hardware_name in self.hardware_processing_order:
-            self.hardware_dict[hardware_name].on_before_execution()
+        """
+        Return:
+          True if all the hardware is prepared, otherwise False
+        """
+        self.execution_threads = []
+        self.execution_started = False
+        self.aborting_task_timer = None
+        self.prepared_hardware_names, failed_names = self._run_hardware_callbacks(
+                'on_before_execution', self.hardware_processing_order, stop_on_failure=True)
+
+        # the hardware whose preparation failed may be partially prepared, so it is reset too
+        self.reset_hardware_names = self.prepared_hardware_names + failed_names
+        return len(self.prepared_hardware_names) == len(self.hardware_processing_order)
 
     def _start_test(self):
         # notify all hardware the execution just begins
+        self.task_clock.start()
+        self.execution_started = True
         self.execution_threads = []
         for hardware_name in self.hardware_processing_order:
             thread_name = 'Exe-%s' % hardware_name
@@ -38,37 +84,144 @@ class HardwareEngine(object):
             t = threading.Thread(name=thread_name,
                     target=self.hardware_dict[hardware_name].on_execute)
             t.start()
-            self.execution_threads.append(t)
+            self.execution_threads.append((hardware_name, t))
     
     def _terminate_hardware_procedure(self):
-        if not self.task_running:
-            return
-
-        self.task_running = False
+        """
+        Return:
+          True if this call terminates the task, False if the task is not running, e.g., it is
+          terminated by another call already
+        """
+        # several devices and the timer may request a termination at the same time, but only one
+        # of them should carry it out
+        with self.task_running_lock:
+            if not self.task_running:
+                return False
+            self.task_running = False
 
-        self.aborting_task_timer.cancel()
+        if self.aborting_task_timer:
+            self.aborting_task_timer.cancel()
         
-        # send terminate signal to all hardware
-        for hardware_name in self.hardware_processing_order:
-            print('terminate', hardware_name)
-            self.hardware_dict[hardware_name].on_terminate()
+        # send terminate signal to all hardware, unless the task is aborted before the
+        # execution, in which case there is nothing to terminate
+        if self.execution_started:
+            self._run_hardware_callbacks('on_terminate', self.prepared_hardware_names)
+            self._write_task_clock_output()
 
-        for th in self.execution_threads:
+        # A device whose on_terminate() timed out may never return from on_execute(), hence its
+        # thread is only waited for until its callback timeout
+        start_time = time.time()
+        for hardware_name, th in self.execution_threads:
             print('wait for', th)
-            th.join()
+            th.join(max(start_time + self.hardware_timeouts[hardware_name] - time.time(), 0.))
+            if th.is_alive():
+                print('on_execute of %s is still running, stop waiting for it' % hardware_name)
         
         # send clean signal to all hardware
-        for hardware_name in self.hardware_processing_order:
-            self.hardware_dict[hardware_name].on_reset_after_execution()
+        self._run_hardware_callbacks('on_reset_after_execution', self.reset_hardware_names)
+        return True
+
+    def _on_task_timeout(self, task_id):
+        # a timer which fires after its task is terminated must not end the next task
+        if task_id != self.task_id:
+            return
+        self._terminate_hardware_procedure()
+
+    def _run_hardware_callbacks(self, method_name, hardware_names, stop_on_failure=False):
+        """
+        Invoke the specified callback of the given hardware concurrently. A callback starts only
+        after the callbacks of all the hardware it depends on (specified in the
+        "hardware_dependencies" field of the configuration) are done. Every callback has to
+        finish within the "callback_timeout_sec" of its hardware.
+
+        Params:
+          method_name: the name of the callback, e.g., "on_before_execution"
+          hardware_names: the hardware to be notified
+          stop_on_failure: if True, do not start any further callback once a callback raises an
+              exception or times out
+        Return:
+          (succeeded_names, failed_names): the hardware names whose callback finished
+              successfully, in finishing order, and whose callback raised an exception. The
+              hardware whose callback timed out is in neither, as its callback may still run.
+        """
+        pending_names = [n for n in self.hardware_processing_order if n in hardware_names]
+        finished_names = []
+        succeeded_names = []
+        failed_names = []
+        failed = False
+        running = {}  # future => (hardware_name, deadline)
+
+        executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(len(pending_names), 1),
+                thread_name_prefix=method_name,
+        )
+        try:
+            while True:
+                # start the callbacks whose dependencies are all done
+                if not (failed and stop_on_failure):
+                    for hardware_name in list(pending_names):
+                        dependencies = self.hardware_dependencies[hardware_name]
+                        if all(d in finished_names or d not in hardware_names
+                                for d in dependencies):
+                            print(method_name, hardware_name)
+                            future = executor.submit(
+                                    getattr(self.hardware_dict[hardware_name], method_name))
+                            deadline = time.time() + self.hardware_timeouts[hardware_name]
+                            running[future] = (hardware_name, deadline)
+                            pending_names.remove(hardware_name)
+
+                # either all the callbacks are done, or we stop because of a failure
+                if len(running) == 0:
+                    break
+
+                wait_sec = max(min(d for _, d in running.values()) - time.time(), 0.)
+                done, _ = concurrent.futures.wait(list(running.keys()), timeout=wait_sec,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+
+                for future in done:
+                    hardware_name, _ = running.pop(future)
+                    finished_names.append(hardware_name)
+                    try:
+                        future.result()
+                        succeeded_names.append(hardware_name)
+                    except:
+                        failed = True
+                        failed_names.append(hardware_name)
+                        print('%s of %s failed, full stack trace below' % (
+                            method_name, hardware_name))
+                        traceback.print_exc()
+
+                now = time.time()
+                for future in [f for f in running if running[f][1] <= now]:
+                    hardware_name, _ = running.pop(future)
+                    finished_names.append(hardware_name)
+                    failed = True
+                    print('%s of %s timed out' % (method_name, hardware_name))
+        finally:
+            # a timed-out callback cannot be interrupted, so do not wait for it
+            executor.shutdown(wait=False)
+
+        return (succeeded_names, failed_names)
+
+    def _write_task_clock_output(self):
+        if not self.task_clock_output_file:
+            return
+        with open(os.path.join(self.file_folder, self.task_clock_output_file), 'w') as fo:
+            json.dump({
+                'device_start_offsets_sec': self.task_clock.get_device_start_offsets_sec(),
+            }, fo, indent=2, sort_keys=True)
 
     #
     # callbacks
     #
     def notify_terminate(self):
         """
-        Expceted call-sites are hardware devices or aborting_task_timer
+        Expceted call-sites are hardware devices or aborting_task_timer. The termination
+        procedure runs on its own thread because it waits for the callbacks of all the hardware,
+        which may in turn wait for the thread of the caller (e.g., a serial reading thread).
         """
-        self._terminate_hardware_procedure()
+        threading.Thread(target=self._terminate_hardware_procedure,
+                name='Terminate').start()
     
     #
     # private initialization procedure
@@ -83,12 +236,25 @@ class HardwareEngine(object):
         # hardware info
         self.hardware_dict = None
         self.hardware_processing_order = None
+        self.hardware_dependencies = None
+        self.hardware_timeouts = None
+        self.prepared_hardware_names = None
+        self.reset_hardware_names = None
 
         # hardware execution
+        self.execution_started = None
         self.execution_threads = None
 
-        # grading status
+        # the timebase of a task, shared by all hardware. Hardware accesses it through the
+        # hardware engine
+        self.task_clock = TaskClock()
+        self.task_clock_output_file = None
+
+        # grading status. task_id identifies the current task, which is the last one passed to
+        # grade_task()
+        self.task_id = 0
         self.task_running = None
+        self.task_running_lock = threading.Lock()
         self.task_execution_time_sec = None
         self.aborting_task_timer = None
 
@@ -109,6 +275,31 @@ class HardwareEngine(object):
                 if hardware_name not in config['hardware_list']:
                     raise Exception('hardware_list and hardware_processing_order do not match in configuration file')
 
+        # get hardware dependencies. Without explicit dependencies, each hardware depends on the
+        # previous one in hardware_processing_order, i.e., all callbacks are invoked serially
+        if 'hardware_dependencies' in config:
+            self.hardware_dependencies = {}
+            for hardware_name in self.hardware_processing_order:
+                dependencies = config['hardware_dependencies'].get(hardware_name, [])
+                for dependency in dependencies:
+                    if dependency not in config['hardware_list']:
+                        raise Exception('Unknown hardware "%s" in hardware_dependencies' % dependency)
+                self.hardware_dependencies[hardware_name] = list(dependencies)
+            for hardware_name in config['hardware_dependencies']:
+                if hardware_name not in config['hardware_list']:
+                    raise Exception('Unknown hardware "%s" in hardware_dependencies' % hardware_name)
+            self._check_hardware_dependencies_acyclic()
+        else:
+            self.hardware_dependencies = {}
+            for idx, hardware_name in enumerate(self.hardware_processing_order):
+                self.hardware_dependencies[hardware_name] = self.hardware_processing_order[:idx][-1:]
+
+        self.hardware_timeouts = {}
+        for hardware_name in config['hardware_list']:
+            hardware_config = config['hardware_list'][hardware_name]
+            self.hardware_timeouts[hardware_name] = hardware_config.get(
+                    'callback_timeout_sec', HardwareEngine.DEFAULT_CALLBACK_TIMEOUT_SEC)
+
         self.hardware_dict = {}
         for hardware_name in config['hardware_list']:
             hardware_config = config['hardware_list'][hardware_name]
@@ -118,6 +309,21 @@ class HardwareEngine(object):
             instance = MyClass(hardware_name, init_params, self, self.file_folder)
             self.hardware_dict[hardware_name] = instance
 
+        # the start offsets of the hardware on the task clock can be saved as an output file
+        if 'output_task_clock_file' in config:
+            self.task_clock_output_file = config['output_task_clock_file']
+
         for input_file in config['required_input_files']:
             if input_file in config['required_output_files']:
                 raise Exception('required_input_files and required_output_files are overlapped')
+
+    def _check_hardware_dependencies_acyclic(self):
+        remaining = dict(self.hardware_dependencies)
+        resolved = set()
+        while len(remaining) > 0:
+            ready = [n for n in remaining if all(d in resolved for d in remaining[n])]
+            if len(ready) == 0:
+                raise Exception('hardware_dependencies has a cycle among %s' % sorted(remaining))
+            for hardware_name in ready:
+                resolved.add(hardware_name)
+                del remaining[hardware_name]
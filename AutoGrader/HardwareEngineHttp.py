@@ -8,6 +8,7 @@ import importlib
 import subprocess
 
 from .HardwareEngine import HardwareEngine
+from .TaskQueue import TaskQueue
 
 
 class HardwareEngineHttp(HardwareEngine):
@@ -15,12 +16,15 @@ class HardwareEngineHttp(HardwareEngine):
     STATUS_IDLE = "IDLE"
     STATUS_TESTING = "TESTING"
 
-    def __init__(self, config, file_folder, backup_root_folder):
+    DEFAULT_TASK_QUEUE_LENGTH = 10
+
+    def __init__(self, config, file_folder, backup_root_folder, queue_folder):
         super().__init__(config, file_folder)
     
         # variable initialization
         self.http_client = None
         self.task_secret_code = None
+        self.task_start_time = None
         self.status = HardwareEngineHttp.STATUS_IDLE
         self.backup_root_folder = backup_root_folder
 
@@ -28,19 +32,32 @@ class HardwareEngineHttp(HardwareEngine):
         if not os.path.isdir(self.backup_root_folder):
             os.makedirs(self.backup_root_folder)
 
+        # pending tasks which arrive while the testbed is busy
+        queue_length = HardwareEngineHttp.DEFAULT_TASK_QUEUE_LENGTH
+        if 'task_queue_length' in config:
+            queue_length = config['task_queue_length']
+        self.task_queue = TaskQueue(queue_folder, queue_length)
+        self.status_lock = threading.Lock()
+
     def add_http_client(self, client):
         self.http_client = client
 
     def _terminate_hardware_procedure(self):
         # _terminate_hardware_procedure() may be called several times by different devices, but
-        # should only be executed once. We use self.task_running as an indicator of whether
-        # the method has been called before, and the variable is changed in
-        # HardwareEngine._terminate_hardware_procedure().
-        if not self.task_running:
-            return
+        # should only be executed once. HardwareEngine._terminate_hardware_procedure() tells
+        # whether this call is the one which terminates the task.
+        if not super()._terminate_hardware_procedure():
+            return False
 
-        super()._terminate_hardware_procedure()
+        try:
+            self._report_task()
+        except:
+            print('Unable to report the task, full stack trace below')
+            traceback.print_exc()
+        self._finish_task()
+        return True
 
+    def _report_task(self):
         # upload files
         output_files = {}
         for file_name in self.config['required_output_files']:
@@ -57,10 +74,16 @@ class HardwareEngineHttp(HardwareEngine):
         task_backup_folder = os.path.join(self.backup_root_folder, now)
         os.makedirs(task_backup_folder)
         shutil.move(self.file_folder, task_backup_folder)
-        
-        # all tasks are done. update status
-        self.status = HardwareEngineHttp.STATUS_IDLE
+
+    def _finish_task(self):
+        self.task_queue.record_task_duration(time.time() - self.task_start_time)
         print('Test complete.')
+
+        # start the next queued task right away, otherwise the testbed becomes idle
+        with self.status_lock:
+            if self._start_next_task():
+                return
+            self.status = HardwareEngineHttp.STATUS_IDLE
     
         # update status over HTTP
         if self.http_client.send_tb_status(self.status):
@@ -68,10 +91,20 @@ class HardwareEngineHttp(HardwareEngine):
         else:
             print('Unable to post status to server')
 
+    def start_queued_tasks(self):
+        """
+        Start grading the tasks restored from the queue folder, if any. Should be called after
+        the http client is added.
+        """
+        with self.status_lock:
+            if self.status == HardwareEngineHttp.STATUS_IDLE:
+                self._start_next_task()
+
     def request_grade_task(self, input_files, secret_code, execution_time_sec):
         """
         Is designed for entities which wish to make an assignment grading request (expected from
-        HTTPServer).
+        HTTPServer). If the testbed is busy, the task is queued and starts as soon as the
+        previous tasks finish.
 
         Params:
           input_files: a dictionary of (string => bytestream). It is designed for passing file
@@ -79,26 +112,75 @@ class HardwareEngineHttp(HardwareEngine):
           secret_code: the code to return when finishing the grading
           execution_time_sec: maximum time allowed to execute this task
         Return:
-          True if succesfully storing the data
+          True if succesfully storing the data, False if the task queue is full
         """
 
-        if self.status != HardwareEngineHttp.STATUS_IDLE:
-            return False
-        
-        self.status = HardwareEngineHttp.STATUS_TESTING
-
-        # store assignment info
-        if not os.path.isdir(self.file_folder):
-            os.makedirs(self.file_folder)
-        subprocess.call(['rm', '-rf', '%s/*' % self.file_folder])
-        for file_name in input_files:
-            file_path = os.path.join(self.file_folder, file_name)
-            with open(file_path, 'wb') as fo:
-                fo.write(input_files[file_name])
-        self.task_secret_code = secret_code
         if execution_time_sec is None:
             execution_time_sec = 600
 
+        with self.status_lock:
+            if not self.task_queue.push(input_files, secret_code, execution_time_sec):
+                print('request_grade_task rejected, task queue is full')
+                return False
+
+            if self.status == HardwareEngineHttp.STATUS_IDLE:
+                self._start_next_task()
+            else:
+                print('request_grade_task queued, %d task(s) waiting'
+                        % self.task_queue.get_length())
+
+        return True
+
+    #
+    # query status
+    #
+    def get_status(self):
+        return self.status
+
+    def get_queue_length(self):
+        return self.task_queue.get_length()
+
+    def get_estimated_wait_sec(self):
+        """
+        Return the estimated time before a newly submitted task starts to execute.
+        """
+        if self.status == HardwareEngineHttp.STATUS_IDLE:
+            return self.task_queue.get_estimated_wait_sec()
+        return self.task_queue.get_estimated_wait_sec(
+                running_task_elapsed_sec=time.time() - self.task_start_time,
+                running_task_limit_sec=self.task_execution_time_sec,
+        )
+
+    #
+    # task scheduling
+    #
+    def _start_next_task(self):
+        """
+        Pop a task from the queue and start grading it asynchronously. The caller should hold
+        self.status_lock.
+
+        Return:
+          True if a task is started, False if there is no pending task
+        """
+        # store assignment info. A task whose files cannot be restored is dropped
+        while True:
+            if self.task_queue.get_length() == 0:
+                return False
+            try:
+                if not os.path.isdir(self.file_folder):
+                    os.makedirs(self.file_folder)
+                subprocess.call(['rm', '-rf', '%s/*' % self.file_folder])
+                secret_code, execution_time_sec = self.task_queue.pop(self.file_folder)
+                break
+            except:
+                print('Unable to restore a queued task, drop it. Full stack trace below')
+                traceback.print_exc()
+
+        self.task_secret_code = secret_code
+        self.task_execution_time_sec = execution_time_sec
+        self.task_start_time = time.time()
+        self.status = HardwareEngineHttp.STATUS_TESTING
+
         # start the grading task asynchronously
         print('request_grade_task start')
         threading.Thread(
@@ -109,14 +191,14 @@ class HardwareEngineHttp(HardwareEngine):
 
         return True
 
-    #
-    # query status
-    #
-    def get_status(self):
-        return self.status
-
     #
     # Threads   
     #
     def _grade_thread(self, execution_time_sec):
-        self.grade_task(execution_time_sec)
+        try:
+            self.grade_task(execution_time_sec)
+        except:
+            # move on to the next task anyway, otherwise the testbed stays in TESTING forever
+            print('grade_task failed, full stack trace below')
+            traceback.print_exc()
+            self._finish_task()
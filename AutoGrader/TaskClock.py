@@ -0,0 +1,47 @@
+import time
+import threading
+
+
+class TaskClock(object):
+    """
+    The timebase shared by all the hardware during a task. It is based on the monotonic,
+    high-resolution perf_counter_ns(), and t=0 is when the hardware engine starts the test
+    (i.e., right before on_execute() of every hardware is invoked).
+
+    Hardware records when it actually starts via record_device_start(), so that the outputs of
+    different instruments can be aligned by these offsets.
+    """
+
+    def __init__(self):
+        self.start_ns = time.perf_counter_ns()
+        self.device_start_offsets_ns = {}
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        Set t=0 to now and forget the device start offsets of the previous task.
+        """
+        with self.lock:
+            self.start_ns = time.perf_counter_ns()
+            self.device_start_offsets_ns = {}
+
+    def get_time_ns(self):
+        return time.perf_counter_ns() - self.start_ns
+
+    def get_time_sec(self):
+        return self.get_time_ns() * 1e-9
+
+    def record_device_start(self, device_name):
+        """
+        Return:
+          The start offset of the device in seconds
+        """
+        offset_ns = self.get_time_ns()
+        with self.lock:
+            self.device_start_offsets_ns[device_name] = offset_ns
+        return offset_ns * 1e-9
+
+    def get_device_start_offsets_sec(self):
+        with self.lock:
+            return {name: offset_ns * 1e-9
+                    for name, offset_ns in self.device_start_offsets_ns.items()}
@@ -0,0 +1,163 @@
+import os
+import json
+import time
+import shutil
+import threading
+import collections
+
+
+class TaskQueue(object):
+    """
+    A bounded FIFO of grading tasks which is persisted on disk, so that submissions accepted while
+    the testbed is busy survive a restart of the testbed program.
+
+    Each task occupies a sub-folder of queue_folder named by a monotonically increasing sequence
+    number. The sub-folder holds the input files under "files/" and a "task.json" descriptor. The
+    descriptor is written last (via a rename), hence a sub-folder without a descriptor is an
+    incomplete submission and is discarded when the queue is loaded.
+    """
+
+    TASK_DESCRIPTOR_NAME = 'task.json'
+    TASK_FILES_FOLDER_NAME = 'files'
+
+    # number of finished tasks used to estimate the duration of the upcoming ones
+    DURATION_HISTORY_SIZE = 10
+
+    def __init__(self, queue_folder, max_length):
+        self.queue_folder = queue_folder
+        self.max_length = max_length
+
+        self.lock = threading.Lock()
+
+        # a list of (sequence number, task descriptor dictionary), in FIFO order
+        self.tasks = []
+        self.next_seq = 0
+
+        self.recent_durations = collections.deque(maxlen=TaskQueue.DURATION_HISTORY_SIZE)
+
+        if not os.path.isdir(self.queue_folder):
+            os.makedirs(self.queue_folder)
+        self._load_tasks()
+
+    def push(self, input_files, secret_code, execution_time_sec):
+        """
+        Params:
+          input_files: a dictionary of (string => bytestream)
+          secret_code: the code to return when finishing the grading
+          execution_time_sec: maximum time allowed to execute this task
+        Return:
+          True if the task is stored, False if the queue is full
+        """
+        with self.lock:
+            if len(self.tasks) >= self.max_length:
+                return False
+
+            seq = self.next_seq
+            self.next_seq += 1
+
+            task_folder = self._get_task_folder(seq)
+            files_folder = os.path.join(task_folder, TaskQueue.TASK_FILES_FOLDER_NAME)
+            os.makedirs(files_folder)
+            for file_name in input_files:
+                with open(os.path.join(files_folder, file_name), 'wb') as fo:
+                    fo.write(input_files[file_name])
+
+            task = {
+                'secret_code': secret_code,
+                'execution_time_sec': execution_time_sec,
+                'submission_time': time.time(),
+            }
+            descriptor_path = os.path.join(task_folder, TaskQueue.TASK_DESCRIPTOR_NAME)
+            tmp_descriptor_path = descriptor_path + '.tmp'
+            with open(tmp_descriptor_path, 'w') as fo:
+                json.dump(task, fo)
+                fo.flush()
+                os.fsync(fo.fileno())
+            os.rename(tmp_descriptor_path, descriptor_path)
+
+            self.tasks.append((seq, task))
+            return True
+
+    def pop(self, destination_folder):
+        """
+        Move the input files of the oldest task into destination_folder and remove the task from
+        the queue.
+
+        Return:
+          (secret_code, execution_time_sec) of the task, or None if the queue is empty
+        """
+        with self.lock:
+            if len(self.tasks) == 0:
+                return None
+            seq, task = self.tasks.pop(0)
+
+        task_folder = self._get_task_folder(seq)
+        files_folder = os.path.join(task_folder, TaskQueue.TASK_FILES_FOLDER_NAME)
+        if not os.path.isdir(destination_folder):
+            os.makedirs(destination_folder)
+        for file_name in os.listdir(files_folder):
+            shutil.move(os.path.join(files_folder, file_name),
+                    os.path.join(destination_folder, file_name))
+        shutil.rmtree(task_folder)
+
+        return (task['secret_code'], task['execution_time_sec'])
+
+    def get_length(self):
+        return len(self.tasks)
+
+    def record_task_duration(self, duration_sec):
+        self.recent_durations.append(duration_sec)
+
+    def get_estimated_wait_sec(self, running_task_elapsed_sec=None, running_task_limit_sec=None):
+        """
+        Estimate how long a newly submitted task has to wait before it starts. Finished tasks
+        give the expected duration of a task; before any task finishes, the execution time limit
+        of each queued task is used instead, which is an upper bound.
+
+        Params:
+          running_task_elapsed_sec: how long the current task has been running, None if the
+              testbed is idle
+          running_task_limit_sec: the execution time limit of the current task
+        """
+        with self.lock:
+            queued_limits = [task['execution_time_sec'] for _, task in self.tasks]
+
+        if len(self.recent_durations) > 0:
+            avg_duration = sum(self.recent_durations) / len(self.recent_durations)
+            queued_durations = [min(avg_duration, limit) for limit in queued_limits]
+        else:
+            avg_duration = None
+            queued_durations = queued_limits
+
+        wait_sec = sum(queued_durations)
+        if running_task_elapsed_sec is not None:
+            expected_duration = running_task_limit_sec
+            if avg_duration is not None and expected_duration is not None:
+                expected_duration = min(avg_duration, expected_duration)
+            if expected_duration is not None:
+                wait_sec += max(expected_duration - running_task_elapsed_sec, 0.)
+        return wait_sec
+
+    def _load_tasks(self):
+        seqs = []
+        for entry in os.listdir(self.queue_folder):
+            entry_path = os.path.join(self.queue_folder, entry)
+            if not entry.isdigit() or not os.path.isdir(entry_path):
+                continue
+            descriptor_path = os.path.join(entry_path, TaskQueue.TASK_DESCRIPTOR_NAME)
+            if not os.path.isfile(descriptor_path):
+                print('TaskQueue: discard incomplete task %s' % entry_path)
+                shutil.rmtree(entry_path)
+                continue
+            seqs.append(int(entry))
+
+        for seq in sorted(seqs):
+            with open(os.path.join(self._get_task_folder(seq), TaskQueue.TASK_DESCRIPTOR_NAME)) as f:
+                self.tasks.append((seq, json.load(f)))
+            self.next_seq = seq + 1
+
+        if len(self.tasks) > 0:
+            print('TaskQueue: %d task(s) restored from %s' % (len(self.tasks), self.queue_folder))
+
+    def _get_task_folder(self, seq):
+        return os.path.join(self.queue_folder, '%08d' % seq)
@@ -1,2 +1,4 @@
 from .HardwareEngine import *
 from .HardwareEngineHttp import *
+from .TaskQueue import *
+from .TaskClock import *
@@ -0,0 +1,121 @@
+import numpy
+
+
+class EnergyTrace(object):
+    """
+    A growable table of float64 rows. The storage is preallocated and doubled when full, so
+    appending a row is amortized O(1) and the whole table can be written out at once.
+    """
+
+    INITIAL_CAPACITY = 4096
+
+    # rows formatted at once by write_text(), which bounds the temporary strings and tuples
+    WRITE_BLOCK_NUM_ROWS = 8192
+
+    def __init__(self, num_columns, capacity=INITIAL_CAPACITY):
+        self.data = numpy.empty((max(capacity, 1), num_columns), dtype=numpy.float64)
+        self.num_rows = 0
+
+    def __len__(self):
+        return self.num_rows
+
+    def append(self, row):
+        self._reserve(self.num_rows + 1)
+        self.data[self.num_rows] = row
+        self.num_rows += 1
+
+    def extend(self, rows):
+        """
+        Params:
+          rows: a 2D array-like with num_columns columns
+        """
+        rows = numpy.asarray(rows, dtype=numpy.float64)
+        self._reserve(self.num_rows + len(rows))
+        self.data[self.num_rows:self.num_rows + len(rows)] = rows
+        self.num_rows += len(rows)
+
+    def get(self):
+        """
+        Return:
+          A view of the filled rows
+        """
+        return self.data[:self.num_rows]
+
+    def write_text(self, file_path, row_format):
+        """
+        Params:
+          row_format: the format of a row, e.g., "%f %f\n"
+        """
+        rows = self.get()
+        with open(file_path, 'w') as fo:
+            for sidx in range(0, len(rows), EnergyTrace.WRITE_BLOCK_NUM_ROWS):
+                block = rows[sidx:sidx + EnergyTrace.WRITE_BLOCK_NUM_ROWS]
+                fo.write((row_format * len(block)) % tuple(block.ravel().tolist()))
+
+    def write_npy(self, file_path):
+        numpy.save(file_path, self.get())
+
+    def _reserve(self, num_rows):
+        if num_rows > len(self.data):
+            new_data = numpy.empty((max(num_rows, len(self.data) * 2), self.data.shape[1]),
+                    dtype=numpy.float64)
+            new_data[:self.num_rows] = self.data[:self.num_rows]
+            self.data = new_data
+
+
+class EnergyWindowAggregator(object):
+    """
+    Summarizes power samples into fixed-length windows as the samples arrive. Each window
+    becomes a row of (window start time in sec, mean power, min power, max power, energy). The
+    mean is over the samples in the window, and the energy is the integral of power over the
+    window. Windows without samples are skipped.
+    """
+
+    NUM_COLUMNS = 5
+
+    def __init__(self, window_sec):
+        self.window_sec = window_sec
+        self.rows = EnergyTrace(EnergyWindowAggregator.NUM_COLUMNS)
+        self._start_window(None)
+
+    def add_sample(self, age, power, energy):
+        """
+        Params:
+          age: the time of the sample in sec, non-decreasing
+          power: the power of the sample
+          energy: the energy since the previous sample
+        """
+        window_idx = int(age // self.window_sec)
+        if window_idx != self.window_idx:
+            self._flush()
+            self._start_window(window_idx)
+        self.num_samples += 1
+        self.sum_power += power
+        self.min_power = min(self.min_power, power)
+        self.max_power = max(self.max_power, power)
+        self.energy += energy
+
+    def finish(self):
+        """
+        Close the last window.
+
+        Return:
+          The EnergyTrace of the window rows
+        """
+        self._flush()
+        self._start_window(None)
+        return self.rows
+
+    def _start_window(self, window_idx):
+        self.window_idx = window_idx
+        self.num_samples = 0
+        self.sum_power = 0.
+        self.min_power = float('inf')
+        self.max_power = float('-inf')
+        self.energy = 0.
+
+    def _flush(self):
+        if self.num_samples == 0:
+            return
+        self.rows.append((self.window_idx * self.window_sec, self.sum_power / self.num_samples,
+                self.min_power, self.max_power, self.energy))
@@ -32,6 +32,11 @@ class HardwareBase(object):
         will call this method for the hardware itself to clean up. Implementing this method
         is optional since you may consider integrating the procedure into on_before_execution()
         method.
+
+        If the task is aborted because some hardware fails in on_before_execution(), this
+        method is called without on_execute() and on_terminate(), on the hardware which is
+        prepared and on the one which failed. It should release what on_before_execution() may
+        have partially set up.
         """
         pass
 
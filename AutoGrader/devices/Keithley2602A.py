@@ -5,30 +5,52 @@ import struct
 import socket
 import time
 import numpy
-import datetime
 import os
+import threading
 
 from AutoGrader.devices import HardwareBase
+from AutoGrader.devices.TSPReplyParser import TSPReplyParser
+from AutoGrader.devices.EnergyTrace import EnergyTrace, EnergyWindowAggregator
 
 
 class Keithley2602A(HardwareBase):
+    # measure() of the on-board script replies a line of 3 tab-separated values. The last two
+    # are the sensing time and the energy during the sensing time.
+    NUM_REPLY_FIELDS = 3
+
+    DEFAULT_PIPELINE_DEPTH = 4
+    RECV_SIZE = 4096
+    RECV_TIMEOUT_SEC = 0.05
+    TERMINATE_TIMEOUT_SEC = 5.
+
+    # device info
+    name = None
+    hardware_engine = None
+
     # parameters
     host = None
     port = None
     energy_file_path = None
+    energy_npy_file_path = None
+    aggregate_file_path = None
+    aggregate_window_sec = None
+    sample_rate_hz = None
+    pipeline_depth = DEFAULT_PIPELINE_DEPTH
    
     # connection
     sock = None
+    reply_parser = None
 
     # status
     is_running = False
-    is_measuring = False
+    measurement_done = None
 
     # statistics
     start_measurement_time = None
     prev_measurement_time = None
     accu_energy = None
-    energy_trace = None
+    energy_trace = None  # rows of (age, accumulated energy)
+    energy_aggregator = None
 
     def __init__(self, name, config, hardware_engine, file_folder):
         if "host" not in config:
@@ -43,61 +65,154 @@ class Keithley2602A(HardwareBase):
             raise Exception('"output_energy_file" field is required')
         self.energy_file_path = os.path.join(file_folder, config['output_energy_file'])
 
+        self.name = name
+        self.hardware_engine = hardware_engine
+
+        # the same trace as output_energy_file, as a (n, 2) float64 array in .npy format
+        if 'output_energy_npy_file' in config and config['output_energy_npy_file']:
+            self.energy_npy_file_path = os.path.join(file_folder, config['output_energy_npy_file'])
+
+        # power and energy summarized per window of aggregate_window_ms, see
+        # EnergyWindowAggregator for the columns
+        if 'output_aggregate_file' in config and config['output_aggregate_file']:
+            if 'aggregate_window_ms' not in config:
+                raise Exception('"aggregate_window_ms" field is required by "output_aggregate_file"')
+            self.aggregate_file_path = os.path.join(file_folder, config['output_aggregate_file'])
+            self.aggregate_window_sec = config['aggregate_window_ms'] / 1000.
+
+        # measure requests are sent at this rate. If not specified, as fast as the instrument
+        # replies
+        if 'sample_rate_hz' in config:
+            self.sample_rate_hz = config['sample_rate_hz']
+
+        # the number of measure requests which can be sent before their replies arrive
+        if 'pipeline_depth' in config:
+            self.pipeline_depth = config['pipeline_depth']
+        if self.pipeline_depth < 1:
+            raise Exception('"pipeline_depth" has to be at least 1')
+
+        self.measurement_done = threading.Event()
+        self.measurement_done.set()
+
     def on_before_execution(self):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.connect((self.host, self.port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.sock.send(b'TSB_Script.run()\n')
         #self._send_abort_command()
         #self.sock.send(b'reset()\n')
         #self.sock.send(b'set_parameters()\n')
         #self.sock.send(b'begin_supply()\n')
+        self.reply_parser = TSPReplyParser(Keithley2602A.NUM_REPLY_FIELDS)
         
         self.is_running = True
-        self.is_measuring = False
+        self.measurement_done.clear()
 
     def on_execute(self):
-        self.start_measurement_time = datetime.datetime.now()
-        self.prev_measurement_time = self.start_measurement_time
-        self.accu_energy = 0.
-        self.energy_trace = []
-        while self.is_running:
-            self._send_measure_command()
+        self._reset_trace()
+        try:
+            self._sample()
+        finally:
+            self.measurement_done.set()
     
     def on_terminate(self):
         self.is_running = False
-        while self.is_measuring:
-            pass
-        with open(self.energy_file_path, 'w') as fo:
-            for age, energy in self.energy_trace:
-                fo.write('%f %f\n' % (age, energy))
-                print('Keithley', age, energy)
+        if not self.measurement_done.wait(Keithley2602A.TERMINATE_TIMEOUT_SEC):
+            print('Keithley sampling does not stop in %f sec' % Keithley2602A.TERMINATE_TIMEOUT_SEC)
+        print('Keithley %d samples, %s' % (len(self.energy_trace), self.reply_parser.get_stats()))
+        self.energy_trace.write_text(self.energy_file_path, '%f %f\n')
+        if self.energy_npy_file_path:
+            self.energy_trace.write_npy(self.energy_npy_file_path)
+        if self.energy_aggregator:
+            self.energy_aggregator.finish().write_text(
+                    self.aggregate_file_path, '%f %f %f %f %f\n')
 
     def on_reset_after_execution(self):
         #self.sock.send(b'end_supply()\n')
         #self._send_abort_command()
-        self.sock.close()
+        if self.sock:
+            self.sock.close()
         self.sock = None
 
     def _send_abort_command(self):
         self.sock.send(b"*RST\n")
         self.sock.send(b"abort\n")
         self.sock.send(b"*CLS\n")
-        
-    def _send_measure_command(self):
-        self.is_measuring = True
-        self.sock.send(b"measure()\n")
-        buf = self.sock.recv(4096)
-        buf.decode('ascii').split('\t')
-        _, sensing_time, energy = tuple(map(float, buf.decode('ascii').split('\t')))
-        cur_time = datetime.datetime.now()
-        session_elapsed_time = self._convert_timedelta_in_ms_precision(cur_time - self.prev_measurement_time)
-        session_energy = energy / sensing_time * session_elapsed_time
-        age = self._convert_timedelta_in_ms_precision(cur_time - self.start_measurement_time)
-        print('age', age)
-        self.accu_energy += session_energy
-        self.energy_trace.append((age, self.accu_energy))
+
+    def _sample(self):
+        """
+        Keep up to pipeline_depth measure requests in flight so that the round trip time of the
+        network does not limit the sample rate. If sample_rate_hz is set, requests are sent on a
+        fixed schedule instead. The replies still in flight when the task terminates are
+        discarded together with the connection.
+        """
+        request_interval_sec = 1. / self.sample_rate_hz if self.sample_rate_hz else 0.
+        num_pending_requests = 0
+        next_request_time = time.monotonic()
+
+        while self.is_running:
+            # send requests which are due
+            now = time.monotonic()
+            while num_pending_requests < self.pipeline_depth and now >= next_request_time:
+                self.sock.send(b"measure()\n")
+                num_pending_requests += 1
+                # do not burst to catch up if we fell behind by more than one interval
+                next_request_time = max(next_request_time + request_interval_sec,
+                        now - request_interval_sec)
+
+            # wait for replies, but not beyond the time of the next request
+            timeout_sec = Keithley2602A.RECV_TIMEOUT_SEC
+            if num_pending_requests < self.pipeline_depth:
+                timeout_sec = min(timeout_sec, max(next_request_time - time.monotonic(), 0.))
+            if timeout_sec <= 0.:
+                continue
+            self.sock.settimeout(timeout_sec)
+            try:
+                data = self.sock.recv(Keithley2602A.RECV_SIZE)
+            except socket.timeout:
+                continue
+            if not data:
+                print('Keithley connection is closed by the instrument')
+                break
+
+            # a malformed line, e.g., an error message, still answers a request
+            replies, num_lines = self.reply_parser.feed(data)
+            num_pending_requests = max(num_pending_requests - num_lines, 0)
+            self._record_samples(replies, self.hardware_engine.task_clock.get_time_sec())
+
+    def _record_samples(self, replies, cur_time):
+        """
+        Replies arriving in the same chunk share the time elapsed since the previous chunk
+        evenly.
+
+        Params:
+          replies: a list of parsed replies
+          cur_time: the arrival time of the replies on the task clock, in seconds
+        """
+        if len(replies) == 0:
+            return
+        chunk_elapsed_time = cur_time - self.prev_measurement_time
+        base_age = self.prev_measurement_time - self.start_measurement_time
+        session_elapsed_time = chunk_elapsed_time / len(replies)
+
+        values = numpy.array(replies, dtype=numpy.float64)
+        powers = values[:, 2] / values[:, 1]
+        session_energies = powers * session_elapsed_time
+        ages = base_age + session_elapsed_time * numpy.arange(1, len(replies) + 1)
+        accu_energies = self.accu_energy + numpy.cumsum(session_energies)
+        self.energy_trace.extend(numpy.column_stack((ages, accu_energies)))
+        self.accu_energy = float(accu_energies[-1])
+
+        if self.energy_aggregator:
+            for sample in zip(ages.tolist(), powers.tolist(), session_energies.tolist()):
+                self.energy_aggregator.add_sample(*sample)
         self.prev_measurement_time = cur_time
-        self.is_measuring = False
 
-    def _convert_timedelta_in_ms_precision(self, dt):
-        return dt.seconds + dt.microseconds * 1e-6
+    def _reset_trace(self):
+        self.start_measurement_time = self.hardware_engine.task_clock.record_device_start(
+                self.name)
+        self.prev_measurement_time = self.start_measurement_time
+        self.accu_energy = 0.
+        self.energy_trace = EnergyTrace(2)
+        if self.aggregate_window_sec:
+            self.energy_aggregator = EnergyWindowAggregator(self.aggregate_window_sec)
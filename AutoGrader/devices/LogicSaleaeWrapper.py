@@ -4,6 +4,7 @@ import traceback
 import shutil
 import os
 import time
+import tempfile
 
 import saleae
 
@@ -15,16 +16,20 @@ class LogicSaleaeWrapper(HardwareBase):
     Before testbed is running, make sure start Logic Saleae GUI first
     """
 
-    TMP_OUTPUT_PATH = '/tmp/logic.csv'
+    # the raw data is exported to a unique file in this folder for every task
+    TMP_OUTPUT_FOLDER = '/tmp'
 
     def __init__(self, name, config, hardware_engine, file_folder):
         
         # parameters
         self.output_waveform_path = None
+        self.output_binary_waveform_path = None
+        self.output_mapped_waveform_path = None
 
         # device info
         self.name = None
         self.config = None
+        self.hardware_engine = None
 
         # Saleae instance
         self.saleae_dev = None
@@ -37,6 +42,16 @@ class LogicSaleaeWrapper(HardwareBase):
             raise Exception('"output_waveform_file" field is required')
         self.output_waveform_path = os.path.join(file_folder, config['output_waveform_file'])
 
+        # the transitions of the waveform can additionally be written in the binary format
+        if 'output_binary_waveform_file' in config and config['output_binary_waveform_file']:
+            self.output_binary_waveform_path = os.path.join(
+                    file_folder, config['output_binary_waveform_file'])
+
+        # and in the columns layout of the binary format, which the readers can memory-map
+        if 'output_mapped_waveform_file' in config and config['output_mapped_waveform_file']:
+            self.output_mapped_waveform_path = os.path.join(
+                    file_folder, config['output_mapped_waveform_file'])
+
         self.seleae_dev = saleae.Saleae()
         if not self.seleae_dev:
             raise Exception('No Logic Seleae detected')
@@ -46,19 +61,24 @@ class LogicSaleaeWrapper(HardwareBase):
 
         self.name = name
         self.config = config
+        self.hardware_engine = hardware_engine
 
     def on_before_execution(self):
         self.seleae_dev.set_capture_seconds(300) # test for maximum 5 minutes
-        self.execution_start_time = time.time()
 
     def on_execute(self):
+        self.execution_start_time = self.hardware_engine.task_clock.record_device_start(self.name)
         self.seleae_dev.capture_start()
 
     def on_terminate(self):
         self.seleae_dev.capture_stop()
-        self.seleae_dev.export_data2(LogicSaleaeWrapper.TMP_OUTPUT_PATH)
+        execution_time = (self.hardware_engine.task_clock.get_time_sec()
+                - self.execution_start_time)
 
-        execution_time = time.time() - self.execution_start_time
+        tmp_fd, tmp_output_path = tempfile.mkstemp(prefix=('logic-%s-' % self.name),
+                suffix='.csv', dir=LogicSaleaeWrapper.TMP_OUTPUT_FOLDER)
+        os.close(tmp_fd)
+        self.seleae_dev.export_data2(tmp_output_path)
         
         writer = LogicSaleaeWaveformFileWriter(self.output_waveform_path)
         writer.set_period_sec(execution_time)
@@ -69,8 +89,12 @@ class LogicSaleaeWrapper(HardwareBase):
                     plot_pins=pin_set['indexes'],
             )
         
-        writer.set_raw_data_path(LogicSaleaeWrapper.TMP_OUTPUT_PATH)
-        writer.marshal()
+        writer.set_raw_data_path(tmp_output_path)
+        try:
+            writer.marshal(binary_file_path=self.output_binary_waveform_path,
+                    mapped_file_path=self.output_mapped_waveform_path)
+        finally:
+            os.remove(tmp_output_path)
     
     def on_reset_after_execution(self):
         pass
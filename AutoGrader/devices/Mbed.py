@@ -9,6 +9,8 @@ import subprocess
 import shutil
 
 from AutoGrader.devices import HardwareBase
+from AutoGrader.devices.MbedFlasher import MbedFlasher
+from AutoGrader.devices.TerminationCondition import create_termination_conditions
 
 
 class Mbed(HardwareBase, threading.Thread):
@@ -19,17 +21,34 @@ class Mbed(HardwareBase, threading.Thread):
     usb_path = None
     blank_firmware_path = None
     testing_firmware_path = None
+    # None polls every flashing step for at most its fixed delay, see MbedFlasher
+    flash_timeout_sec = None
+    force_reflash = False
+    collapse_blank_burn = False
     serial_output_path = None
+    serial_index_path = None
     log_size = 1000000
 
+    # serial capture
+    MAX_READ_SIZE = 4096
+    FLUSH_INTERVAL_SEC = 0.1
+
     # device info
     hardware_engine = None
     name = None
     config = None
 
+    # firmware programming
+    flasher = None
+
+    # early termination
+    termination_condition_configs = None
+    termination_conditions = None
+
     # serial
     dev = None
     f_serial = None
+    f_serial_index = None
     byte_written = None
 
     # working threads
@@ -77,32 +96,54 @@ class Mbed(HardwareBase, threading.Thread):
         else:
             self.serial_output_path = '/dev/null'
 
+        # an optional side file recording when each chunk of serial output arrives
+        if 'serial_index_output' in config:
+            self.serial_index_path = os.path.join(file_folder, config['serial_index_output'])
+
         if 'log_size' in config:
             self.log_size = config['log_size']
 
+        if 'termination_conditions' in config:
+            self.termination_condition_configs = config['termination_conditions']
+            create_termination_conditions(self.termination_condition_configs)  # validate
+
+        if 'flash_timeout_sec' in config:
+            self.flash_timeout_sec = config['flash_timeout_sec']
+
+        if 'force_reflash' in config:
+            self.force_reflash = config['force_reflash']
+
+        if 'collapse_blank_burn' in config:
+            self.collapse_blank_burn = config['collapse_blank_burn']
+
         # backup configurations
         self.hardware_engine = hardware_engine
         self.name = name
         self.config = config
         
+        self.flasher = MbedFlasher(self.name, self.mount_path, self.dev_path, self.usb_path,
+                device_desp='mbed', timeout_sec=self.flash_timeout_sec)
+
         # take file system snapshot
         if os.getuid() != 0:
             raise Exception("FATAL: Require root permission")
         
-        print("Unmounting.. (mbed name=%s) %s" % (self.name, self.dev_path))
-        subprocess.call(['umount', self.dev_path])
-        time.sleep(3)
-        
-        print("Mounting back (mbed name=%s) %s %s" % (self.name, self.dev_path, self.mount_path))
-        subprocess.call(['mount', self.dev_path, self.mount_path])
-        time.sleep(0.3)
+        self.flasher.remount()
 
     def on_before_execution(self):
-        self._burn_firmware(self.blank_firmware_path, firmware_short_desp='blank')
-        self._burn_firmware(self.testing_firmware_path, firmware_short_desp='testing')
+        testing_firmware_burnt = self.flasher.prepare_firmware(
+                self.blank_firmware_path,
+                self.testing_firmware_path,
+                force_reflash=self.force_reflash,
+                collapse_blank_burn=self.collapse_blank_burn,
+        )
         
         self.f_serial = open(self.serial_output_path, 'wb')
+        if self.serial_index_path:
+            self.f_serial_index = open(self.serial_index_path, 'w')
         self.byte_written = 0
+        self.termination_conditions = create_termination_conditions(
+                self.termination_condition_configs)
         
         tmp_dev = serial.Serial()
         tmp_dev.port = self.usb_path
@@ -119,6 +160,12 @@ class Mbed(HardwareBase, threading.Thread):
         self.dev = tmp_dev
         print('(mbed) UART is open')
 
+        # The board already holds the testing firmware, so it was not restarted by burning. The
+        # mbed interface chip resets the target on a serial break.
+        if not testing_firmware_burnt:
+            self.dev.send_break()
+            print('(mbed) Reset by serial break')
+
         # pull obselete bytes from last session
         self.dev.reset_input_buffer()
         self.dev.reset_output_buffer()
@@ -137,54 +184,77 @@ class Mbed(HardwareBase, threading.Thread):
 
     def on_terminate(self):
         self.alive = False
+
+        # wait until the remaining output is written, unless the termination is requested by
+        # the reading thread itself
+        if (self.serial_reading_thread
+                and self.serial_reading_thread is not threading.current_thread()):
+            self.serial_reading_thread.join()
     
     def on_reset_after_execution(self):
-        pass
+        # the reading thread is still running if the task is aborted before the execution
+        self.on_terminate()
 
     def __del__(self):
         if self.dev and self.dev.is_open:
             self.dev.close()
 
-    def _burn_firmware(self, firmware_path, firmware_short_desp=None):
-        # To make the burning process smoother, we have to copy the code to mbeds, unmound mbeds,
-        # and mound mbeds. After we adapt to it, we didn't see any burning error.
-        if not firmware_short_desp:
-            firmware_short_desp = ''
-        else:
-            firmware_short_desp += ' '
-        
-        print("Removing old codes from mbed (name=%s)" % self.name)
-        subprocess.call(['rm', '-rf', '%s/*' % self.mount_path])
-        time.sleep(3)
-        
-        print("programming %sfirmware on mbed (name=%s)" % (firmware_short_desp, self.name))
-        shutil.copy(firmware_path, self.mount_path)
-        time.sleep(3)
-        
-        print("Unmounting.. (mbed name=%s) %s" % (self.name, self.dev_path))
-        subprocess.call(['umount', self.dev_path])
-        time.sleep(3)
-        
-        print("Mounting back (mbed name=%s) %s %s" % (self.name, self.dev_path, self.mount_path))
-        subprocess.call(['mount', self.dev_path, self.mount_path])
-        time.sleep(3)
-    
     def _read_serial(self):
+        # Keep the objects of this session. Requesting a termination from this thread may let
+        # the hardware engine prepare the next task before this thread finishes.
+        dev = self.dev
+        f_serial = self.f_serial
+        f_serial_index = self.f_serial_index
+
+        last_flush_time = time.time()
+        self.termination_conditions.reset(last_flush_time)
+
         while self.alive:
-            b = self.dev.read(1)
-            if not b:
+            # Take whatever has arrived. If nothing is there, wait for at most one read timeout
+            # for the next byte.
+            num_waiting_bytes = dev.in_waiting
+            chunk = dev.read(max(1, min(num_waiting_bytes, self.MAX_READ_SIZE)))
+            arrival_time = time.time()
+            if not chunk:
+                if self.termination_conditions.on_idle(arrival_time):
+                    print('(mbed) Termination condition met (name=%s)' % self.name)
+                    f_serial.flush()
+                    self.hardware_engine.notify_terminate()
+                    break
+
+                # the line went quiet, write out the bytes received since the last flush
+                if arrival_time - last_flush_time >= self.FLUSH_INTERVAL_SEC:
+                    f_serial.flush()
+                    last_flush_time = arrival_time
                 continue
 
             if self.byte_written < self.log_size:
-                self.byte_written += 1
-                self.f_serial.write(b)
-                self.f_serial.flush()
+                log_chunk = chunk[:self.log_size - self.byte_written]
+                if f_serial_index:
+                    f_serial_index.write('%d,%f\n' % (self.byte_written, arrival_time))
+                self.byte_written += len(log_chunk)
+                f_serial.write(log_chunk)
+
+            if self.termination_conditions.on_bytes(chunk, arrival_time):
+                print('(mbed) Termination condition met (name=%s)' % self.name)
+                f_serial.flush()
+                self.hardware_engine.notify_terminate()
+                break
+
+            # bound the latency of the log file instead of flushing every chunk
+            if arrival_time - last_flush_time >= self.FLUSH_INTERVAL_SEC:
+                f_serial.flush()
+                last_flush_time = arrival_time
 
         try:
-            self.dev.close()
-            self.f_serial.close()
+            dev.close()
+            f_serial.close()
+            if f_serial_index:
+                f_serial_index.close()
             print('(mbed) UART is closed')
         except:
             print('(mbed) UART device unable to close')
-        self.dev = None
-        self.f_serial = None
+        if self.dev is dev:
+            self.dev = None
+            self.f_serial = None
+            self.f_serial_index = None
@@ -0,0 +1,267 @@
+import os
+import time
+import hashlib
+import shutil
+import subprocess
+
+
+class MbedFlasher(object):
+    """
+    Programs an mbed board through its USB mass storage interface. After each step (removing
+    old firmware, copying the new one, unmounting and mounting back), the flasher waits for the
+    actual readiness signal of the step instead of sleeping for a fixed amount of time:
+
+      - the old firmware files are removed, and the removal is synced to the board
+      - the copied firmware is fsynced, and the block device re-enumerates in sysfs
+      - the mount table drops or lists the mount path
+      - the block device and the serial tty exist
+
+    A signal is polled for at most the fixed delay the original procedure slept for that step,
+    so a detection failure costs no more than the original procedure. timeout_sec, if set,
+    replaces that limit, e.g., to give a slow board longer than the fixed delay. A detection
+    failure then takes timeout_sec.
+
+    The flasher also remembers the content hash of the firmware last programmed successfully,
+    so that prepare_firmware() can skip burning an image which the board already holds. The
+    hash is only kept in memory, so it is lost when the testbed restarts, and the first task
+    after a restart always burns the firmware.
+
+    The paths of the mount table and the sysfs block folder are parameters, and the mount
+    commands and the delays can be overridden, so that the procedure can be exercised against
+    a fake mount folder and a fake sysfs tree (see helper/check_mbed_flasher.py).
+    """
+
+    UMOUNT_CMD = ['umount']
+    MOUNT_CMD = ['mount']
+
+    # the fixed delays used when a readiness signal cannot be detected
+    FALLBACK_DELAY_SEC = 3.
+    FALLBACK_BOOT_DELAY_SEC = 4.
+
+    POLL_INTERVAL_SEC = 0.05
+
+    def __init__(self, name, mount_path, dev_path, usb_path, device_desp='mbed', timeout_sec=None,
+            mounts_file_path='/proc/mounts', sysfs_block_path='/sys/class/block'):
+        self.name = name
+        self.mount_path = mount_path
+        self.dev_path = dev_path
+        self.usb_path = usb_path
+        self.device_desp = device_desp
+        self.timeout_sec = timeout_sec
+        self.mounts_file_path = mounts_file_path
+        self.sysfs_block_path = sysfs_block_path
+
+        # sha256 of the firmware on the board, None if unknown
+        self.flashed_firmware_hash = None
+
+    def prepare_firmware(self, blank_firmware_path, testing_firmware_path, force_reflash=False,
+            collapse_blank_burn=False):
+        """
+        Bring the board to run the testing firmware. The blank firmware is burnt first unless
+        collapse_blank_burn is set. Nothing is burnt if the board already holds an identical
+        testing image.
+
+        Params:
+          blank_firmware_path: the do-nothing firmware, can be None
+          testing_firmware_path: the firmware to be tested
+          force_reflash: ignore what the board holds and burn both firmwares
+          collapse_blank_burn: burn the testing firmware directly
+        Return:
+          True if the testing firmware is burnt, which also restarts the board. False if the
+          burn is skipped, hence the caller has to reset the board by other means.
+        """
+        if force_reflash:
+            self.invalidate_firmware_cache()
+
+        testing_hash = self.compute_firmware_hash(testing_firmware_path)
+        if testing_hash == self.flashed_firmware_hash:
+            print("%s (name=%s) already holds the testing firmware, skip burning" % (
+                self.device_desp, self.name))
+            return False
+
+        if blank_firmware_path and not collapse_blank_burn:
+            self.burn_firmware(blank_firmware_path, firmware_short_desp='blank')
+
+        self.burn_firmware(testing_firmware_path, firmware_short_desp='testing')
+        return True
+
+    def invalidate_firmware_cache(self):
+        self.flashed_firmware_hash = None
+
+    def compute_firmware_hash(self, firmware_path):
+        h = hashlib.sha256()
+        with open(firmware_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 16), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def burn_firmware(self, firmware_path, firmware_short_desp=None):
+        """
+        Return:
+          True if all the readiness signals are observed. Otherwise the content of the board
+          is considered as unknown.
+        """
+        # To make the burning process smoother, we have to copy the code to mbeds, unmound mbeds,
+        # and mound mbeds. After we adapt to it, we didn't see any burning error.
+        if not firmware_short_desp:
+            firmware_short_desp = ''
+        else:
+            firmware_short_desp += ' '
+
+        # the board content is unknown until the whole procedure succeeds
+        self.invalidate_firmware_cache()
+        firmware_hash = self.compute_firmware_hash(firmware_path)
+
+        print("Removing old codes from %s (name=%s)" % (self.device_desp, self.name))
+        success = self._remove_old_firmware()
+        if not success:
+            print('(%s) cannot confirm "old firmware removed" (name=%s), fall back to fixed '
+                    'delay' % (self.device_desp, self.name))
+            time.sleep(self.FALLBACK_DELAY_SEC)
+
+        print("programming %sfirmware on %s (name=%s)" % (
+            firmware_short_desp, self.device_desp, self.name))
+        self._copy_firmware(firmware_path)
+        self._wait_for_reenumeration()
+
+        success = self.remount() and success
+        if success:
+            self.flashed_firmware_hash = firmware_hash
+        return success
+
+    def remount(self):
+        """
+        Return:
+          True if all the readiness signals are observed
+        """
+        print("Unmounting.. (%s name=%s) %s" % (self.device_desp, self.name, self.dev_path))
+        subprocess.call(self.UMOUNT_CMD + [self.dev_path])
+        success = self._wait_for(lambda: not self._is_mounted(), 'unmounted',
+                self.FALLBACK_DELAY_SEC)
+
+        print("Mounting back (%s name=%s) %s %s" % (
+            self.device_desp, self.name, self.dev_path, self.mount_path))
+        success = self._wait_for(self._is_block_device_present, 'block device present',
+                self.FALLBACK_DELAY_SEC) and success
+        subprocess.call(self.MOUNT_CMD + [self.dev_path, self.mount_path])
+        success = self._wait_for(self._is_mounted, 'mounted',
+                self.FALLBACK_DELAY_SEC) and success
+        success = self._wait_for(self._is_tty_present, 'tty present', 0.) and success
+        return success
+
+    def wait_until_ready(self):
+        """
+        Wait until the board is mounted and its serial tty exists.
+        """
+        self._wait_for(lambda: self._is_mounted() and self._is_tty_present(), 'board ready',
+                self.FALLBACK_BOOT_DELAY_SEC)
+
+    #
+    # steps
+    #
+    def _remove_old_firmware(self):
+        """
+        Return:
+          True if the firmware files are removed and the removal is written through to the
+          board. Listing the mount folder alone would show the files gone right after
+          os.remove(), while the board may not have seen the removal yet.
+        """
+        for file_path in self._list_firmware_files():
+            try:
+                os.remove(file_path)
+            except OSError:
+                print('(%s) unable to remove %s' % (self.device_desp, file_path))
+        if len(self._list_firmware_files()) > 0:
+            return False
+
+        try:
+            fd = os.open(self.mount_path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        except OSError:
+            return False
+        return True
+
+    def _copy_firmware(self, firmware_path):
+        dst_path = os.path.join(self.mount_path, os.path.basename(firmware_path))
+        shutil.copy(firmware_path, dst_path)
+
+        # make sure the content reaches the board before it starts to flash
+        fd = os.open(dst_path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _wait_for_reenumeration(self):
+        """
+        Once the firmware is received, the board flashes itself and re-enumerates on USB, i.e.,
+        the block device disappears and comes back. If the board never disappears within the
+        fallback delay, it is assumed to be done flashing.
+        """
+        start_time = time.time()
+        while time.time() - start_time < self.FALLBACK_DELAY_SEC:
+            if not self._is_block_device_present():
+                self._wait_for(self._is_block_device_present, 'block device re-enumerated',
+                        self.FALLBACK_DELAY_SEC)
+                return
+            time.sleep(self.POLL_INTERVAL_SEC)
+
+    def _wait_for(self, condition, desp, fallback_delay_sec):
+        """
+        Poll condition until it holds, for at most fallback_delay_sec, or timeout_sec if it is
+        set. If the condition is not observed, make sure at least fallback_delay_sec is passed
+        since the method was called, which only sleeps further if timeout_sec is shorter.
+
+        Return:
+          True if the condition is observed, otherwise False
+        """
+        limit_sec = fallback_delay_sec if self.timeout_sec is None else self.timeout_sec
+        start_time = time.time()
+        while True:
+            try:
+                if condition():
+                    return True
+            except OSError:
+                pass
+            elapsed_time = time.time() - start_time
+            if elapsed_time >= limit_sec:
+                break
+            time.sleep(self.POLL_INTERVAL_SEC)
+
+        print('(%s) cannot detect "%s" (name=%s), fall back to fixed delay' % (
+            self.device_desp, desp, self.name))
+        remaining_sec = fallback_delay_sec - (time.time() - start_time)
+        if remaining_sec > 0:
+            time.sleep(remaining_sec)
+        return False
+
+    #
+    # readiness signals
+    #
+    def _list_firmware_files(self):
+        if not os.path.isdir(self.mount_path):
+            return []
+        return [os.path.join(self.mount_path, f) for f in os.listdir(self.mount_path)
+                if f.lower().endswith('.bin')]
+
+    def _is_mounted(self):
+        mount_path = os.path.normpath(self.mount_path)
+        with open(self.mounts_file_path) as f:
+            for line in f:
+                terms = line.split()
+                if len(terms) < 2:
+                    continue
+                # spaces in the mount point are escaped as \040 in the mount table
+                if os.path.normpath(terms[1].replace('\\040', ' ')) == mount_path:
+                    return True
+        return False
+
+    def _is_block_device_present(self):
+        return os.path.exists(
+                os.path.join(self.sysfs_block_path, os.path.basename(self.dev_path)))
+
+    def _is_tty_present(self):
+        return os.path.exists(self.usb_path)
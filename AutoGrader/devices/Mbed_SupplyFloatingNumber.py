@@ -7,8 +7,14 @@ import traceback
 import subprocess
 import shutil
 import time
+import hashlib
+import json
+import select
+import numpy
 
 from AutoGrader.devices import HardwareBase
+from AutoGrader.devices.MbedFlasher import MbedFlasher
+from AutoGrader.devices.TerminationCondition import create_termination_conditions
 
 
 class Mbed_SupplyFloatingNumber(HardwareBase, threading.Thread):
@@ -19,14 +25,34 @@ class Mbed_SupplyFloatingNumber(HardwareBase, threading.Thread):
     usb_path = None
     blank_firmware_path = None
     testing_firmware_path = None
+    # None polls every flashing step for at most its fixed delay, see MbedFlasher
+    flash_timeout_sec = None
+    force_reflash = False
+    collapse_blank_burn = False
     floating_file_path = None
+    input_cache_folder = None
     serial_output_path = None
+    transmission_stats_path = None
+
+    # serial capture
+    MAX_READ_SIZE = 4096
+    FLUSH_INTERVAL_SEC = 0.1
+
+    # transmission
+    WRITE_POLL_INTERVAL_SEC = 0.01
 
     # device info
     hardware_engine = None
     name = None
     config = None
 
+    # firmware programming
+    flasher = None
+
+    # early termination
+    termination_condition_configs = None
+    termination_conditions = None
+
     # serial
     dev = None
     f_serial = None
@@ -42,6 +68,7 @@ class Mbed_SupplyFloatingNumber(HardwareBase, threading.Thread):
 
     # input info
     num_samples = None
+    input_samples = None
     input_bytes = None
     sending_events = None
     expected_received_bytes = None
@@ -85,59 +112,78 @@ class Mbed_SupplyFloatingNumber(HardwareBase, threading.Thread):
             raise Exception('"floating_input_file" field is required')
         self.floating_file_path = os.path.join(file_folder, config['floating_input_file'])
 
+        # the compiled input is only cached if a folder is specified. The folder has to be
+        # outside of file_folder, which is moved to the backup folder after every task
+        if 'input_cache_folder' in config:
+            self.input_cache_folder = config['input_cache_folder']
+
         if 'serial_output' in config:
             self.serial_output_path = os.path.join(file_folder, config['serial_output'])
         else:
             self.serial_output_path = '/dev/null'
 
+        # without explicit conditions, the task ends once the expected output is received
+        if 'termination_conditions' in config:
+            self.termination_condition_configs = config['termination_conditions']
+            create_termination_conditions(self.termination_condition_configs)  # validate
+
+        if 'transmission_stats_output' in config:
+            self.transmission_stats_path = os.path.join(
+                    file_folder, config['transmission_stats_output'])
+
+        if 'flash_timeout_sec' in config:
+            self.flash_timeout_sec = config['flash_timeout_sec']
+
+        if 'force_reflash' in config:
+            self.force_reflash = config['force_reflash']
+
+        if 'collapse_blank_burn' in config:
+            self.collapse_blank_burn = config['collapse_blank_burn']
+
         # backup configurations
         self.hardware_engine = hardware_engine
         self.name = name
         self.config = config
 
+        self.flasher = MbedFlasher(self.name, self.mount_path, self.dev_path, self.usb_path,
+                device_desp='DUT', timeout_sec=self.flash_timeout_sec)
+
         # take file system snapshot
         if os.getuid() != 0:
             raise Exception("FATAL: Require root permission")
 
         #self.existing_ttys = self._device_folder_snapshot()
         
-        print("Unmounting.. (DUT name=%s) %s" % (self.name, self.dev_path))
-        subprocess.call(['umount', self.dev_path])
-        time.sleep(3)
-        
-        print("Mounting back (DUT name=%s) %s %s" % (self.name, self.dev_path, self.mount_path))
-        subprocess.call(['mount', self.dev_path, self.mount_path])
-        time.sleep(0.3)
+        self.flasher.remount()
 
     def on_before_execution(self):
         # prepare the input
-        with open(self.floating_file_path) as f:
-            self.num_samples = int(f.readline().strip())
-            self.input_bytes = b''
-            for i in range(self.num_samples):
-                x, y, z = tuple(map(float, f.readline().strip().split(' ')))
-                self.input_bytes += struct.pack('=fff', x, y, z)
-            num_sending_events = int(f.readline().strip())
-            self.sending_events = []
-            for i in range(num_sending_events):
-                terms = f.readline().strip().split(' ')
-                num_bytes, waiting_time = int(terms[0]), float(terms[1])
-                self.sending_events.append((num_bytes, waiting_time))
+        self._load_input()
         self.expected_received_bytes = (((self.num_samples // 100) * 21) + 3) * 4
 
         # configure the mbed
-        time.sleep(4.0)
+        self.flasher.wait_until_ready()
 
         #self.dev_path = self._get_dev_path()
         #self.usb_path = self._get_usb_path()
         print('dev path', self.dev_path)
         print('mount path', self.mount_path)
 
-        self._burn_firmware(self.blank_firmware_path, firmware_short_desp='blank')
-        self._burn_firmware(self.testing_firmware_path, firmware_short_desp='testing')
+        testing_firmware_burnt = self.flasher.prepare_firmware(
+                self.blank_firmware_path,
+                self.testing_firmware_path,
+                force_reflash=self.force_reflash,
+                collapse_blank_burn=self.collapse_blank_burn,
+        )
         
         self.f_serial = open(self.serial_output_path, 'wb')
         self.byte_written = 0
+
+        condition_configs = self.termination_condition_configs
+        if condition_configs is None:
+            condition_configs = [
+                    {'type': 'byte_count', 'num_bytes': self.expected_received_bytes}]
+        self.termination_conditions = create_termination_conditions(condition_configs)
         
         tmp_dev = serial.Serial()
         tmp_dev.port = self.usb_path
@@ -146,7 +192,7 @@ class Mbed_SupplyFloatingNumber(HardwareBase, threading.Thread):
         tmp_dev.bytesize = serial.EIGHTBITS
         tmp_dev.stopbits = serial.STOPBITS_ONE
         tmp_dev.timeout = 0.01
-        tmp_dev.writeTimeout = 0.0001
+        tmp_dev.writeTimeout = 0  # non-blocking, see _write_fully()
         
         self.alive = True
 
@@ -154,6 +200,12 @@ class Mbed_SupplyFloatingNumber(HardwareBase, threading.Thread):
         self.dev = tmp_dev
         print('(DUT) UART is open')
 
+        # The board already holds the testing firmware, so it was not restarted by burning. The
+        # mbed interface chip resets the target on a serial break.
+        if not testing_firmware_burnt:
+            self.dev.send_break()
+            print('(DUT) Reset by serial break')
+
         # pull obselete bytes from last session
         for i in range(4096):  # clean up to 4K bytes
             print('clean', i)
@@ -166,79 +218,218 @@ class Mbed_SupplyFloatingNumber(HardwareBase, threading.Thread):
         self.serial_reading_thread.start()
 
     def on_execute(self):
-        print('(DUT) on execute')
-        bidx = 0
         print('(DUT) on execute, %d events' % len(self.sending_events))
+        total_bytes = len(self.input_bytes)
+        bidx = 0
+        num_sent_bytes = 0
+        requested_duration_sec = 0.
+
+        # Chunk i is scheduled at the sum of the waiting times of the previous chunks, so time
+        # spent on writing does not accumulate into the schedule.
+        start_time = time.monotonic()
         for chunk_size, wait_time in self.sending_events:
-            for i in range(chunk_size):
-                if not self.alive:
-                    return
-                #print('(DUT) surely going to send chunk_size=%d, wait_time=%.3f' % (chunk_size, wait_time))
-                try:
-                    self.dev.write(self.input_bytes[bidx:bidx+1])
-                except:
-                    pass
-
-                #print(self.dev.write(self.input_bytes[bidx:bidx+1]))
-                bidx += 1
-                #print('(DUT) send %d/%d' % (bidx, len(self.input_bytes)))
-            print('(DUT) send %d/%d' % (bidx, len(self.input_bytes)))
-            time.sleep(wait_time)
+            if not self.alive:
+                break
+
+            chunk_end = min(bidx + chunk_size, total_bytes)
+            num_chunk_sent_bytes = self._write_fully(self.input_bytes[bidx:chunk_end])
+            num_sent_bytes += num_chunk_sent_bytes
+            if num_chunk_sent_bytes < chunk_end - bidx:
+                print('(DUT) only %d of bytes %d-%d are sent' % (
+                    num_chunk_sent_bytes, bidx, chunk_end))
+            bidx = chunk_end
+            print('(DUT) send %d/%d' % (bidx, total_bytes))
+
+            requested_duration_sec += wait_time
+            remaining_sec = start_time + requested_duration_sec - time.monotonic()
+            if remaining_sec > 0:
+                time.sleep(remaining_sec)
+        elapsed_sec = time.monotonic() - start_time
+
+        self._write_transmission_stats(
+                requested_bytes=bidx,
+                sent_bytes=num_sent_bytes,
+                dropped_bytes=bidx - num_sent_bytes,
+                requested_duration_sec=requested_duration_sec,
+                elapsed_sec=elapsed_sec,
+        )
 
     def on_terminate(self):
         self.alive = False
+
+        # wait until the remaining output is written, unless the termination is requested by
+        # the reading thread itself
+        if (self.serial_reading_thread
+                and self.serial_reading_thread is not threading.current_thread()):
+            self.serial_reading_thread.join()
+
+    def on_reset_after_execution(self):
+        # the reading thread is still running if the task is aborted before the execution
+        self.on_terminate()
     
     def __del__(self):
         if self.dev and self.dev.is_open:
             self.dev.close()
 
     def _read_serial(self):
+        # Keep the objects of this session. Requesting a termination from this thread may let
+        # the hardware engine prepare the next task before this thread finishes.
+        dev = self.dev
+        f_serial = self.f_serial
+
+        last_flush_time = time.time()
+        self.termination_conditions.reset(last_flush_time)
+
         while self.alive:
-            b = self.dev.read(1)
-            if not b:
+            num_waiting_bytes = dev.in_waiting
+            chunk = dev.read(max(1, min(num_waiting_bytes, self.MAX_READ_SIZE)))
+            arrival_time = time.time()
+            if not chunk:
+                if self.termination_conditions.on_idle(arrival_time):
+                    print('(DUT) Termination condition met')
+                    f_serial.flush()
+                    self.hardware_engine.notify_terminate()
+                    break
+
+                # the line went quiet, write out the bytes received since the last flush
+                if arrival_time - last_flush_time >= self.FLUSH_INTERVAL_SEC:
+                    f_serial.flush()
+                    last_flush_time = arrival_time
                 continue
 
             if self.byte_written < self.expected_received_bytes:
-                self.byte_written += 1
-                #if self.byte_written % 1 == 0:
-                print('(DUT) %d/%d written bytes' % (self.byte_written, self.expected_received_bytes), self.byte_written == self.expected_received_bytes)
-                self.f_serial.write(b)
-                self.f_serial.flush()
-                if self.byte_written == self.expected_received_bytes:
-                    self.hardware_engine.notify_terminate()
+                log_chunk = chunk[:self.expected_received_bytes - self.byte_written]
+                self.byte_written += len(log_chunk)
+                f_serial.write(log_chunk)
+                print('(DUT) %d/%d written bytes' % (
+                    self.byte_written, self.expected_received_bytes))
+
+            if self.termination_conditions.on_bytes(chunk, arrival_time):
+                print('(DUT) Termination condition met')
+                f_serial.flush()
+                self.hardware_engine.notify_terminate()
+                break
+
+            if arrival_time - last_flush_time >= self.FLUSH_INTERVAL_SEC:
+                f_serial.flush()
+                last_flush_time = arrival_time
 
         try:
-            self.dev.close()
-            self.f_serial.close()
+            dev.close()
+            f_serial.close()
             print('(DUT) UART is closed')
         except:
             print('(DUT) UART device unable to close')
-        self.dev = None
-        self.f_serial = None
-
-    def _burn_firmware(self, firmware_path, firmware_short_desp=None):
-        # To make the burning process smoother, we have to copy the code to mbeds, unmound mbeds,
-        # and mound mbeds. After we adapt to it, we didn't see any burning error.
-        if not firmware_short_desp:
-            firmware_short_desp = ''
+        if self.dev is dev:
+            self.dev = None
+            self.f_serial = None
+
+    def _write_fully(self, data):
+        """
+        Keep writing until all of data is sent, the task is terminated, or the port fails.
+
+        With writeTimeout=0, pyserial returns after a single os.write(), but keeps retrying
+        while the port is not writable (EAGAIN) without ever checking self.alive. Hence we only
+        write once select() reports the port writable, and poll self.alive in between.
+
+        Return:
+          The number of bytes sent, including the bytes sent before a failure
+        """
+        num_sent_bytes = 0
+        try:
+            while num_sent_bytes < len(data) and self.alive:
+                _, writable, _ = select.select([], [self.dev.fd], [],
+                        self.WRITE_POLL_INTERVAL_SEC)
+                if writable:
+                    num_sent_bytes += self.dev.write(data[num_sent_bytes:])
+        except (serial.SerialException, OSError, ValueError):
+            print('(DUT) unable to write to UART')
+        return num_sent_bytes
+
+    def _write_transmission_stats(self, requested_bytes, sent_bytes, dropped_bytes,
+            requested_duration_sec, elapsed_sec):
+        stats = {
+            'requested_bytes': requested_bytes,
+            'sent_bytes': sent_bytes,
+            'dropped_bytes': dropped_bytes,
+            'requested_duration_sec': requested_duration_sec,
+            'elapsed_sec': elapsed_sec,
+            'requested_throughput_bps': (
+                requested_bytes / requested_duration_sec if requested_duration_sec > 0 else None),
+            'achieved_throughput_bps': sent_bytes / elapsed_sec if elapsed_sec > 0 else None,
+        }
+        print('(DUT) transmission stats', stats)
+        if self.transmission_stats_path:
+            with open(self.transmission_stats_path, 'w') as fo:
+                json.dump(stats, fo, indent=2)
+
+    def _load_input(self):
+        """
+        The input file consists of the number of samples, one "x y z" line per sample, the
+        number of sending events, and one "num_bytes waiting_time" line per event. The samples
+        are sent as packed float32 triples (the same as struct.pack('=fff', x, y, z)).
+
+        If input_cache_folder is set, the compiled input is cached there by the hash of the
+        input file, so running the same input again skips parsing.
+        """
+        with open(self.floating_file_path, 'rb') as f:
+            content = f.read()
+
+        cache_folder = self.input_cache_folder
+        cache_path = None
+        if cache_folder is not None:
+            cache_path = os.path.join(cache_folder, '.%s.%s.npz' % (
+                os.path.basename(self.floating_file_path), hashlib.sha256(content).hexdigest()))
+
+        if cache_path is None:
+            samples, sending_events = self._parse_input(content)
+        elif os.path.isfile(cache_path):
+            with numpy.load(cache_path) as cache:
+                samples = cache['samples']
+                sending_events = cache['sending_events']
+            print('(DUT) Load compiled input from %s' % cache_path)
         else:
-            firmware_short_desp += ' '
-        
-        print("Removing old codes from DUT (name=%s)" % self.name)
-        subprocess.call(['rm', '-rf', '%s/*' % self.mount_path])
-        time.sleep(3)
-        
-        print("programming %sfirmware on DUT (name=%s)" % (firmware_short_desp, self.name))
-        shutil.copy(firmware_path, self.mount_path)
-        time.sleep(3)
-        
-        print("Unmounting.. (DUT name=%s) %s" % (self.name, self.dev_path))
-        subprocess.call(['umount', self.dev_path])
-        time.sleep(3)
-        
-        print("Mounting back (DUT name=%s) %s %s" % (self.name, self.dev_path, self.mount_path))
-        subprocess.call(['mount', self.dev_path, self.mount_path])
-        time.sleep(3)
+            samples, sending_events = self._parse_input(content)
+            if not os.path.isdir(cache_folder):
+                os.makedirs(cache_folder)
+            tmp_cache_path = cache_path + '.tmp'
+            with open(tmp_cache_path, 'wb') as fo:
+                numpy.savez(fo, samples=samples, sending_events=sending_events)
+            os.rename(tmp_cache_path, cache_path)
+
+        self.num_samples = len(samples)
+        self.input_samples = samples
+        self.input_bytes = memoryview(samples).cast('B')
+        self.sending_events = [(int(num_bytes), float(waiting_time))
+                for num_bytes, waiting_time in sending_events]
+
+    def _parse_input(self, content):
+        """
+        Return:
+          (samples, sending_events)
+            - samples: a contiguous float32 array of shape (num_samples, 3)
+            - sending_events: a float64 array of shape (num_sending_events, 2)
+        """
+        lines = content.split(b'\n')
+        num_samples = int(lines[0].strip())
+
+        # parse the whole sample block at once. Values are parsed in double precision first and
+        # then rounded to float32, which is what struct.pack('f') does.
+        sample_block = b' '.join(lines[1:1+num_samples]).decode('ascii')
+        samples = numpy.fromstring(sample_block, dtype=numpy.float64, sep=' ')
+        if len(samples) != num_samples * 3:
+            raise Exception('Expect %d floating numbers in the input file, got %d' % (
+                num_samples * 3, len(samples)))
+        samples = numpy.ascontiguousarray(samples.astype(numpy.float32).reshape((num_samples, 3)))
+
+        line_idx = 1 + num_samples
+        num_sending_events = int(lines[line_idx].strip())
+        sending_events = numpy.zeros((num_sending_events, 2), dtype=numpy.float64)
+        for i in range(num_sending_events):
+            terms = lines[line_idx + 1 + i].strip().split(b' ')
+            sending_events[i] = (int(terms[0]), float(terms[1]))
+
+        return (samples, sending_events)
 
     def _device_folder_snapshot(self):
         process = subprocess.Popen(['ls', '/dev/'], stdout=subprocess.PIPE)
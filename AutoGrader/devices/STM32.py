@@ -5,8 +5,13 @@ import threading
 import struct
 import time
 import traceback
+import hashlib
+import numpy
 
 from AutoGrader.devices import HardwareBase
+from AutoGrader.devices.TerminationCondition import create_termination_conditions
+from AutoGrader.devices.STM32PacketDecoder import STM32PacketDecoder
+from AutoGrader.devices.fileio.stm32_waveform_file_writer import STM32WaveformFileWriter
 
 
 class STM32(HardwareBase):
@@ -19,11 +24,35 @@ class STM32(HardwareBase):
     STOP_DELIM = b'E'
     TOTAL_PKT_LEN = 9
 
+    # the wire format of a packet, the same as struct.pack('=ccIHc', ...) on a little-endian host
+    PACKET_DTYPE = numpy.dtype([
+        ('start', 'u1'),
+        ('type', 'u1'),
+        ('time', '<u4'),
+        ('val', '<u2'),
+        ('stop', 'u1'),
+    ])
+
+    # the input waveform is streamed to the UART in writes of this size
+    INPUT_WRITE_SIZE = 4096
+
+    MAX_READ_SIZE = 4096
+    DEVICE_POLL_INTERVAL_SEC = 0.01
+
+    # after a reset, the input is drained until nothing arrives for this long
+    DRAIN_QUIET_SEC = 0.05
+    DRAIN_MAX_SEC = 1.
+
     # parameters
     baud_rate = 460800
     usb_path = None
     input_waveform_path = None
+    input_cache_folder = None
     output_waveform_path = None
+    output_binary_waveform_path = None
+    output_mapped_waveform_path = None
+    persistent_session = False
+    reset_ack_timeout_sec = 1.
 
     # device info
     name = None
@@ -34,18 +63,28 @@ class STM32(HardwareBase):
 
     # serial
     dev = None
+    packet_decoder = None
 
     # files
-    fin = None
+    input_packets = None
     output_metadata = None
+    output_writers = []
 
-    # thread status
+    # thread status. The reading thread lives as long as the session, which lasts for a task,
+    # or for the lifetime of the hardware engine if the session is persistent. alive indicates
+    # whether a task is being captured.
     uart_reading_thread = None
-    alive = True
+    session_alive = False
+    alive = False
+    capture_lock = None
 
     # execution
     execution_start_time = None
 
+    # early termination, in addition to the terminate packet
+    termination_condition_configs = None
+    termination_conditions = None
+
     def __init__(self, name, config, hardware_engine, file_folder):
        
         if 'baud' in config:
@@ -59,153 +98,356 @@ class STM32(HardwareBase):
             raise Exception('"input_waveform_file" field is required')
         self.input_waveform_path = os.path.join(file_folder, config['input_waveform_file'])
 
+        # the compiled input is only cached if a folder is specified. The folder has to be
+        # outside of file_folder, which is moved to the backup folder after every task
+        if 'input_cache_folder' in config:
+            self.input_cache_folder = config['input_cache_folder']
+
         if 'output_waveform_file' in config and config['output_waveform_file']:
             self.output_waveform_path = os.path.join(file_folder, config['output_waveform_file'])
         else:
             self.output_waveform_path = '/dev/null'
 
+        # the output waveform can additionally be written in the binary format
+        if 'output_binary_waveform_file' in config and config['output_binary_waveform_file']:
+            self.output_binary_waveform_path = os.path.join(
+                    file_folder, config['output_binary_waveform_file'])
+
+        # the columns layout of the binary format, which can be memory-mapped by the readers. It
+        # is converted from one of the other output files after the capture
+        if 'output_mapped_waveform_file' in config and config['output_mapped_waveform_file']:
+            if self.output_waveform_path == '/dev/null' and not self.output_binary_waveform_path:
+                raise Exception('"output_mapped_waveform_file" requires "output_waveform_file" '
+                        'or "output_binary_waveform_file"')
+            self.output_mapped_waveform_path = os.path.join(
+                    file_folder, config['output_mapped_waveform_file'])
+
         if 'output_metadata' not in config:
             raise Exception('"output_metadata" field is required')
         self.output_metadata = config['output_metadata']
 
+        if 'termination_conditions' in config:
+            self.termination_condition_configs = config['termination_conditions']
+            create_termination_conditions(self.termination_condition_configs)  # validate
+
+        # keep the UART and the reading thread open across tasks
+        if 'persistent_session' in config:
+            self.persistent_session = config['persistent_session']
+
+        if 'reset_ack_timeout_sec' in config:
+            self.reset_ack_timeout_sec = config['reset_ack_timeout_sec']
+
         self.name = name
         self.config = config
         self.hardware_engine = hardware_engine
+        self.capture_lock = threading.Lock()
 
     def on_before_execution(self):
-
-        # open serial port
-        tmp_dev = serial.Serial()
-        tmp_dev.port = self.usb_path
-        tmp_dev.baudrate = self.baud_rate
-        tmp_dev.parity = serial.PARITY_NONE
-        tmp_dev.bytesize = serial.EIGHTBITS
-        tmp_dev.stopbits = serial.STOPBITS_ONE
-        tmp_dev.timeout = 0.01
-        tmp_dev.writeTimeout = None
-
-        # open input waveform file but get rid of the metadata part
-        self.fin = open(self.input_waveform_path, 'r')
-        while True:
-            line = self.fin.readline()
-            if not line or line.strip() == '==':
-                break
-
-        # open output waveform file and write the meatadata part
-        self.output_lines = []
-        self.output_lines.append('')  # period
-        self.output_lines.append('Tick frequency: %f' % self.output_metadata['tick_frequency'])
-        self.output_lines.append('Display start')
-        for pin_config in self.output_metadata['pins']:
-            self.output_lines.append('%s,%s' % (
-                pin_config['label'],
-                ','.join(list(map(str, pin_config['indexes']))),
-            ))
-        self.output_lines.append('Display end')
-        self.output_lines.append('==')
-
-        self.alive = True
+        self.packet_decoder = None
+
+        # compile the input waveform into packets before the execution starts
+        self.input_packets = self._load_input_packets()
+
+        # open output waveform files and write the meatadata part. Events are appended as they
+        # are decoded
+        output_paths = [(self.output_waveform_path, False)]
+        if self.output_binary_waveform_path:
+            output_paths.append((self.output_binary_waveform_path, True))
+        self.output_writers = []
+        for path, binary in output_paths:
+            writer = STM32WaveformFileWriter(path)
+            writer.set_tick_frequency(self.output_metadata['tick_frequency'])
+            for pin_config in self.output_metadata['pins']:
+                writer.add_display_param(pin_config['label'], pin_config['indexes'])
+            writer.open_stream(binary=binary)
+            self.output_writers.append(writer)
+
+        self.termination_conditions = create_termination_conditions(
+                self.termination_condition_configs)
+        self.packet_decoder = STM32PacketDecoder(
+                self.PACKET_DTYPE, self.START_DELIM, self.STOP_DELIM)
         
         try:
-            tmp_dev.open() 
-            self.dev = tmp_dev
-            print('(STM32) UART is open')
-            self.send_command(self.CMD_RESET_TESTER)
-            print('(STM32) reset')
-            time.sleep(1)
-            self.uart_reading_thread = threading.Thread(
-                    target=self._reading_thread, name=('STM32-%s-reading' % self.name)).start()
+            # a persistent session is reused unless the port failed in the last task
+            if not (self.persistent_session and self.session_alive):
+                self._close_session()
+                self._open_session()
+            self._reset_tester()
+            self.termination_conditions.reset(time.time())
+            self.alive = True
         except:
-            exc_info = sys.exc_info()
-            print('(STM32) UART device unable to open, full stack trace below')
-            traceback.print_exception(*exc_info)
+            # the hardware engine prints the stack trace and aborts the task
+            print('(STM32) UART device unable to open')
             self.alive = False
+            self._close_session()
+            raise
 
     def on_execute(self):
-        self.execution_start_time = time.time()
+        self.execution_start_time = self.hardware_engine.task_clock.record_device_start(self.name)
 
-        # feed input waveform file into STM32
-        for line in self.fin:
+        # feed the compiled input waveform into STM32
+        if not self.dev:
+            print('(STM32) UART device does not exist, not able to send the command')
+            return
+        for sidx in range(0, len(self.input_packets), self.INPUT_WRITE_SIZE):
             if not self.alive:
                 break
-            terms = line.split(',')
-            pkt_type, pkt_time, pkt_val = chr(int(terms[0])), int(terms[1]), int(terms[2])
-            binary = struct.pack('=ccIHc', self.START_DELIM, pkt_type.encode('ascii'), pkt_time,
-                    pkt_val, self.STOP_DELIM)
-            if not self.dev:
-                print('(STM32) UART device does not exist, not able to send the command')
-                return
-            self.dev.write(binary)
-            print('(STM32) packet sent', pkt_type, pkt_time, pkt_val)
-
-        self.fin.close()
+            self.dev.write(self.input_packets[sidx:sidx+self.INPUT_WRITE_SIZE])
+        print('(STM32) %d packets sent' % (len(self.input_packets) // self.TOTAL_PKT_LEN))
 
     def on_terminate(self):
         self.alive = False
         
-        execution_stop_time = time.time()
+        execution_stop_time = self.hardware_engine.task_clock.get_time_sec()
         execution_elasped_time = execution_stop_time - self.execution_start_time
-        self.output_lines[0] = "Period: %f" % execution_elasped_time
 
-        with open(self.output_waveform_path, 'w') as fo:
-            fo.write('\n'.join(self.output_lines))
+        # make sure no more events are appended after the files are closed. The mapped file is
+        # converted from the last output file, which is the binary one if there is
+        with self.capture_lock:
+            for writer in self.output_writers:
+                writer.set_period_sec(execution_elasped_time)
+                if writer is self.output_writers[-1]:
+                    writer.close_stream(mapped_file_path=self.output_mapped_waveform_path)
+                else:
+                    writer.close_stream()
+            self.output_writers = []
     
     def on_reset_after_execution(self):
+        # the output files are still open if the task is aborted before the execution
+        with self.capture_lock:
+            self.alive = False
+            for writer in self.output_writers:
+                writer.set_period_sec(0.)
+                writer.close_stream()
+            self.output_writers = []
+
+        if self.packet_decoder:
+            print('(STM32) packet decoder stats', self.packet_decoder.get_stats())
         
-        try:
-            self.dev.flush()
-            self.dev.close()
-            print('(STM32) UART is closed')
-        except:
-            print('(STM32) UART device unable to close')
-        self.dev = None
+        if not self.persistent_session:
+            self._close_session()
 
     def __del__(self):
         if self.dev and self.dev.is_open:
             self.dev.close()
 
-    def _reading_thread(self):
-        rx_buffer = b''
-
-        while self.alive:
-            # continue immediately if serial isn't ready
-            if not self.dev:
+    def _load_input_packets(self):
+        """
+        If input_cache_folder is set, the compiled packets are cached there by the hash of the
+        input waveform file, so running the same input again skips parsing.
+
+        Return:
+          A memoryview of the packed packets
+        """
+        with open(self.input_waveform_path, 'rb') as f:
+            content = f.read()
+
+        cache_folder = self.input_cache_folder
+        cache_path = None
+        if cache_folder is not None:
+            cache_path = os.path.join(cache_folder, '.%s.%s.bin' % (
+                os.path.basename(self.input_waveform_path), hashlib.sha256(content).hexdigest()))
+
+        if cache_path is None:
+            binary = self._compile_input_waveform(content)
+        elif os.path.isfile(cache_path):
+            with open(cache_path, 'rb') as f:
+                binary = f.read()
+            print('(STM32) Load compiled input from %s' % cache_path)
+        else:
+            binary = self._compile_input_waveform(content)
+            if not os.path.isdir(cache_folder):
+                os.makedirs(cache_folder)
+            tmp_cache_path = cache_path + '.tmp'
+            with open(tmp_cache_path, 'wb') as fo:
+                fo.write(binary)
+            os.rename(tmp_cache_path, cache_path)
+
+        return memoryview(binary)
+
+    def _compile_input_waveform(self, content):
+        """
+        Convert the waveform section (after the "==" line) of an input waveform file, whose lines
+        are "type, time, value", into the packet wire format.
+        """
+        lines = content.split(b'\n')
+        line_idx = 0
+        while line_idx < len(lines) and lines[line_idx].strip() != b'==':
+            line_idx += 1
+
+        data_block = b' '.join(lines[line_idx+1:]).replace(b',', b' ').decode('ascii')
+        values = numpy.fromstring(data_block, dtype=numpy.int64, sep=' ')
+        if len(values) % 3 != 0:
+            raise Exception('Input waveform has an incomplete event')
+        values = values.reshape((-1, 3))
+
+        if len(values) > 0:
+            if values[:, 0].min() < 0 or values[:, 0].max() > 0x7f:
+                raise Exception('Input waveform has a non-ascii event type')
+            if values[:, 1].min() < 0 or values[:, 1].max() > 0xffffffff:
+                raise Exception('Input waveform has an event time out of range')
+            if values[:, 2].min() < 0 or values[:, 2].max() > 0xffff:
+                raise Exception('Input waveform has an event value out of range')
+
+        packets = numpy.empty(len(values), dtype=self.PACKET_DTYPE)
+        packets['start'] = ord(self.START_DELIM)
+        packets['type'] = values[:, 0]
+        packets['time'] = values[:, 1]
+        packets['val'] = values[:, 2]
+        packets['stop'] = ord(self.STOP_DELIM)
+        return packets.tobytes()
+
+    def _reading_thread(self, dev):
+        """
+        Lives as long as the session. Received bytes are only captured while a task is running,
+        i.e., self.alive is True.
+        """
+        while self.session_alive:
+            if not self.alive:
+                time.sleep(self.DEVICE_POLL_INTERVAL_SEC)
                 continue
 
-            # Because we set a read timeout, chances are we only get a 
-            # partial of a packet
-            rx_buffer += self.dev.read(self.TOTAL_PKT_LEN)
-            
-            # Thus, if it's not a complete packet yet, read more
-            if len(rx_buffer) < self.TOTAL_PKT_LEN:
-                continue
+            with self.capture_lock:
+                if not self.alive:
+                    continue
+
+                # Because we set a read timeout, chances are we only get a partial of a packet.
+                # The decoder keeps the partial packet until the rest arrives.
+                try:
+                    chunk = dev.read(max(1, min(dev.in_waiting, self.MAX_READ_SIZE)))
+                except:
+                    exc_info = sys.exc_info()
+                    print('(STM32) UART device unable to read, full stack trace below')
+                    traceback.print_exception(*exc_info)
+                    self.session_alive = False
+                    self._terminate_by_condition()
+                    return
+
+                now = time.time()
+                if not chunk:
+                    if self.termination_conditions.on_idle(now):
+                        self._terminate_by_condition()
+                    continue
+
+                # the chunk which completes a condition is part of the output, thus it is
+                # decoded and written before the conditions are checked
+                packets = self.packet_decoder.feed(chunk)
+                if len(packets) > 0:
+                    self._handle_packets(packets)
+                if self.alive and self.termination_conditions.on_bytes(chunk, now):
+                    self._terminate_by_condition()
+    
+    def _handle_packets(self, packets):
+        """
+        Params:
+          packets: a numpy array of PACKET_DTYPE
+        """
+        # stop at the terminate packet
+        terminate_idxs = numpy.flatnonzero(packets['type'] == ord(self.CMD_TERMINATE))
+        if len(terminate_idxs) > 0:
+            event_packets = packets[:terminate_idxs[0]]
+        else:
+            event_packets = packets
 
-            # check the packet is valid via start and stop byte
-            # (The reason that we have to use bytes[0:1] is that var[0] returns an int)
-            if rx_buffer[0:1] == self.START_DELIM and rx_buffer[8:9] == self.STOP_DELIM:
-                self._handle_packet_payload(rx_buffer[1:8])
-            else:
-                print('(STM32) bad packet!', rx_buffer[0:9])
+        # packet types have to be ascii characters
+        non_ascii = event_packets['type'] > 0x7f
+        if non_ascii.any():
+            print('(STM32) Cannot handle %d non-ascii packets' % int(non_ascii.sum()))
+            event_packets = event_packets[~non_ascii]
 
-            rx_buffer = rx_buffer[9:]
-    
-    def _handle_packet_payload(self, binary):
-        # 1B type, 4B time, 2B val
-        [pkt_type, pkt_time, pkt_val] = struct.unpack('<cLH', binary)
+        for writer in self.output_writers:
+            writer.append_events(event_packets['type'], event_packets['time'], event_packets['val'])
+
+        if len(terminate_idxs) > 0:
+            self.alive = False
+            self.hardware_engine.notify_terminate()
+        elif self.termination_conditions.on_packets(len(event_packets), time.time()):
+            self._terminate_by_condition()
+
+    def _terminate_by_condition(self):
+        print('(STM32) Termination condition met')
+        self.alive = False
+        self.hardware_engine.notify_terminate()
+
+    def _open_session(self):
+        tmp_dev = serial.Serial()
+        tmp_dev.port = self.usb_path
+        tmp_dev.baudrate = self.baud_rate
+        tmp_dev.parity = serial.PARITY_NONE
+        tmp_dev.bytesize = serial.EIGHTBITS
+        tmp_dev.stopbits = serial.STOPBITS_ONE
+        tmp_dev.timeout = 0.01
+        tmp_dev.writeTimeout = None
+        tmp_dev.open()
+        self.dev = tmp_dev
+        print('(STM32) UART is open')
+
+        self.session_alive = True
+        self.uart_reading_thread = threading.Thread(target=self._reading_thread,
+                args=(tmp_dev,), name=('STM32-%s-reading' % self.name), daemon=True)
+        self.uart_reading_thread.start()
+
+    def _close_session(self):
+        self.session_alive = False
+        if (self.uart_reading_thread
+                and self.uart_reading_thread is not threading.current_thread()):
+            self.uart_reading_thread.join()
+        self.uart_reading_thread = None
+
+        if self.dev is None:
+            return
         try:
-            pkt_type = pkt_type.decode('ascii')
+            self.dev.flush()
+            self.dev.close()
+            print('(STM32) UART is closed')
         except:
-            print('(STM32) Cannot handle the packet...')
-            exc_type, exc_value, exc_traceback = sys.exc_info()
-            traceback.print_exception(exc_type, exc_value, exc_traceback, file=sys.stdout)
-            return
-        
-        print('type: %s, time: %d, val: %d' % (pkt_type, pkt_time, pkt_val))
-        if pkt_type is not self.CMD_TERMINATE:
-            self.output_lines.append('%d, %d, %d' % (ord(pkt_type), pkt_time, pkt_val))
-        else:
-            self.hardware_engine.notify_terminate()
-            self.alive = False
+            print('(STM32) UART device unable to close')
+        self.dev = None
+
+    def _reset_tester(self):
+        """
+        Reset the tester and wait for its acknowledgement, which is a packet of CMD_RESET_TESTER
+        type. If the tester does not acknowledge within reset_ack_timeout_sec, proceed anyway
+        as if the reset is done. Afterwards, the bytes left from the last task are drained.
+        """
+        with self.capture_lock:
+            self.dev.reset_input_buffer()
+            self.send_command(self.CMD_RESET_TESTER)
+
+            decoder = STM32PacketDecoder(self.PACKET_DTYPE, self.START_DELIM, self.STOP_DELIM)
+            deadline = time.time() + self.reset_ack_timeout_sec
+            acked = False
+            while not acked and time.time() < deadline:
+                packets = decoder.feed(self.dev.read(max(1, self.dev.in_waiting)))
+                acked = bool((packets['type'] == ord(self.CMD_RESET_TESTER)).any())
+            if acked:
+                print('(STM32) reset')
+            else:
+                print('(STM32) reset, no acknowledgement in %f sec' % self.reset_ack_timeout_sec)
+
+            self._drain_input()
+
+    def _drain_input(self):
+        """
+        Discard the received bytes until the line has been quiet for DRAIN_QUIET_SEC, or for at
+        most DRAIN_MAX_SEC.
+        """
+        start_time = time.time()
+        last_receive_time = start_time
+        num_drained_bytes = 0
+        while True:
+            chunk = self.dev.read(max(1, self.dev.in_waiting))
+            now = time.time()
+            if chunk:
+                num_drained_bytes += len(chunk)
+                last_receive_time = now
+            elif now - last_receive_time >= self.DRAIN_QUIET_SEC:
+                break
+            if now - start_time >= self.DRAIN_MAX_SEC:
+                print('(STM32) Line is still busy after draining for %f sec' % self.DRAIN_MAX_SEC)
+                break
+        if num_drained_bytes > 0:
+            print('(STM32) Drained %d bytes' % num_drained_bytes)
     
     def send_command(self, cmd):
         payload = self.START_DELIM + cmd.encode() + b'\x00\x00\x00\x00\x00\x00' + self.STOP_DELIM
@@ -0,0 +1,123 @@
+import numpy
+
+
+class STM32PacketDecoder(object):
+    """
+    Decodes the byte stream sent by the STM32 tester into packets. Packets have a fixed length,
+    starting with a start delimiter and ending with a stop delimiter.
+
+    Received bytes are appended to a reusable buffer, and all the complete packets in the buffer
+    are decoded at once by viewing the buffer as an array of packets. When a frame does not have
+    valid delimiters, the decoder scans forward to the next position which has both, instead of
+    dropping a whole frame, so that a lost or extra byte only costs the packet it hits.
+    """
+
+    INITIAL_BUFFER_SIZE = 65536
+
+    def __init__(self, packet_dtype, start_delim, stop_delim):
+        """
+        Params:
+          packet_dtype: a numpy structured dtype describing the wire format, whose first and
+              last fields are the delimiters
+          start_delim: the start delimiter, a bytes of length 1
+          stop_delim: the stop delimiter, a bytes of length 1
+        """
+        self.packet_dtype = packet_dtype
+        self.packet_len = packet_dtype.itemsize
+        self.start_byte = ord(start_delim)
+        self.stop_byte = ord(stop_delim)
+
+        self.buffer = bytearray(STM32PacketDecoder.INITIAL_BUFFER_SIZE)
+        self.num_buffered_bytes = 0
+
+        # statistics
+        self.num_decoded_packets = 0
+        self.num_dropped_bytes = 0
+        self.num_resyncs = 0
+
+    def feed(self, data):
+        """
+        Params:
+          data: newly received bytes
+        Return:
+          A numpy array of packet_dtype, containing all the packets completed by data
+        """
+        self._append(data)
+
+        byte_view = numpy.frombuffer(self.buffer, dtype=numpy.uint8,
+                count=self.num_buffered_bytes)
+        decoded_segments = []
+        pos = 0
+        while self.num_buffered_bytes - pos >= self.packet_len:
+            num_frames = (self.num_buffered_bytes - pos) // self.packet_len
+            frames = byte_view[pos:pos + num_frames * self.packet_len].reshape(
+                    (num_frames, self.packet_len))
+            valid = (frames[:, 0] == self.start_byte) & (frames[:, -1] == self.stop_byte)
+
+            # take the leading valid frames
+            num_valid_frames = num_frames if valid.all() else int(numpy.argmin(valid))
+            if num_valid_frames > 0:
+                decoded_segments.append(numpy.frombuffer(self.buffer, dtype=self.packet_dtype,
+                        count=num_valid_frames, offset=pos).copy())
+                pos += num_valid_frames * self.packet_len
+            if num_valid_frames == num_frames:
+                break
+
+            # resync to the next position having both delimiters
+            self.num_resyncs += 1
+            search_end = self.num_buffered_bytes - self.packet_len + 1
+            candidates = numpy.flatnonzero(
+                    (byte_view[pos+1:search_end] == self.start_byte)
+                    & (byte_view[pos+self.packet_len:] == self.stop_byte))
+            if len(candidates) > 0:
+                next_pos = pos + 1 + int(candidates[0])
+            else:
+                # no complete frame is left. Keep the tail from the first start delimiter which
+                # may still begin a packet
+                tail_pos = max(pos + 1, search_end)
+                starts = numpy.flatnonzero(byte_view[tail_pos:] == self.start_byte)
+                if len(starts) > 0:
+                    next_pos = tail_pos + int(starts[0])
+                else:
+                    next_pos = self.num_buffered_bytes
+            self.num_dropped_bytes += next_pos - pos
+            pos = next_pos
+
+        self._consume(pos)
+
+        if len(decoded_segments) == 0:
+            return numpy.empty(0, dtype=self.packet_dtype)
+        packets = (decoded_segments[0] if len(decoded_segments) == 1
+                else numpy.concatenate(decoded_segments))
+        self.num_decoded_packets += len(packets)
+        return packets
+
+    def reset(self):
+        self.num_buffered_bytes = 0
+        self.num_decoded_packets = 0
+        self.num_dropped_bytes = 0
+        self.num_resyncs = 0
+
+    def get_stats(self):
+        return {
+            'decoded_packets': self.num_decoded_packets,
+            'dropped_bytes': self.num_dropped_bytes,
+            'resyncs': self.num_resyncs,
+        }
+
+    def _append(self, data):
+        required_size = self.num_buffered_bytes + len(data)
+        if required_size > len(self.buffer):
+            # allocate a new buffer instead of resizing, the old one may still be viewed
+            new_buffer = bytearray(max(required_size, len(self.buffer) * 2))
+            new_buffer[:self.num_buffered_bytes] = self.buffer[:self.num_buffered_bytes]
+            self.buffer = new_buffer
+        self.buffer[self.num_buffered_bytes:required_size] = data
+        self.num_buffered_bytes = required_size
+
+    def _consume(self, num_bytes):
+        # move the incomplete tail to the front of the buffer
+        remaining = self.num_buffered_bytes - num_bytes
+        if remaining > 0 and num_bytes > 0:
+            self.buffer[:remaining] = self.buffer[num_bytes:self.num_buffered_bytes]
+        self.num_buffered_bytes = remaining
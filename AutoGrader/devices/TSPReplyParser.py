@@ -0,0 +1,55 @@
+class TSPReplyParser(object):
+    """
+    Splits the byte stream returned by a TSP instrument into replies. Every reply is a line of
+    tab-separated numbers, terminated by "\n" (optionally preceded by "\r"). A recv() may return
+    a partial reply or several replies, so the incomplete tail is kept until the rest arrives.
+    """
+
+    def __init__(self, num_fields):
+        """
+        Params:
+          num_fields: the number of values expected in a reply
+        """
+        self.num_fields = num_fields
+        self.buffer = b''
+
+        # statistics
+        self.num_replies = 0
+        self.num_malformed_lines = 0
+
+    def feed(self, data):
+        """
+        Params:
+          data: newly received bytes
+        Return:
+          (replies, num_lines)
+            - replies: a list of replies completed by data, each is a tuple of floats
+            - num_lines: the number of lines completed by data, including the malformed ones,
+                  i.e., how many requests are answered
+        """
+        lines = (self.buffer + data).split(b'\n')
+        self.buffer = lines.pop()
+
+        replies = []
+        for line in lines:
+            terms = line.strip().split(b'\t')
+            if len(terms) != self.num_fields:
+                self.num_malformed_lines += 1
+                continue
+            try:
+                replies.append(tuple(map(float, terms)))
+            except ValueError:
+                self.num_malformed_lines += 1
+        self.num_replies += len(replies)
+        return (replies, len(lines))
+
+    def reset(self):
+        self.buffer = b''
+        self.num_replies = 0
+        self.num_malformed_lines = 0
+
+    def get_stats(self):
+        return {
+            'replies': self.num_replies,
+            'malformed_lines': self.num_malformed_lines,
+        }
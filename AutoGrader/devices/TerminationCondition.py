@@ -0,0 +1,219 @@
+import re
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+
+"""
+Termination conditions let a device end a task as soon as the output of the DUT is complete,
+instead of waiting for the execution time limit. They are configured per device in the testbed
+configuration file as a list under the "termination_conditions" field of init_params, e.g.,
+
+  "termination_conditions": [
+      {"type": "byte_count", "num_bytes": 4096},
+      {"type": "sentinel", "sentinel": "DONE\n"},
+      {"type": "regex", "pattern": "score: \\d+", "window_size": 256},
+      {"type": "idle_timeout", "timeout_sec": 5},
+      {"type": "packet_count", "num_packets": 1000}
+  ]
+
+The task terminates once any of the conditions holds. Conditions are evaluated incrementally on
+the capture path: every call only looks at the newly arrived data (plus a bounded window), so
+the cost is proportional to the chunk size.
+"""
+
+
+class TerminationCondition(object):
+    def reset(self, timestamp):
+        """
+        Called when the capture of a task starts.
+        """
+        pass
+
+    def on_bytes(self, chunk, timestamp):
+        """
+        Return:
+          True if the condition holds after receiving chunk
+        """
+        return False
+
+    def on_packets(self, num_packets, timestamp):
+        """
+        Return:
+          True if the condition holds after receiving num_packets more packets
+        """
+        return False
+
+    def on_idle(self, timestamp):
+        """
+        Called when a read returns nothing.
+
+        Return:
+          True if the condition holds
+        """
+        return False
+
+
+class ByteCountCondition(TerminationCondition):
+    def __init__(self, num_bytes):
+        self.num_bytes = num_bytes
+        self.num_received_bytes = 0
+
+    def reset(self, timestamp):
+        self.num_received_bytes = 0
+
+    def on_bytes(self, chunk, timestamp):
+        self.num_received_bytes += len(chunk)
+        return self.num_received_bytes >= self.num_bytes
+
+
+class SentinelCondition(TerminationCondition):
+    def __init__(self, sentinel):
+        if type(sentinel) is str:
+            sentinel = sentinel.encode()
+        if len(sentinel) == 0:
+            raise Exception('Sentinel cannot be empty')
+        self.sentinel = sentinel
+        self.tail = b''
+
+    def reset(self, timestamp):
+        self.tail = b''
+
+    def on_bytes(self, chunk, timestamp):
+        # keep the last len(sentinel)-1 bytes in case the sentinel spans two chunks
+        data = self.tail + chunk
+        if self.sentinel in data:
+            return True
+        self.tail = data[-(len(self.sentinel) - 1):] if len(self.sentinel) > 1 else b''
+        return False
+
+
+class RegexCondition(TerminationCondition):
+    """
+    Holds once the pattern matches. A match which spans several chunks is found as long as it is
+    not longer than window_size bytes.
+
+    A match which ends in a new chunk starts at most the maximum match length of the pattern
+    before its end, so only that many bytes of the previous chunks are searched again, and every
+    chunk costs a bounded overlap instead of the whole window. If the pattern has no maximum
+    match length (e.g., "\\d+"), the overlap is window_size bytes.
+    """
+
+    DEFAULT_WINDOW_SIZE = 4096
+
+    # bytes kept before the overlap, which "\b" and lookbehinds may look at
+    CONTEXT_SIZE = 16
+
+    def __init__(self, pattern, window_size=None):
+        if type(pattern) is str:
+            pattern = pattern.encode()
+        self.regex = re.compile(pattern)
+        self.window_size = window_size or RegexCondition.DEFAULT_WINDOW_SIZE
+        self.overlap_size = max(
+                min(self._get_max_match_length(pattern), self.window_size) - 1, 0)
+        self.tail = b''
+
+    def reset(self, timestamp):
+        self.tail = b''
+
+    def on_bytes(self, chunk, timestamp):
+        data = self.tail + chunk
+        # the matches which start earlier are searched for with the previous chunks
+        start = max(len(self.tail) - self.overlap_size, 0)
+        if self.regex.search(data, start) is not None:
+            return True
+        self.tail = data[-(self.overlap_size + RegexCondition.CONTEXT_SIZE):]
+        return False
+
+    def _get_max_match_length(self, pattern):
+        try:
+            return sre_parse.parse(pattern).getwidth()[1]
+        except Exception:
+            return self.window_size
+
+
+class IdleTimeoutCondition(TerminationCondition):
+    def __init__(self, timeout_sec):
+        self.timeout_sec = timeout_sec
+        self.last_activity_time = None
+
+    def reset(self, timestamp):
+        self.last_activity_time = timestamp
+
+    def on_bytes(self, chunk, timestamp):
+        self.last_activity_time = timestamp
+        return False
+
+    def on_packets(self, num_packets, timestamp):
+        self.last_activity_time = timestamp
+        return False
+
+    def on_idle(self, timestamp):
+        if self.last_activity_time is None:
+            self.last_activity_time = timestamp
+        return timestamp - self.last_activity_time >= self.timeout_sec
+
+
+class PacketCountCondition(TerminationCondition):
+    def __init__(self, num_packets):
+        self.num_packets = num_packets
+        self.num_received_packets = 0
+
+    def reset(self, timestamp):
+        self.num_received_packets = 0
+
+    def on_packets(self, num_packets, timestamp):
+        self.num_received_packets += num_packets
+        return self.num_received_packets >= self.num_packets
+
+
+class TerminationConditionSet(TerminationCondition):
+    """
+    Holds if any of its conditions holds. Every condition is updated on each call so that their
+    states stay consistent.
+    """
+
+    def __init__(self, conditions):
+        self.conditions = conditions
+
+    def reset(self, timestamp):
+        for c in self.conditions:
+            c.reset(timestamp)
+
+    def on_bytes(self, chunk, timestamp):
+        return any([c.on_bytes(chunk, timestamp) for c in self.conditions])
+
+    def on_packets(self, num_packets, timestamp):
+        return any([c.on_packets(num_packets, timestamp) for c in self.conditions])
+
+    def on_idle(self, timestamp):
+        return any([c.on_idle(timestamp) for c in self.conditions])
+
+
+def create_termination_conditions(condition_configs):
+    """
+    Params:
+      condition_configs: a list of dictionaries, each has a "type" field and the parameters of
+          the condition. See the top of this file for the format. None means no condition.
+    Return:
+      A TerminationConditionSet
+    """
+    conditions = []
+    for c in condition_configs or []:
+        if 'type' not in c:
+            raise Exception('"type" field is required in termination conditions')
+        if c['type'] == 'byte_count':
+            conditions.append(ByteCountCondition(c['num_bytes']))
+        elif c['type'] == 'sentinel':
+            conditions.append(SentinelCondition(c['sentinel']))
+        elif c['type'] == 'regex':
+            conditions.append(RegexCondition(c['pattern'], c.get('window_size')))
+        elif c['type'] == 'idle_timeout':
+            conditions.append(IdleTimeoutCondition(c['timeout_sec']))
+        elif c['type'] == 'packet_count':
+            conditions.append(PacketCountCondition(c['num_packets']))
+        else:
+            raise Exception('Unrecognized termination condition type "%s"' % c['type'])
+    return TerminationConditionSet(conditions)
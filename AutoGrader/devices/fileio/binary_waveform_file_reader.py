@@ -0,0 +1,161 @@
+import numpy
+
+from serapis.utils.visualizers.fileio import binary_waveform_format
+from serapis.utils.visualizers.fileio.waveform_query_base import WaveformColumns
+from serapis.utils.visualizers.fileio.waveform_file_reader_base import WaveformFileReaderBase
+
+"""
+The reader of the binary waveform files described in binary_waveform_format.py. Unlike the text
+readers, it takes the file path instead of the file content.
+
+For the files in the columns layout, the time and value columns are memory-mapped and used as
+the waveform directly. Nothing is loaded when the reader is created, and a query only touches
+the pages it needs, e.g., finding a time window is a binary search over the time column. The
+queries which go through the whole waveform, such as the edge queries, still read all of it.
+
+The files in the records layout are captured events, which can be in any order. They are read
+and cleaned the same way as the text files. If the records have a "code" field, i.e., the
+binary files written by STM32WaveformFileWriter, only the waveform events (code 68) are kept.
+
+Timestamps are in seconds.
+"""
+
+class BinaryWaveformFileReader(WaveformFileReaderBase):
+    ERROR_CODE_EMPTY_FILE = 1
+    ERROR_CODE_FORMAT = 3
+
+    # the event code of the waveform events in STM32 records
+    STM32_WAVEFORM_EVENT_CODE = 68
+
+    def __init__(self, file_path):
+        self._initialize_instance_variables()
+        self._parse_file(file_path)
+
+    def _initialize_instance_variables(self):
+        self.period_sec = None
+        self.tick_frequency = None
+        self.layout = None
+
+        # display_params is an array, each element is a dictionary with `name` (a string) and
+        # `pins` (a list of integers)
+        self.display_params = None
+
+        # data is a WaveformColumns, i.e., the start timestamps in seconds and the bus values.
+        # In the columns layout, its arrays are memory-mapped
+        self.data = None
+
+        # a DecimationPyramid per plot, if built or loaded
+        self.decimation_pyramids = None
+
+        self.error_code = None
+
+    def _parse_file(self, file_path):
+        try:
+            with open(file_path, 'rb') as f:
+                if f.read(1) == b'':
+                    self.error_code = BinaryWaveformFileReader.ERROR_CODE_EMPTY_FILE
+                    return
+                f.seek(0)
+                header = binary_waveform_format.unpack_header(f)
+
+            self.period_sec = header['period_sec']
+            self.tick_frequency = header['tick_frequency']
+            self.layout = header['layout']
+            self.display_params = header['display_params']
+
+            if self.layout == binary_waveform_format.LAYOUT_COLUMNS:
+                self.data = self._map_columns(file_path, header)
+            elif self.layout == binary_waveform_format.LAYOUT_RECORDS:
+                self.data = self._load_records(file_path, header)
+            else:
+                raise Exception('Unknown layout')
+        except:
+            self.error_code = BinaryWaveformFileReader.ERROR_CODE_FORMAT
+            return
+
+        self.error_code = None
+
+    def _map_columns(self, file_path, header):
+        if header['event_dtype'] != binary_waveform_format.COLUMNS_DTYPE:
+            raise Exception('Unexpected columns')
+        if header['num_events'] < 2:
+            raise Exception('A cleaned waveform has at least 2 events')
+
+        offsets = binary_waveform_format.get_column_offsets(header)
+        columns = {}
+        for name in header['event_dtype'].names:
+            columns[name] = numpy.memmap(file_path, dtype=header['event_dtype'][name], mode='r',
+                    offset=offsets[name], shape=(header['num_events'],))
+        return WaveformColumns(columns['time'], columns['value'])
+
+    def _load_records(self, file_path, header):
+        records = numpy.fromfile(file_path, dtype=header['event_dtype'],
+                count=header['num_events'], offset=header['data_offset'])
+        if len(records) != header['num_events']:
+            raise Exception('The file is truncated')
+
+        if 'code' in records.dtype.names:
+            records = records[
+                    records['code'] == BinaryWaveformFileReader.STM32_WAVEFORM_EVENT_CODE]
+        times = records['time'].astype(numpy.float64)
+        if self.tick_frequency > 0.:
+            times *= 1. / self.tick_frequency
+
+        return self._clean_waveform_columns(
+                WaveformColumns(times, records['value']), self.period_sec)
+
+    def is_successfully_parsed(self):
+        return self.error_code is None
+
+    def get_error_code(self):
+        return self.error_code
+
+    def get_error_description(self):
+        if self.error_code is None:
+            raise Exception("No error during parsing")
+
+        if self.error_code == BinaryWaveformFileReader.ERROR_CODE_EMPTY_FILE:
+            return "Empty file"
+        elif self.error_code == BinaryWaveformFileReader.ERROR_CODE_FORMAT:
+            return "Parsing error: file format is not correct"
+        else:
+            raise Exception("Unknown error code")
+
+    def get_period_sec(self):
+        if self.error_code is not None:
+            raise Exception("There is an error while parsing content")
+        return self.period_sec
+
+    def get_tick_frequency(self):
+        """
+        Returns:
+          The tick frequency of the original waveform, or 0 if the timestamps were in seconds
+        """
+        if self.error_code is not None:
+            raise Exception("There is an error while parsing content")
+        return self.tick_frequency
+
+    def get_num_display_plots(self):
+        if self.error_code is not None:
+            raise Exception("There is an error while parsing content")
+        return len(self.display_params)
+
+    def get_event_series(self, series_idx, start_time_sec=None, end_time_sec=None):
+        """
+        When start_time_sec and/or end_time_sec is None, it is configured as default value:
+        start_time_sec will be 0.0, end_time_sec will be the period length.
+
+        Returns:
+          (name, time_series)
+            - name: plot name, a string
+            - time_series: a list of (time_sec, bus_value). Align with both start_time_sec and
+                  end_time_sec. Will filter out duplicate transitions.
+        """
+
+        if self.error_code is not None:
+            raise Exception("There is an error while parsing content")
+
+        display_param = self.display_params[series_idx]
+        result_sec = self._get_event_series(
+                self.data, display_param['pins'], start_time_sec, end_time_sec)
+        return (display_param['name'], result_sec)
@@ -0,0 +1,134 @@
+import json
+import struct
+
+import numpy
+
+
+"""
+Waveform writers can produce a binary file besides the text one. The binary file starts with a
+fixed-size header (little-endian):
+
+  magic            8 bytes, "HARTWAV1"
+  period_sec       float64
+  tick_frequency   float64, 0 if the event time is already in seconds
+  num_events       uint64
+  metadata_len     uint32
+
+followed by metadata_len bytes of JSON metadata, zero padding up to a multiple of 8 bytes, and
+the fixed-width events. The metadata contains the display params as a list of
+{"name", "pins"}, the numpy dtype of an event as "event_dtype", and how the events are laid out
+as "layout". Since the header has a fixed size, a writer which streams events can patch the
+period and the number of events when it finishes.
+
+There are two layouts:
+  - "records": the events are stored one after another, as they are captured. The files
+    written before the layout was introduced have no "layout" in the metadata and are records.
+  - "columns": every field of the events is stored as a contiguous column, in the order of
+    event_dtype, and each column is padded to a multiple of 8 bytes. The events are the
+    waveform after cleaning (see clean_waveform_columns() in waveform_query_base.py), i.e.,
+    times in seconds sorted from 0 to period_sec, so that a reader can memory-map the columns
+    and query them without loading the file. tick_frequency is the one of the original
+    waveform, 0 if unknown.
+"""
+
+MAGIC = b'HARTWAV1'
+HEADER_FORMAT = '<8sddQI'
+
+LAYOUT_RECORDS = 'records'
+LAYOUT_COLUMNS = 'columns'
+
+# the events of the columns layout
+COLUMNS_DTYPE = numpy.dtype([
+    ('time', '<f8'),
+    ('value', '<u4'),
+])
+
+
+def pack_header(period_sec, tick_frequency, num_events, display_params, event_dtype,
+        layout=LAYOUT_RECORDS):
+    """
+    Params:
+      display_params: a list of {"name", "pins"}
+      event_dtype: a numpy dtype of an event record
+      layout: LAYOUT_RECORDS or LAYOUT_COLUMNS
+    Return:
+      The bytes before the first event record
+    """
+    metadata = json.dumps({
+        'display_params': display_params,
+        'event_dtype': event_dtype.descr,
+        'layout': layout,
+    }).encode('utf-8')
+    header = struct.pack(HEADER_FORMAT, MAGIC, period_sec, tick_frequency, num_events,
+            len(metadata)) + metadata
+    return header + b'\x00' * (-len(header) % 8)
+
+
+def unpack_header(f):
+    """
+    Params:
+      f: a binary file object positioned at the beginning of the file
+    Return:
+      A dictionary with period_sec, tick_frequency, num_events, display_params, event_dtype (a
+      numpy dtype), layout, and data_offset (where the events start)
+    """
+    header_size = struct.calcsize(HEADER_FORMAT)
+    header = f.read(header_size)
+    if len(header) != header_size:
+        raise Exception('The file is too short')
+    magic, period_sec, tick_frequency, num_events, metadata_len = struct.unpack(
+            HEADER_FORMAT, header)
+    if magic != MAGIC:
+        raise Exception('Not a binary waveform file')
+
+    metadata_bytes = f.read(metadata_len)
+    if len(metadata_bytes) != metadata_len:
+        raise Exception('The file is too short')
+    metadata = json.loads(metadata_bytes.decode('utf-8'))
+
+    metadata_end = header_size + metadata_len
+    return {
+        'period_sec': period_sec,
+        'tick_frequency': tick_frequency,
+        'num_events': num_events,
+        'display_params': metadata['display_params'],
+        'event_dtype': numpy.dtype([tuple(field) for field in metadata['event_dtype']]),
+        'layout': metadata.get('layout', LAYOUT_RECORDS),
+        'data_offset': metadata_end + (-metadata_end % 8),
+    }
+
+
+def get_column_offsets(header):
+    """
+    Params:
+      header: the dictionary returned by unpack_header() of a file in the columns layout
+    Return:
+      A dictionary from the field names to the file offsets of the columns
+    """
+    offsets = {}
+    offset = header['data_offset']
+    for name in header['event_dtype'].names:
+        offsets[name] = offset
+        column_size = header['event_dtype'][name].itemsize * header['num_events']
+        offset += column_size + (-column_size % 8)
+    return offsets
+
+
+def write_columns(file_path, period_sec, tick_frequency, display_params, times, values):
+    """
+    Write a waveform in the columns layout.
+
+    Params:
+      times, values: the waveform after cleaning, times in seconds
+    """
+    times = numpy.ascontiguousarray(times, dtype=COLUMNS_DTYPE['time'])
+    values = numpy.ascontiguousarray(values, dtype=COLUMNS_DTYPE['value'])
+    if times.shape != values.shape:
+        raise Exception('times and values have different lengths')
+
+    with open(file_path, 'wb') as fo:
+        fo.write(pack_header(period_sec, tick_frequency, len(times), display_params,
+                COLUMNS_DTYPE, LAYOUT_COLUMNS))
+        for column in (times, values):
+            column.tofile(fo)
+            fo.write(b'\x00' * (-column.nbytes % 8))
@@ -1,7 +1,10 @@
 import json
 import re
+import numpy
 
-from serapis.utils.visualizers.fileio.waveform_query_base import WaveformQueryBase
+from serapis.utils.visualizers.fileio.waveform_query_base import WaveformColumns
+from serapis.utils.visualizers.fileio.waveform_file_reader_base import WaveformFileReaderBase
+from serapis.utils.visualizers.fileio.waveform_text_parser import find_waveform_section, load_columns, parse_hex
 
 """
 An example of the file content of Logic Saleae waveform looks like the following:
@@ -50,11 +53,18 @@ Or visually, it looks like the following:
 
 """
 
-class LogicSaleaeWaveformFileReader(WaveformQueryBase):
+class LogicSaleaeWaveformFileReader(WaveformFileReaderBase):
     ERROR_CODE_EMPTY_FILE = 1
     ERROR_CODE_NON_ASCII = 2
     ERROR_CODE_FORMAT = 3
 
+    # the columns of a row in the waveform section. Values are hexadecimal strings, and the rows
+    # whose value may be truncated are left to the line-by-line parser
+    EVENT_DTYPE = numpy.dtype([
+        ('time', numpy.float64),
+        ('value', 'S16'),
+    ])
+
     def __init__(self, raw_content):
         self._initialize_instance_variables()
         self._parse_raw_content(raw_content)
@@ -66,9 +76,12 @@ class LogicSaleaeWaveformFileReader(WaveformQueryBase):
         # `pins` (a list of integers)
         self.display_params = None
 
-        # data contains a list of tuples. Each tuple contains two items, a float representing
-        # start timestamp in ms, and an integer for a bus value
+        # data is a WaveformColumns, i.e., the start timestamps in seconds and the bus values.
+        # It can also be used as a list of (timestamp, bus value) tuples
         self.data = None
+
+        # a DecimationPyramid per plot, if built or loaded
+        self.decimation_pyramids = None
         
         self.error_code = None
 
@@ -77,56 +90,67 @@ class LogicSaleaeWaveformFileReader(WaveformQueryBase):
             self.error_code = LogicSaleaeWaveformFileReader.ERROR_CODE_EMPTY_FILE
             return
         
-        try:
-            content = raw_content.decode('ascii')
-        except:
+        if not raw_content.isascii():
             self.error_code = LogicSaleaeWaveformFileReader.ERROR_CODE_NON_ASCII
             return
 
-        if not self._parse_content(content):
+        # the fast parser handles well-formed files, and the line-by-line parser decides the rest
+        if (not self._parse_content_fast(raw_content)
+                and not self._parse_content(raw_content.decode('ascii'))):
             self.error_code = LogicSaleaeWaveformFileReader.ERROR_CODE_FORMAT
             return
 
         self.error_code = None
 
-    def _parse_content(self, content):
-        try:
-            lines = content.strip().split('\n')
-            num_total_lines = len(lines)
-            line_idx = 0
-
-            # E.g., Period: 1
-            matches = re.search(r'^Period: *(\d+(\.\d*)?)', lines[line_idx])
-            if not matches:
-                return False
-            self.period_sec = float(matches.group(1))
+    def _parse_metadata(self, lines):
+        """
+        Return:
+          The index of the line after "==", or None if the metadata is not valid
+        """
+        num_total_lines = len(lines)
+        line_idx = 0
+
+        # E.g., Period: 1
+        matches = re.search(r'^Period: *(\d+(\.\d*)?)', lines[line_idx])
+        if not matches:
+            return None
+        self.period_sec = float(matches.group(1))
+        line_idx += 1
+
+        # E.g., Display start
+        #       CTL,0
+        #       VAL,3,1
+        #       Display end
+        if not lines[line_idx].startswith('Display start'):
+            return None
+        line_idx += 1
+
+        self.display_params = []  # a list of {name, pins}
+        while line_idx < num_total_lines and not lines[line_idx].startswith('Display end'):
+            terms = lines[line_idx].split(',')
+            if len(terms) <= 1:
+                return None  # should have at least a name and a pin index
+            self.display_params.append({
+                'name': terms[0],
+                'pins': [int(x) for x in terms[1:]],
+            })
             line_idx += 1
 
-            # E.g., Display start
-            #       CTL,0
-            #       VAL,3,1
-            #       Display end
-            if not lines[line_idx].startswith('Display start'):
-                return False
-            line_idx += 1
+        line_idx += 1
 
-            self.display_params = []  # a list of {name, pins}
-            while line_idx < num_total_lines and not lines[line_idx].startswith('Display end'):
-                terms = lines[line_idx].split(',')
-                if len(terms) <= 1:
-                    return False  # should have at least a name and a pin index
-                self.display_params.append({
-                    'name': terms[0],
-                    'pins': [int(x) for x in terms[1:]],
-                })
-                line_idx += 1
+        # E.g., ==
+        if not lines[line_idx].startswith('=='):
+            return None
+        line_idx += 1
 
-            line_idx += 1
+        return line_idx
 
-            # E.g., ==
-            if not lines[line_idx].startswith('=='):
+    def _parse_content(self, content):
+        try:
+            lines = content.strip().split('\n')
+            line_idx = self._parse_metadata(lines)
+            if line_idx is None:
                 return False
-            line_idx += 1
 
             # E.g., Time[s], Data[Hex]
             #       0.000000000000000, 0
@@ -137,9 +161,33 @@ class LogicSaleaeWaveformFileReader(WaveformQueryBase):
             line_terms = [l.strip().split(',') for l in lines[line_idx:]]
 
             # self.data a list of (start timestamp, bus value)
-            self.data = [(float(l[0]), int(l[1], 16)) for l in line_terms]
+            self.data = WaveformColumns.from_events(
+                    [(float(l[0]), int(l[1], 16)) for l in line_terms])
+
+            self.data = self._clean_waveform_columns(self.data, self.period_sec)
+        except:
+            return False
+
+        return True
 
-            self.data = self._clean_waveform(self.data, self.period_sec)
+    def _parse_content_fast(self, raw_content):
+        """
+        Parse the waveform section with numpy instead of line by line. Return False if the file
+        is not in the exact form the fast parser expects.
+        """
+        try:
+            header_end, data_start = find_waveform_section(raw_content, num_skipped_lines=1)
+            lines = raw_content[:header_end].decode('ascii').strip().split('\n')
+            if self._parse_metadata(lines) != len(lines):
+                return False
+
+            events = load_columns(
+                    raw_content, data_start, LogicSaleaeWaveformFileReader.EVENT_DTYPE)
+            value_width = LogicSaleaeWaveformFileReader.EVENT_DTYPE['value'].itemsize
+            if (numpy.char.str_len(events['value']) >= value_width).any():
+                return False
+            self.data = WaveformColumns(events['time'], parse_hex(events['value']))
+            self.data = self._clean_waveform_columns(self.data, self.period_sec)
         except:
             return False
 
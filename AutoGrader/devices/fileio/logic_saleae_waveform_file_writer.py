@@ -1,5 +1,11 @@
-import json
-import re
+import os
+import shutil
+
+import numpy
+
+from AutoGrader.devices.fileio import binary_waveform_format
+from AutoGrader.devices.fileio.waveform_query_base import WaveformColumns, clean_waveform_columns
+from AutoGrader.devices.fileio.waveform_text_parser import parse_hex
 
 
 """
@@ -18,10 +24,23 @@ An example of the file content of Logic Saleae waveform looks like the following
   0.736037562500000, 8
 
 Please see logic_saleae_waveform_file_reader.py for the specification of the file.
+
+The raw data exported by Logic Saleae is streamed into the file after the metadata, without
+being loaded into memory. Optionally, the raw data is also converted into the binary format
+described in binary_waveform_format.py while copying. The binary file only keeps the rows where
+the value changes, and event times are in seconds. The same transitions can also be written in
+the columns layout of the binary format, which BinaryWaveformFileReader memory-maps.
 """
 
 class LogicSaleaeWaveformFileWriter(object):
 
+    COPY_CHUNK_SIZE = 1 << 20
+
+    EVENT_DTYPE = numpy.dtype([
+        ('time', '<f8'),
+        ('value', '<u4'),
+    ])
+
     def __init__(self, file_path):
         # initialize instance variables
         self.file_path = file_path
@@ -32,6 +51,9 @@ class LogicSaleaeWaveformFileWriter(object):
         # The first item is the name of the plot, following are pin numbers.
         self.display_params = []
 
+        # the same display params as a list of {name, pins}, used by the binary format
+        self.display_param_dicts = []
+
         # The output file path of Logic Saleae python library
         self.raw_data_path = None
 
@@ -44,11 +66,18 @@ class LogicSaleaeWaveformFileWriter(object):
             plot_pins = [plot_pins]
 
         self.display_params.append(','.join(list(map(str, [plot_name] + plot_pins))))
+        self.display_param_dicts.append({'name': plot_name, 'pins': list(plot_pins)})
 
     def set_raw_data_path(self, data_path):
         self.raw_data_path = data_path
 
-    def marshal(self):
+    def marshal(self, binary_file_path=None, mapped_file_path=None):
+        """
+        Params:
+          binary_file_path: if specified, also write the waveform in the binary format
+          mapped_file_path: if specified, also write the waveform in the columns layout of the
+              binary format, which BinaryWaveformFileReader memory-maps
+        """
         if self.period_sec is None:
             raise Exception('"Period" is not set')
         if len(self.display_params) == 0:
@@ -56,15 +85,108 @@ class LogicSaleaeWaveformFileWriter(object):
         if self.raw_data_path is None:
             raise Exception('"Raw data path" is not set')
 
-        with open(self.raw_data_path, 'rb') as f:
-            raw_waveform_data = f.read().decode()
-
-        with open(self.file_path, 'w') as fo:
-            fo.write("\n".join(
-                ["Period: %f" % self.period_sec] +
-                ["Display start"] +
-                self.display_params +
-                ["Display end"] +
-                ["=="] +
-                [raw_waveform_data]
-            ))
+        header = "\n".join(
+            ["Period: %f" % self.period_sec] +
+            ["Display start"] +
+            self.display_params +
+            ["Display end"] +
+            ["=="] +
+            [""]
+        ).encode()
+
+        transition_chunks = [] if mapped_file_path is not None else None
+        with open(self.raw_data_path, 'rb') as f, open(self.file_path, 'wb') as fo:
+            fo.write(header)
+            if binary_file_path is None and mapped_file_path is None:
+                _copy_file(f, fo)
+            elif binary_file_path is None:
+                self._copy_and_convert(f, fo, None, transition_chunks)
+            else:
+                with open(binary_file_path, 'wb') as fb:
+                    self._copy_and_convert(f, fo, fb, transition_chunks)
+
+        if mapped_file_path is not None:
+            transitions = numpy.concatenate(
+                    [numpy.empty(0, dtype=LogicSaleaeWaveformFileWriter.EVENT_DTYPE)]
+                    + transition_chunks)
+            waveform = clean_waveform_columns(
+                    WaveformColumns(transitions['time'], transitions['value']), self.period_sec)
+            binary_waveform_format.write_columns(mapped_file_path, self.period_sec, 0.,
+                    self.display_param_dicts, waveform.times, waveform.values)
+
+    def _copy_and_convert(self, f, fo, fb, transition_chunks=None):
+        """
+        Copy f into fo, and convert the rows where the value changes into the binary records,
+        which are written into fb if it is not None, and appended to transition_chunks if it is
+        not None.
+        """
+        if fb is not None:
+            fb.write(self._get_binary_header(num_events=0))
+        num_events = 0
+        last_value = None
+        remainder = b''
+        is_first_line = True
+        while True:
+            chunk = f.read(LogicSaleaeWaveformFileWriter.COPY_CHUNK_SIZE)
+            fo.write(chunk)
+
+            # the last line is incomplete unless the file ends
+            data = remainder + chunk
+            end = data.rfind(b'\n') + 1 if chunk else len(data)
+            data, remainder = data[:end], data[end:]
+            if is_first_line and end > 0:
+                data = data[data.find(b'\n') + 1:] if b'\n' in data else b''  # the column names
+                is_first_line = False
+
+            tokens = data.replace(b',', b' ').split()
+            if len(tokens) % 2 != 0:
+                raise Exception('Raw data has an incomplete row')
+            if len(tokens) > 0:
+                events = numpy.empty(len(tokens) // 2,
+                        dtype=LogicSaleaeWaveformFileWriter.EVENT_DTYPE)
+                events['time'] = numpy.array(tokens[0::2]).astype(numpy.float64)
+                events['value'] = parse_hex(tokens[1::2])
+
+                # keep transitions only
+                changed = numpy.empty(len(events), dtype=bool)
+                changed[0] = events['value'][0] != last_value
+                changed[1:] = events['value'][1:] != events['value'][:-1]
+                last_value = events['value'][-1]
+                events = events[changed]
+                if fb is not None:
+                    fb.write(events.tobytes())
+                if transition_chunks is not None:
+                    transition_chunks.append(events)
+                num_events += len(events)
+
+            if not chunk:
+                break
+
+        if fb is not None:
+            fb.seek(0)
+            fb.write(self._get_binary_header(num_events))
+
+    def _get_binary_header(self, num_events):
+        return binary_waveform_format.pack_header(self.period_sec, 0., num_events,
+                self.display_param_dicts, LogicSaleaeWaveformFileWriter.EVENT_DTYPE)
+
+
+def _copy_file(f, fo):
+    """
+    Copy the rest of f into fo with sendfile() if the platform supports it, so that the data does
+    not pass through user space.
+    """
+    fo.flush()
+    offset = f.tell()
+    start_offset = offset
+    try:
+        while True:
+            num_sent_bytes = os.sendfile(fo.fileno(), f.fileno(), offset,
+                    LogicSaleaeWaveformFileWriter.COPY_CHUNK_SIZE)
+            if num_sent_bytes == 0:
+                return
+            offset += num_sent_bytes
+    except (AttributeError, OSError):
+        if offset != start_offset:
+            raise
+    shutil.copyfileobj(f, fo, LogicSaleaeWaveformFileWriter.COPY_CHUNK_SIZE)
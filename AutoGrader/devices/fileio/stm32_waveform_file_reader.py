@@ -1,7 +1,10 @@
 import json
 import re
+import numpy
 
-from serapis.utils.visualizers.fileio.waveform_query_base import WaveformQueryBase
+from serapis.utils.visualizers.fileio.waveform_query_base import WaveformColumns
+from serapis.utils.visualizers.fileio.waveform_file_reader_base import WaveformFileReaderBase
+from serapis.utils.visualizers.fileio.waveform_text_parser import find_waveform_section, load_columns
 
 """
 An example of the file content of STM32 waveform looks like the following:
@@ -48,11 +51,18 @@ Or visually, it looks like the following:
 
 """
 
-class STM32WaveformFileReader(WaveformQueryBase):
+class STM32WaveformFileReader(WaveformFileReaderBase):
     ERROR_CODE_EMPTY_FILE = 1
     ERROR_CODE_NON_ASCII = 2
     ERROR_CODE_FORMAT = 3
 
+    # the columns of a row in the waveform section
+    EVENT_DTYPE = numpy.dtype([
+        ('code', numpy.int64),
+        ('time', numpy.float64),
+        ('value', numpy.int64),
+    ])
+
     def __init__(self, raw_content):
         self._initialize_instance_variables()
         self._parse_raw_content(raw_content)
@@ -65,9 +75,12 @@ class STM32WaveformFileReader(WaveformQueryBase):
         # `pins` (a list of integers)
         self.display_params = None
 
-        # data contains a list of tuples. Each tuple contains two items, a float representing
-        # start timestamp in ms, and an integer for a bus value
+        # data is a WaveformColumns, i.e., the start timestamps in seconds and the bus values.
+        # It can also be used as a list of (timestamp, bus value) tuples
         self.data = None
+
+        # a DecimationPyramid per plot, if built or loaded
+        self.decimation_pyramids = None
         
         self.error_code = None
 
@@ -76,76 +89,112 @@ class STM32WaveformFileReader(WaveformQueryBase):
             self.error_code = STM32WaveformFileReader.ERROR_CODE_EMPTY_FILE
             return
         
-        try:
-            content = raw_content.decode('ascii')
-        except:
+        if not raw_content.isascii():
             self.error_code = STM32WaveformFileReader.ERROR_CODE_NON_ASCII
             return
 
-        if not self._parse_content(content):
+        # the fast parser handles well-formed files, and the line-by-line parser decides the rest
+        if (not self._parse_content_fast(raw_content)
+                and not self._parse_content(raw_content.decode('ascii'))):
             self.error_code = STM32WaveformFileReader.ERROR_CODE_FORMAT
             return
 
         self.error_code = None
 
-    def _parse_content(self, content):
-        try:
-            lines = content.strip().split('\n')
-            num_total_lines = len(lines)
-            line_idx = 0
-
-            # E.g., Period: 20
-            matches = re.search(r'^Period: *(\d+(\.\d*)?)', lines[line_idx])
-            if not matches:
-                return False
-            self.period_sec = float(matches.group(1))
-            line_idx += 1
-
-            # E.g., Tick frequency: 5000
-            matches = re.search(r'^Tick frequency: *(\d+(\.\d*)?)', lines[line_idx])
-            if not matches:
-                return False
-            self.tick_frequency = float(matches.group(1))
+    def _parse_metadata(self, lines):
+        """
+        Return:
+          The index of the line after "==", or None if the metadata is not valid
+        """
+        num_total_lines = len(lines)
+        line_idx = 0
+
+        # E.g., Period: 20
+        matches = re.search(r'^Period: *(\d+(\.\d*)?)', lines[line_idx])
+        if not matches:
+            return None
+        self.period_sec = float(matches.group(1))
+        line_idx += 1
+
+        # E.g., Tick frequency: 5000
+        matches = re.search(r'^Tick frequency: *(\d+(\.\d*)?)', lines[line_idx])
+        if not matches:
+            return None
+        self.tick_frequency = float(matches.group(1))
+        line_idx += 1
+
+        # E.g., Display start
+        #       CTL,0
+        #       VAL,2,1
+        #       Display end
+        if not lines[line_idx].startswith('Display start'):
+            return None
+        line_idx += 1
+
+        self.display_params = []  # a list of {name, pins}
+        while line_idx < num_total_lines and not lines[line_idx].startswith('Display end'):
+            terms = lines[line_idx].split(',')
+            if len(terms) <= 1:
+                return None  # should have at least a name and a pin index
+            self.display_params.append({
+                'name': terms[0],
+                'pins': [int(x) for x in terms[1:]],
+            })
             line_idx += 1
 
-            tick_sec = 1. / self.tick_frequency
-
-            # E.g., Display start
-            #       CTL,0
-            #       VAL,2,1
-            #       Display end
-            if not lines[line_idx].startswith('Display start'):
-                return False
-            line_idx += 1
+        line_idx += 1
 
-            self.display_params = []  # a list of {name, pins}
-            while line_idx < num_total_lines and not lines[line_idx].startswith('Display end'):
-                terms = lines[line_idx].split(',')
-                if len(terms) <= 1:
-                    return False  # should have at least a name and a pin index
-                self.display_params.append({
-                    'name': terms[0],
-                    'pins': [int(x) for x in terms[1:]],
-                })
-                line_idx += 1
+        # E.g., ==
+        if not lines[line_idx].startswith('=='):
+            return None
+        line_idx += 1
 
-            line_idx += 1
+        return line_idx
 
-            # E.g., ==
-            if not lines[line_idx].startswith('=='):
+    def _parse_content(self, content):
+        try:
+            lines = content.strip().split('\n')
+            line_idx = self._parse_metadata(lines)
+            if line_idx is None:
                 return False
-            line_idx += 1
 
             # E.g., 68, 0, 0
             #       68, 30000, 3
             #       68, 70000, 4
             line_terms = [l.strip().split(',') for l in lines[line_idx:]]
 
+            tick_sec = 1. / self.tick_frequency
+
             # self.data a list of (start timestamp, bus value)
-            self.data = [(float(l[1]) * tick_sec, int(l[2]))
-                    for l in line_terms if int(l[0]) == 68]
+            self.data = WaveformColumns.from_events([(float(l[1]) * tick_sec, int(l[2]))
+                    for l in line_terms if int(l[0]) == 68])
 
-            self.data = self._clean_waveform(self.data, self.period_sec)
+            self.data = self._clean_waveform_columns(self.data, self.period_sec)
+        except:
+            return False
+
+        return True
+
+    def _parse_content_fast(self, raw_content):
+        """
+        Parse the waveform section with numpy instead of line by line. Return False if the file
+        is not in the exact form the fast parser expects.
+        """
+        try:
+            header_end, data_start = find_waveform_section(raw_content)
+            lines = raw_content[:header_end].decode('ascii').strip().split('\n')
+            if self._parse_metadata(lines) != len(lines):
+                return False
+
+            events = load_columns(raw_content, data_start, STM32WaveformFileReader.EVENT_DTYPE)
+            events = events[events['code'] == 68]
+            if len(events) > 0 and (events['value'].min() < 0
+                    or events['value'].max() > numpy.iinfo(numpy.uint32).max):
+                return False
+
+            self.data = WaveformColumns(events['time'] * (1. / self.tick_frequency),
+                    events['value'])
+            self.data = self._clean_waveform_columns(self.data, self.period_sec)
         except:
             return False
 
@@ -221,7 +270,76 @@ class STM32WaveformFileReader(WaveformQueryBase):
         display_param = self.display_params[series_idx]
         series_name = display_param['name']
         series_pins = display_param['pins']
-        result_sec = self._get_event_series(self.data, series_pins, start_time_sec, end_time_sec)
-        result_ms = [(t * 1000., v) for t, v in result_sec]
+        result_sec = self._get_event_series_columns(
+                self.data, series_pins, start_time_sec, end_time_sec)
+        result_ms = list(zip((result_sec.times * 1000.).tolist(), result_sec.values.tolist()))
         
         return (series_name, result_ms)
+
+    def get_bus_values(self, series_idx, query_times_ms):
+        """
+        The same as WaveformFileReaderBase.get_bus_values(), with the time points in ms.
+        """
+
+        query_times_sec = numpy.asarray(query_times_ms, dtype=numpy.float64) / 1000.
+        return super().get_bus_values(series_idx, query_times_sec)
+
+    def sample_bus_values(self, series_idx, interval_ms, start_time_ms=None, end_time_ms=None):
+        """
+        The same as WaveformFileReaderBase.sample_bus_values(), with the time in ms.
+
+        Returns:
+          (name, times_ms, values)
+        """
+
+        start_time_sec = None if start_time_ms is None else start_time_ms / 1000.
+        end_time_sec = None if end_time_ms is None else end_time_ms / 1000.
+
+        name, times_sec, values = super().sample_bus_values(
+                series_idx, interval_ms / 1000., start_time_sec, end_time_sec)
+        return (name, times_sec * 1000., values)
+
+    def get_event_series_batch(self, series_idx, time_windows_ms):
+        """
+        The same as get_event_series(), but for many (start_time_ms, end_time_ms) windows.
+
+        Returns:
+          (name, time_series_list)
+            - name: plot name, a string
+            - time_series_list: a list of time series, one per window. See get_event_series().
+        """
+
+        time_windows_sec = numpy.asarray(time_windows_ms, dtype=numpy.float64) / 1000.
+        name, results_sec = self._query_event_series_batch(series_idx, time_windows_sec)
+        results_ms = [list(zip((r.times * 1000.).tolist(), r.values.tolist()))
+                for r in results_sec]
+        return (name, results_ms)
+
+    def get_decimated_series(self, series_idx, num_buckets, start_time_ms=None, end_time_ms=None):
+        """
+        The same as WaveformFileReaderBase.get_decimated_series(), with the time in ms.
+        """
+
+        start_time_sec = None if start_time_ms is None else start_time_ms / 1000.
+        end_time_sec = None if end_time_ms is None else end_time_ms / 1000.
+
+        name, result_sec = self._query_decimated_series(
+                series_idx, num_buckets, start_time_sec, end_time_sec)
+        return (name, result_sec.to_list(time_scale=1000.))
+
+    def compare_waveform(self, other, pin_indexes, tolerance_ms=0., offset_ms=0.,
+            max_offset_ms=None, start_time_ms=None, end_time_ms=None, other_pin_indexes=None):
+        """
+        The same as WaveformFileReaderBase.compare_waveform(), with the time in ms, also in the
+        returned dictionary.
+        """
+
+        tolerance_sec = tolerance_ms / 1000.
+        offset_sec = offset_ms / 1000.
+        max_offset_sec = None if max_offset_ms is None else max_offset_ms / 1000.
+        start_time_sec = None if start_time_ms is None else start_time_ms / 1000.
+        end_time_sec = None if end_time_ms is None else end_time_ms / 1000.
+
+        result_sec = self._query_comparison(other, pin_indexes, other_pin_indexes,
+                tolerance_sec, offset_sec, max_offset_sec, start_time_sec, end_time_sec)
+        return result_sec.to_dict(time_scale=1000.)
@@ -1,5 +1,8 @@
-import json
-import re
+import numpy
+
+from AutoGrader.devices.fileio import binary_waveform_format
+from AutoGrader.devices.fileio.waveform_query_base import WaveformColumns, clean_waveform_columns
+from AutoGrader.devices.fileio.waveform_text_parser import find_waveform_section, load_columns
 
 
 """
@@ -17,10 +20,28 @@ An example of the file content of STM32 waveform looks like the following:
   68, 70000, 4
 
 Please see stm32_waveform_file_reader.py for the specification of the file.
+
+Besides marshaling all the events at once, the writer supports a stream mode, which writes
+events to the file as they are added. The period is usually unknown until the end, thus the
+period line is written as a fixed-width placeholder and patched when the stream is closed.
+
+The stream mode can also produce a binary file instead of the text one, whose format is
+described in binary_waveform_format.py. Event times are in ticks.
+
+Both modes can additionally write the waveform in the columns layout of the binary format, which
+BinaryWaveformFileReader memory-maps. It is converted from the events once they are all known.
 """
 
 class STM32WaveformFileWriter(object):
 
+    PERIOD_FIELD_WIDTH = 24
+
+    EVENT_DTYPE = numpy.dtype([
+        ('code', 'u1'),
+        ('time', '<u4'),
+        ('value', '<u2'),
+    ])
+
     def __init__(self, file_path):
         # initialize instance variables
         self.file_path = file_path
@@ -32,10 +53,18 @@ class STM32WaveformFileWriter(object):
         # The first item is the name of the plot, following are pin numbers.
         self.display_params = []
 
+        # the same display params as a list of {name, pins}, used by the binary format
+        self.display_param_dicts = []
+
         # data contains a list of strings. Each string contains 3 comman-separated integers, which
         # are packet code, timestamp in tick, and a bus value
         self.data = []
 
+        # stream mode
+        self.stream = None
+        self.stream_binary = False
+        self.num_streamed_events = 0
+
     def set_period_sec(self, period_sec):
         self.period_ms = period_sec * 1000.
 
@@ -51,11 +80,19 @@ class STM32WaveformFileWriter(object):
             plot_pins = [plot_pins]
 
         self.display_params.append(','.join(list(map(str, [plot_name] + plot_pins))))
+        self.display_param_dicts.append({'name': plot_name, 'pins': list(plot_pins)})
 
     def add_event(self, event_code, time, bus_value):
-        self.data.append('%d,%d,%d' % (event_code, time, bus_value))
-
-    def marshal(self):
+        if self.stream is not None:
+            self.append_events([event_code], [time], [bus_value])
+        else:
+            self.data.append('%d,%d,%d' % (event_code, time, bus_value))
+
+    def marshal(self, mapped_file_path=None):
+        """
+        Params:
+          mapped_file_path: if specified, also write the waveform in the columns layout
+        """
         if self.period_ms is None:
             raise Exception('"Period" is not set')
         if self.tick_frequency is None:
@@ -73,3 +110,126 @@ class STM32WaveformFileWriter(object):
                 ["=="] +
                 self.data
             ))
+
+        if mapped_file_path is not None:
+            events = numpy.array([row.split(',') for row in self.data], dtype=numpy.int64)
+            events = events.reshape((-1, 3))
+            self._write_mapped_file(mapped_file_path, events[:, 0], events[:, 1], events[:, 2])
+
+    #
+    # stream mode
+    #
+    def open_stream(self, binary=False):
+        """
+        Write the metadata and keep the file open for appending events. The period does not
+        need to be set until close_stream().
+        """
+        if self.tick_frequency is None:
+            raise Exception('"Tick frequency" is not set')
+        if len(self.display_params) == 0:
+            raise Exception('"Display params" is empty')
+        if self.stream is not None:
+            raise Exception('Stream is already open')
+
+        self.stream = open(self.file_path, 'wb')
+        self.stream_binary = binary
+        self.num_streamed_events = 0
+
+        if binary:
+            self.stream.write(self._get_binary_header(period_sec=0.))
+        else:
+            self.stream.write(("\n".join(
+                [self._get_period_line(0.)] +
+                ["Tick frequency: %f" % self.tick_frequency] +
+                ["Display start"] +
+                self.display_params +
+                ["Display end"] +
+                ["=="]
+            ) + "\n").encode('ascii'))
+
+    def append_events(self, event_codes, times, bus_values):
+        """
+        Params:
+          event_codes, times, bus_values: sequences (or numpy arrays) of the same length
+        """
+        if self.stream is None:
+            raise Exception('Stream is not open')
+
+        if self.stream_binary:
+            records = numpy.empty(len(event_codes), dtype=STM32WaveformFileWriter.EVENT_DTYPE)
+            records['code'] = event_codes
+            records['time'] = times
+            records['value'] = bus_values
+            self.stream.write(records.tobytes())
+        else:
+            rows = zip(_to_list(event_codes), _to_list(times), _to_list(bus_values))
+            self.stream.write(''.join(['%d,%d,%d\n' % r for r in rows]).encode('ascii'))
+        self.num_streamed_events += len(event_codes)
+
+    def close_stream(self, mapped_file_path=None):
+        """
+        Patch the period and close the file.
+
+        Params:
+          mapped_file_path: if specified, also write the waveform in the columns layout, which
+              is converted from the file just closed
+        """
+        if self.stream is None:
+            raise Exception('Stream is not open')
+        if self.period_ms is None:
+            raise Exception('"Period" is not set')
+
+        self.stream.flush()
+        if self.stream.seekable():
+            self.stream.seek(0)
+            if self.stream_binary:
+                self.stream.write(self._get_binary_header(self.period_ms / 1000.))
+            else:
+                self.stream.write(self._get_period_line(self.period_ms / 1000.).encode('ascii'))
+        self.stream.close()
+        self.stream = None
+
+        if mapped_file_path is not None:
+            events = self._load_streamed_events()
+            self._write_mapped_file(
+                    mapped_file_path, events['code'], events['time'], events['value'])
+
+    def _load_streamed_events(self):
+        if self.stream_binary:
+            with open(self.file_path, 'rb') as f:
+                header = binary_waveform_format.unpack_header(f)
+            return numpy.fromfile(self.file_path, dtype=STM32WaveformFileWriter.EVENT_DTYPE,
+                    count=header['num_events'], offset=header['data_offset'])
+
+        if self.num_streamed_events == 0:
+            return numpy.empty(0, dtype=STM32WaveformFileWriter.EVENT_DTYPE)
+        with open(self.file_path, 'rb') as f:
+            raw_content = f.read()
+        _, data_start = find_waveform_section(raw_content)
+        return load_columns(raw_content, data_start, STM32WaveformFileWriter.EVENT_DTYPE)
+
+    def _write_mapped_file(self, file_path, event_codes, times, bus_values):
+        # only the waveform events are displayed, same as STM32WaveformFileReader
+        is_waveform_event = numpy.asarray(event_codes) == 68
+        times_sec = numpy.asarray(times)[is_waveform_event] * (1. / self.tick_frequency)
+        waveform = clean_waveform_columns(
+                WaveformColumns(times_sec, numpy.asarray(bus_values)[is_waveform_event]),
+                self.period_ms / 1000.)
+        binary_waveform_format.write_columns(file_path, self.period_ms / 1000.,
+                self.tick_frequency, self.display_param_dicts, waveform.times, waveform.values)
+
+    def _get_period_line(self, period_sec):
+        # padded to a fixed width so that the line can be overwritten in place
+        period_str = '%f' % period_sec
+        if len(period_str) > STM32WaveformFileWriter.PERIOD_FIELD_WIDTH:
+            raise Exception('Period is too long')
+        return 'Period: %s' % period_str.ljust(STM32WaveformFileWriter.PERIOD_FIELD_WIDTH)
+
+    def _get_binary_header(self, period_sec):
+        return binary_waveform_format.pack_header(period_sec, self.tick_frequency,
+                self.num_streamed_events, self.display_param_dicts,
+                STM32WaveformFileWriter.EVENT_DTYPE)
+
+
+def _to_list(values):
+    return values.tolist() if isinstance(values, numpy.ndarray) else list(values)
@@ -0,0 +1,176 @@
+from serapis.utils.visualizers.fileio.waveform_query_base import WaveformQueryBase
+from serapis.utils.visualizers.fileio.waveform_query_base import save_decimation_pyramids, load_decimation_pyramids
+
+"""
+WaveformFileReaderBase provides the queries which the waveform file readers share. A reader
+sets self.data (the cleaned WaveformColumns), self.period_sec, self.display_params,
+self.decimation_pyramids and self.error_code, and the queries work on them in seconds.
+
+A reader whose interface is in another time unit (e.g., STM32WaveformFileReader in ms)
+overrides the public queries to convert the time around the _query_*() methods, which return
+the results in seconds before they are turned into lists.
+"""
+
+class WaveformFileReaderBase(WaveformQueryBase):
+
+    def get_bus_values(self, series_idx, query_times_sec):
+        """
+        Get the bus values at many time points at once.
+
+        Returns:
+          (name, values)
+            - name: plot name, a string
+            - values: a numpy array of bus values, one per time point. -1 if the time point is
+                  beyond the waveform.
+        """
+
+        display_param = self._get_display_param(series_idx)
+        values = self._get_bus_values(self.data, display_param['pins'], query_times_sec)
+        return (display_param['name'], values)
+
+    def sample_bus_values(self, series_idx, interval_sec, start_time_sec=None, end_time_sec=None):
+        """
+        Sample the bus value every interval_sec. The default time range is the same as
+        get_event_series().
+
+        Returns:
+          (name, times_sec, values)
+            - name: plot name, a string
+            - times_sec: a numpy array of the sampling time points
+            - values: a numpy array of bus values
+        """
+
+        display_param = self._get_display_param(series_idx)
+        times_sec, values = self._sample_bus_values(self.data, display_param['pins'],
+                interval_sec, start_time_sec, end_time_sec)
+        return (display_param['name'], times_sec, values)
+
+    def get_event_series_batch(self, series_idx, time_windows_sec):
+        """
+        The same as get_event_series(), but for many (start_time_sec, end_time_sec) windows.
+
+        Returns:
+          (name, time_series_list)
+            - name: plot name, a string
+            - time_series_list: a list of time series, one per window. See get_event_series().
+        """
+
+        name, results_sec = self._query_event_series_batch(series_idx, time_windows_sec)
+        return (name, [r.to_list() for r in results_sec])
+
+    def get_decimated_series(self, series_idx, num_buckets, start_time_sec=None,
+            end_time_sec=None):
+        """
+        Reduce the waveform between start_time_sec and end_time_sec to num_buckets buckets, e.g.,
+        one per pixel of a plot. The default time range is the same as get_event_series().
+
+        Returns:
+          (name, buckets)
+            - name: plot name, a string
+            - buckets: a list of (bucket_start_time_sec, first, last, min, max) where first and
+                  last are the bus values at the start and at the end of the bucket, and min and
+                  max are the range of the bus value within the bucket
+        """
+
+        name, result_sec = self._query_decimated_series(
+                series_idx, num_buckets, start_time_sec, end_time_sec)
+        return (name, result_sec.to_list())
+
+    def build_decimation_pyramids(self, file_path=None, num_finest_buckets=None):
+        """
+        Build a DecimationPyramid for every plot, which get_decimated_series() uses for wide
+        windows afterwards. If file_path is specified, the pyramids are also saved there, e.g.,
+        beside the waveform file, to be loaded by load_decimation_pyramids() next time.
+        """
+
+        self._check_parsed()
+
+        kwargs = {}
+        if num_finest_buckets is not None:
+            kwargs['num_finest_buckets'] = num_finest_buckets
+        self.decimation_pyramids = [
+                self._build_decimation_pyramid(self.data, p['pins'], self.period_sec, **kwargs)
+                for p in self.display_params]
+        if file_path is not None:
+            save_decimation_pyramids(file_path, self.decimation_pyramids)
+
+    def load_decimation_pyramids(self, file_path):
+        """
+        Load the pyramids saved by build_decimation_pyramids().
+        """
+
+        self._check_parsed()
+
+        pyramids = load_decimation_pyramids(file_path)
+        if (len(pyramids) != len(self.display_params)
+                or any(pyramid.period_sec != self.period_sec
+                    or pyramid.pin_indexes != display_param['pins']
+                    for pyramid, display_param in zip(pyramids, self.display_params))):
+            raise Exception('The pyramids are not built for this waveform')
+        self.decimation_pyramids = pyramids
+
+    def compare_waveform(self, other, pin_indexes, tolerance_sec=0., offset_sec=0.,
+            max_offset_sec=None, start_time_sec=None, end_time_sec=None, other_pin_indexes=None):
+        """
+        Compare the waveform of another reader, e.g., a capture of the DUT in any format,
+        against this one as the reference, pin by pin. The other waveform is shifted by
+        offset_sec, or by the best-fit offset within offset_sec +/- max_offset_sec if
+        max_offset_sec is not None. The default time range is where both waveforms are defined.
+        See _compare_waveforms() for the parameters.
+
+        Params:
+          other: a STM32WaveformFileReader, LogicSaleaeWaveformFileReader or
+              BinaryWaveformFileReader
+        Returns:
+          A dictionary, see WaveformComparison.to_dict(). The time is in seconds.
+        """
+
+        result_sec = self._query_comparison(other, pin_indexes, other_pin_indexes,
+                tolerance_sec, offset_sec, max_offset_sec, start_time_sec, end_time_sec)
+        return result_sec.to_dict()
+
+    #
+    # queries in seconds, before the results are turned into lists
+    #
+    def _query_event_series_batch(self, series_idx, time_windows_sec):
+        """
+        Returns:
+          (name, a list of WaveformColumns)
+        """
+        display_param = self._get_display_param(series_idx)
+        results_sec = self._get_event_series_batch(
+                self.data, display_param['pins'], time_windows_sec)
+        return (display_param['name'], results_sec)
+
+    def _query_decimated_series(self, series_idx, num_buckets, start_time_sec, end_time_sec):
+        """
+        Returns:
+          (name, a DecimatedSeries)
+        """
+        display_param = self._get_display_param(series_idx)
+        pyramid = (self.decimation_pyramids[series_idx]
+                if self.decimation_pyramids is not None else None)
+        result_sec = self._get_decimated_series(self.data, display_param['pins'], num_buckets,
+                start_time_sec, end_time_sec, pyramid)
+        return (display_param['name'], result_sec)
+
+    def _query_comparison(self, other, pin_indexes, other_pin_indexes, tolerance_sec,
+            offset_sec, max_offset_sec, start_time_sec, end_time_sec):
+        """
+        Returns:
+          A WaveformComparison
+        """
+        self._check_parsed()
+        if not other.is_successfully_parsed():
+            raise Exception("There is an error while parsing the content to compare")
+
+        return self._compare_waveforms(self.data, other.data, pin_indexes, other_pin_indexes,
+                tolerance_sec, offset_sec, max_offset_sec, start_time_sec, end_time_sec)
+
+    def _check_parsed(self):
+        if self.error_code is not None:
+            raise Exception("There is an error while parsing content")
+
+    def _get_display_param(self, series_idx):
+        self._check_parsed()
+        return self.display_params[series_idx]
@@ -1,15 +1,657 @@
 import json
 import re
-import bisect
+import collections
 import numpy
 
 """
 WaveformQueryBase is an abstract class which provides waveform event cleaning methods and handy
 query methods, such as retrieving all rising edges.
+
+A waveform is stored as WaveformColumns, i.e., a float64 array of timestamps and a uint32 array
+of bus values, and queries are computed on the arrays. The protected methods also accept the
+former representation, a list of (time, bus_value) tuples, and return lists as before.
+
+The cleaning is also available as clean_waveform_columns() for the code which does not query
+waveforms, e.g., the writers of the binary format.
+
+_compare_waveforms() compares a captured waveform against a reference, e.g., a Logic Saleae
+capture of the DUT against the STM32 waveform it should produce. It only needs the cleaned
+WaveformColumns of both, thus the two can come from readers of different formats.
 """
 
+class WaveformColumns(object):
+    """
+    A waveform in columnar form. times are in seconds and non-decreasing once the waveform is
+    cleaned. For compatibility with the list-of-tuples representation, it supports len(),
+    indexing and iteration, which produce (time, bus_value) tuples.
+    """
+
+    def __init__(self, times, values):
+        self.times = numpy.ascontiguousarray(times, dtype=numpy.float64)
+        self.values = numpy.ascontiguousarray(values, dtype=numpy.uint32)
+        if self.times.shape != self.values.shape:
+            raise Exception('times and values have different lengths')
+
+    @classmethod
+    def from_events(cls, events):
+        """
+        Params:
+          events: a list of (time, bus_value) tuples
+        """
+        if len(events) == 0:
+            return cls(numpy.empty(0), numpy.empty(0))
+        times, values = zip(*events)
+        return cls(times, values)
+
+    def __len__(self):
+        return len(self.times)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return WaveformColumns(self.times[idx], self.values[idx])
+        return (float(self.times[idx]), int(self.values[idx]))
+
+    def __iter__(self):
+        return zip(self.times.tolist(), self.values.tolist())
+
+    def to_list(self):
+        return list(self)
+
+
+class TransitionIndex(object):
+    """
+    The transitions of a waveform on a pin set, i.e., the events where the bus value of the pins
+    changes, in time order. For a single pin, the rising and falling edge timestamps are derived
+    on first use.
+    """
+
+    def __init__(self, times, values):
+        self.times = times
+        self.values = values
+        self.rising_times = None
+        self.falling_times = None
+
+    def get_edge_times(self, rising):
+        """
+        Only meaningful for a single pin. The first transition is the initial value, not an edge.
+        """
+        if self.rising_times is None:
+            self.rising_times = self.times[1:][self.values[1:] == 1]
+            self.falling_times = self.times[1:][self.values[1:] == 0]
+        return self.rising_times if rising else self.falling_times
+
+
+class DecimatedSeries(object):
+    """
+    A series reduced to buckets for plotting. For every bucket, it keeps the bus value at the
+    start (first), right before the end (last), the minimum and maximum values the bus takes
+    within the bucket, and the number of transitions in the bucket. Drawing a vertical line from
+    the minimum to the maximum of every bucket shows the same picture as drawing all the
+    transitions.
+    """
+
+    def __init__(self, times, first_values, last_values, min_values, max_values,
+            num_transitions):
+        # times are the start timestamps of the buckets
+        self.times = times
+        self.first_values = first_values
+        self.last_values = last_values
+        self.min_values = min_values
+        self.max_values = max_values
+        self.num_transitions = num_transitions
+
+    def __len__(self):
+        return len(self.times)
+
+    def to_list(self, time_scale=1.):
+        """
+        Returns:
+          A list of (bucket_start_time, first, last, min, max) tuples, time multiplied by
+          time_scale
+        """
+        return list(zip((self.times * time_scale).tolist(), self.first_values.tolist(),
+                self.last_values.tolist(), self.min_values.tolist(), self.max_values.tolist()))
+
+    def _merge_pairs(self):
+        """
+        Returns:
+          A DecimatedSeries with half the buckets, each is the combination of two adjacent
+          buckets. The number of buckets has to be even.
+        """
+        return DecimatedSeries(
+            self.times[0::2],
+            self.first_values[0::2],
+            self.last_values[1::2],
+            numpy.minimum(self.min_values[0::2], self.min_values[1::2]),
+            numpy.maximum(self.max_values[0::2], self.max_values[1::2]),
+            self.num_transitions[0::2] + self.num_transitions[1::2],
+        )
+
+
+def decimate_transitions(times, values, edges):
+    """
+    Params:
+      times, values: the transitions of a bus, e.g., a TransitionIndex. times[0] <= edges[0].
+      edges: the increasing bounds of the buckets. Bucket i is [edges[i], edges[i+1]), and the
+          last bucket also includes its end.
+    Returns:
+      A DecimatedSeries
+    """
+    lo = numpy.searchsorted(times, edges[:-1], side='right')
+    hi = numpy.searchsorted(times, edges[1:], side='left')
+    hi[-1] = numpy.searchsorted(times, edges[-1], side='right')
+    first_values = values[lo - 1]
+    last_values = values[hi - 1]
+    num_transitions = hi - lo
+
+    # reduce the transitions inside the buckets by pairs of (lo, hi) bounds, one more value is
+    # appended as reduceat() requires every bound to be an index
+    padded_values = numpy.append(values, values[-1:])
+    bounds = numpy.empty(2 * len(lo), dtype=numpy.int64)
+    bounds[0::2] = lo
+    bounds[1::2] = hi
+    has_transitions = num_transitions > 0
+    min_values = numpy.where(has_transitions, numpy.minimum(
+            first_values, numpy.minimum.reduceat(padded_values, bounds)[0::2]), first_values)
+    max_values = numpy.where(has_transitions, numpy.maximum(
+            first_values, numpy.maximum.reduceat(padded_values, bounds)[0::2]), first_values)
+
+    return DecimatedSeries(edges[:-1], first_values, last_values, min_values, max_values,
+            num_transitions)
+
+
+class DecimationPyramid(object):
+    """
+    The decimated series of a pin set over the whole waveform at several resolutions. The finest
+    level splits [0, period_sec] into num_finest_buckets (a power of 2) buckets, and every level
+    after has half the buckets of the previous one.
+
+    A query for a wide window is answered by combining the buckets of the coarsest level which
+    is still finer than the requested buckets, instead of going through the transitions. The
+    result is accurate to a bucket of that level, i.e., a requested bucket covers the pyramid
+    buckets which start within it.
+    """
+
+    DEFAULT_NUM_FINEST_BUCKETS = 1 << 16
+
+    FIELDS = ['first_values', 'last_values', 'min_values', 'max_values', 'num_transitions']
+
+    def __init__(self, period_sec, pin_indexes, levels):
+        self.period_sec = period_sec
+        self.pin_indexes = list(pin_indexes)
+
+        # a list of DecimatedSeries, from the finest to a single bucket
+        self.levels = levels
+
+    @classmethod
+    def build(cls, index, period_sec, pin_indexes, num_finest_buckets=DEFAULT_NUM_FINEST_BUCKETS):
+        """
+        Params:
+          index: the TransitionIndex of the pin set
+        """
+        if period_sec <= 0.:
+            raise Exception('period_sec has to be positive')
+        if num_finest_buckets < 1 or num_finest_buckets & (num_finest_buckets - 1) != 0:
+            raise Exception('num_finest_buckets has to be a power of 2')
+
+        levels = [decimate_transitions(index.times, index.values,
+                numpy.linspace(0., period_sec, num_finest_buckets + 1))]
+        while len(levels[-1]) > 1:
+            levels.append(levels[-1]._merge_pairs())
+        return cls(period_sec, pin_indexes, levels)
+
+    def query(self, num_buckets, start_time_sec, end_time_sec):
+        """
+        Returns:
+          A DecimatedSeries of num_buckets buckets over [start_time_sec, end_time_sec], or None if
+          the finest level is too coarse for the requested buckets
+        """
+        bucket_width = (end_time_sec - start_time_sec) / num_buckets
+
+        level = None
+        for candidate in self.levels:
+            if self.period_sec / len(candidate) > bucket_width:
+                break
+            level = candidate
+        if level is None:
+            return None
+
+        # the pyramid buckets which start in the window, plus the one the window starts in
+        level_width = self.period_sec / len(level)
+        first_idx = min(int(start_time_sec / level_width), len(level) - 1)
+        end_idx = min(max(int(numpy.ceil(end_time_sec / level_width)), first_idx + 1),
+                len(level))
+        bucket_idxs = ((level.times[first_idx:end_idx] - start_time_sec) / bucket_width).astype(
+                numpy.int64)
+        bucket_idxs[0] = 0
+        numpy.clip(bucket_idxs, 0, num_buckets - 1, out=bucket_idxs)
+
+        # give up if a requested bucket gets no pyramid bucket due to rounding
+        group_starts = numpy.searchsorted(bucket_idxs, numpy.arange(num_buckets), side='left')
+        group_ends = numpy.append(group_starts[1:], len(bucket_idxs))
+        if (group_ends <= group_starts).any():
+            return None
+
+        group_starts += first_idx
+        group_ends += first_idx
+        return DecimatedSeries(
+            start_time_sec + numpy.arange(num_buckets) * bucket_width,
+            level.first_values[group_starts],
+            level.last_values[group_ends - 1],
+            numpy.minimum.reduceat(level.min_values[:end_idx], group_starts),
+            numpy.maximum.reduceat(level.max_values[:end_idx], group_starts),
+            numpy.add.reduceat(level.num_transitions[:end_idx], group_starts),
+        )
+
+
+def save_decimation_pyramids(file_path, pyramids):
+    """
+    Save the pyramids of a waveform, one per display plot, as a numpy .npz file. All the
+    pyramids have to be built with the same period and number of buckets.
+    """
+    arrays = {
+        'period_sec': numpy.array(pyramids[0].period_sec),
+        'pin_indexes': numpy.array(json.dumps([p.pin_indexes for p in pyramids])),
+    }
+    for field in DecimationPyramid.FIELDS:
+        arrays[field] = numpy.stack([numpy.concatenate(
+                [getattr(level, field) for level in p.levels]) for p in pyramids])
+    with open(file_path, 'wb') as fo:
+        numpy.savez(fo, **arrays)
+
+
+def load_decimation_pyramids(file_path):
+    """
+    Returns:
+      A list of DecimationPyramid saved by save_decimation_pyramids()
+    """
+    with numpy.load(file_path) as npz:
+        period_sec = float(npz['period_sec'])
+        all_pin_indexes = json.loads(str(npz['pin_indexes']))
+        fields = {field: npz[field] for field in DecimationPyramid.FIELDS}
+
+    # the levels are concatenated from the finest, which has (total + 1) / 2 buckets
+    num_finest_buckets = (fields['first_values'].shape[1] + 1) // 2
+    pyramids = []
+    for series_idx, pin_indexes in enumerate(all_pin_indexes):
+        levels = []
+        offset = 0
+        num_level_buckets = num_finest_buckets
+        while num_level_buckets >= 1:
+            level_fields = [fields[field][series_idx, offset:offset + num_level_buckets]
+                    for field in DecimationPyramid.FIELDS]
+            times = numpy.arange(num_level_buckets) * (period_sec / num_level_buckets)
+            levels.append(DecimatedSeries(times, *level_fields))
+            offset += num_level_buckets
+            num_level_buckets //= 2
+        pyramids.append(DecimationPyramid(period_sec, pin_indexes, levels))
+    return pyramids
+
+
+def describe_distribution(values):
+    """
+    Returns:
+      A dictionary with count, mean, std, min, max, median, p5 and p95 (the 5th and the 95th
+      percentiles) of values. All but count are None if values is empty.
+    """
+    values = numpy.asarray(values, dtype=numpy.float64)
+    if len(values) == 0:
+        return {'count': 0, 'mean': None, 'std': None, 'min': None, 'max': None,
+                'median': None, 'p5': None, 'p95': None}
+
+    p5, median, p95 = numpy.percentile(values, [5., 50., 95.]).tolist()
+    return {
+        'count': len(values),
+        'mean': float(values.mean()),
+        'std': float(values.std()),
+        'min': float(values.min()),
+        'max': float(values.max()),
+        'median': median,
+        'p5': p5,
+        'p95': p95,
+    }
+
+
+class PinComparison(object):
+    """
+    The comparison of a pin of a captured waveform against the same pin of a reference, in the
+    time of the reference. Timestamps are in seconds.
+    """
+
+    def __init__(self, pin_index, other_pin_index, mismatch_starts, mismatch_ends,
+            edge_times, edge_errors, num_extra_edges):
+        self.pin_index = pin_index
+        self.other_pin_index = other_pin_index
+
+        # the intervals longer than the tolerance where the pin values differ
+        self.mismatch_starts = mismatch_starts
+        self.mismatch_ends = mismatch_ends
+        self.mismatch_sec = float((mismatch_ends - mismatch_starts).sum())
+
+        # the reference edges and the timing errors (captured minus reference) of their closest
+        # captured edges of the same direction, NaN if there is none within the tolerance
+        self.edge_times = edge_times
+        self.edge_errors = edge_errors
+        self.num_missing_edges = int(numpy.isnan(edge_errors).sum())
+
+        # the captured edges without a reference edge of the same direction within the tolerance
+        self.num_extra_edges = num_extra_edges
+
+    def get_max_edge_error(self):
+        """
+        Returns:
+          The largest absolute timing error of the matched edges, 0 if there is none
+        """
+        errors = numpy.abs(self.edge_errors[~numpy.isnan(self.edge_errors)])
+        return float(errors.max()) if len(errors) > 0 else 0.
+
+    def to_dict(self, time_scale=1.):
+        return {
+            'pin_index': self.pin_index,
+            'other_pin_index': self.other_pin_index,
+            'mismatch_intervals': list(zip((self.mismatch_starts * time_scale).tolist(),
+                    (self.mismatch_ends * time_scale).tolist())),
+            'mismatch_time': self.mismatch_sec * time_scale,
+            'num_edges': len(self.edge_times),
+            'num_missing_edges': self.num_missing_edges,
+            'num_extra_edges': self.num_extra_edges,
+            'max_edge_error': self.get_max_edge_error() * time_scale,
+        }
+
+
+class WaveformComparison(object):
+    """
+    The result of WaveformQueryBase._compare_waveforms(), a PinComparison per compared pin.
+    """
+
+    def __init__(self, offset_sec, start_time_sec, end_time_sec, pins):
+        # a captured event at time t is compared with the reference at t - offset_sec
+        self.offset_sec = offset_sec
+
+        # the compared time range, in the time of the reference
+        self.start_time_sec = start_time_sec
+        self.end_time_sec = end_time_sec
+
+        self.pins = pins
+
+    def get_mismatch_sec(self):
+        return sum(pin.mismatch_sec for pin in self.pins)
+
+    def is_matched(self):
+        """
+        Returns:
+          True if no pin has a mismatch longer than the tolerance or a missing or extra edge
+        """
+        return all(len(pin.mismatch_starts) == 0 and pin.num_missing_edges == 0
+                and pin.num_extra_edges == 0 for pin in self.pins)
+
+    def to_dict(self, time_scale=1.):
+        """
+        Returns:
+          A dictionary of offset, start_time, end_time, mismatch_time, is_matched, and pins (a
+          list of PinComparison.to_dict()), time multiplied by time_scale
+        """
+        return {
+            'offset': self.offset_sec * time_scale,
+            'start_time': self.start_time_sec * time_scale,
+            'end_time': self.end_time_sec * time_scale,
+            'mismatch_time': self.get_mismatch_sec() * time_scale,
+            'is_matched': self.is_matched(),
+            'pins': [pin.to_dict(time_scale) for pin in self.pins],
+        }
+
+
+def get_mismatch_intervals(times, values, other_times, other_values, start_time, end_time):
+    """
+    Params:
+      times, values, other_times, other_values: the transitions of two buses, e.g.,
+          TransitionIndex, both start no later than start_time
+    Returns:
+      (starts, ends): numpy arrays of the maximal intervals within [start_time, end_time]
+          where the values of the two buses differ
+    """
+    # merge the transitions within the range, the transitions of every bus are already sorted
+    bounds = [numpy.searchsorted(t, [start_time, end_time], side=side)
+            for t in (times, other_times) for side in ('right', 'left')]
+    lo, hi = int(bounds[0][0]), int(bounds[1][1])
+    other_lo, other_hi = int(bounds[2][0]), int(bounds[3][1])
+    merged_times = numpy.concatenate((times[lo:hi], other_times[other_lo:other_hi]))
+    order = numpy.argsort(merged_times, kind='stable')
+
+    # the index of the last transition of each bus at every breakpoint, the first breakpoint
+    # is start_time
+    idxs = numpy.empty(len(order) + 1, dtype=numpy.int64)
+    other_idxs = numpy.empty(len(order) + 1, dtype=numpy.int64)
+    is_other = order >= hi - lo
+    idxs[1:] = numpy.where(is_other, -1, order + lo)
+    other_idxs[1:] = numpy.where(is_other, order - (hi - lo) + other_lo, -1)
+    idxs[0] = lo - 1
+    other_idxs[0] = other_lo - 1
+    numpy.maximum.accumulate(idxs, out=idxs)
+    numpy.maximum.accumulate(other_idxs, out=other_idxs)
+
+    # only the last breakpoint at a timestamp starts a segment
+    breakpoints = numpy.concatenate(([start_time], merged_times[order]))
+    is_segment = numpy.ones(len(breakpoints), dtype=bool)
+    numpy.not_equal(breakpoints[1:], breakpoints[:-1], out=is_segment[:-1])
+    breakpoints = breakpoints[is_segment]
+
+    # the values differ or not during every segment between two breakpoints
+    is_mismatched = numpy.zeros(len(breakpoints) + 2, dtype=numpy.int8)
+    is_mismatched[1:-1] = values[idxs[is_segment]] != other_values[other_idxs[is_segment]]
+
+    boundaries = numpy.diff(is_mismatched)
+    segment_ends = numpy.append(breakpoints[1:], end_time)
+    return (breakpoints[boundaries[:-1] == 1], segment_ends[boundaries[1:] == -1])
+
+
+def get_mismatch_time(times, values, other_times, other_values, start_time, end_time):
+    """
+    The total length of get_mismatch_intervals() without finding the intervals. Only for the
+    buses of a single pin, i.e., the values are 0 or 1.
+    """
+    # the time both pins are high is the integral of the other pin over the high segments of
+    # the pin, thus xor = high + other high - 2 * both high
+    lo = int(numpy.searchsorted(times, start_time, side='right'))
+    hi = int(numpy.searchsorted(times, end_time, side='left'))
+    points = numpy.concatenate(([start_time], times[lo:hi], [end_time]))
+    segment_values = values[lo - 1:hi].astype(numpy.float64)
+    other_integrals = _integrate_transitions(other_times, other_values, points)
+    high_time = float(numpy.dot(numpy.diff(points), segment_values))
+    both_high_time = float(numpy.dot(numpy.diff(other_integrals), segment_values))
+    other_high_time = float(other_integrals[-1] - other_integrals[0])
+    return high_time + other_high_time - 2. * both_high_time
+
+
+def _integrate_transitions(times, values, points):
+    """
+    Returns:
+      The integral of the bus value from times[0] to every point, points are sorted and not
+      before times[0]
+    """
+    cumulative = numpy.zeros(len(times))
+    numpy.cumsum(numpy.diff(times) * values[:-1], out=cumulative[1:])
+    idxs = numpy.searchsorted(times, points, side='right') - 1
+    return cumulative[idxs] + values[idxs] * (points - times[idxs])
+
+
+def match_edges(edge_times, other_edge_times, tolerance):
+    """
+    Params:
+      edge_times, other_edge_times: sorted numpy arrays of edge timestamps
+    Returns:
+      The difference between every edge and its closest other edge (other minus this), NaN if
+      there is none within the tolerance
+    """
+    errors = numpy.full(len(edge_times), numpy.nan)
+    if len(other_edge_times) == 0:
+        return errors
+
+    idxs = numpy.searchsorted(other_edge_times, edge_times)
+    after = other_edge_times[numpy.minimum(idxs, len(other_edge_times) - 1)] - edge_times
+    before = other_edge_times[numpy.maximum(idxs - 1, 0)] - edge_times
+    closest = numpy.where(numpy.abs(before) <= numpy.abs(after), before, after)
+    is_matched = numpy.abs(closest) <= tolerance
+    errors[is_matched] = closest[is_matched]
+    return errors
+
+
+def estimate_time_offset(edge_pairs, max_offset, resolution, num_candidates=8,
+        max_num_pairs=1 << 20):
+    """
+    Vote for the time offsets between two sets of edges, i.e., the differences between every
+    other edge and the edges within max_offset of it.
+
+    Params:
+      edge_pairs: a list of (edge_times, other_edge_times), e.g., the rising edges of a pin in
+          both waveforms. Only the edges in the same pair are compared.
+      resolution: the width of a vote bin
+      num_candidates: the number of bins with the most votes to return
+      max_num_pairs: the other edges are subsampled if there are more edge pairs to compare
+    Returns:
+      A list of candidate offsets (other minus this), the mean difference in each of the bins
+      with the most votes, most votes first
+    """
+    differences = []
+    for edge_times, other_edge_times in edge_pairs:
+        lo = numpy.searchsorted(edge_times, other_edge_times - max_offset, side='left')
+        hi = numpy.searchsorted(edge_times, other_edge_times + max_offset, side='right')
+        num_pairs = int((hi - lo).sum())
+        if num_pairs > max_num_pairs:
+            stride = -(-num_pairs // max_num_pairs)
+            other_edge_times, lo, hi = other_edge_times[::stride], lo[::stride], hi[::stride]
+
+        # enumerate the edges in [lo, hi) of every other edge
+        counts = hi - lo
+        other_idxs = numpy.repeat(numpy.arange(len(counts)), counts)
+        first_pair_idxs = numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        idxs = numpy.repeat(lo, counts) + numpy.arange(len(other_idxs)) - first_pair_idxs
+        differences.append(other_edge_times[other_idxs] - edge_times[idxs])
+
+    differences = numpy.concatenate(differences) if differences else numpy.empty(0)
+    if len(differences) == 0:
+        return []
+
+    bins = numpy.floor(differences / resolution).astype(numpy.int64)
+    bins -= bins.min()
+    # a bin also counts the votes of its neighbors, as an offset can fall on a bin border
+    votes = _add_neighbor_bins(numpy.bincount(bins))
+    sums = _add_neighbor_bins(numpy.bincount(bins, weights=differences))
+    top_bins = numpy.argsort(-votes, kind='stable')[:num_candidates]
+    return (sums[top_bins] / votes[top_bins]).tolist()
+
+
+def _add_neighbor_bins(counts):
+    result = counts.copy()
+    result[1:] += counts[:-1]
+    result[:-1] += counts[1:]
+    return result
+
+
+def clean_waveform_columns(waveform, period_sec):
+    """
+    This function crops the events that are beyond the specified time range, or if the specified
+    waveform is too short, the function will extend the waveform to align with the two ends of
+    the time range. That means, the first event of the cleaned waveform will be at time 0, and
+    the last one will be at time period_sec.
+
+    Boundary handling:
+      - If there is no event in data, it will be filled in a waveform of 0 from begin to the
+        end.
+      - If the waveform starts earlier than time 0, a new event at time 0 will be created. The
+        waveform value of this new event is set to whatever it has to be (the previous event
+        value). All the events before time 0 will be truncated.
+      - If the waveform starts later then time 0, a value of 0 will be filled in between time 0
+        to the original waveform start time
+      - If the waveform stops later than period_sec, the method will crop after time period_sec
+      - If the waveform stops before than period_sec, it assumes the device keeps output the
+      - same value till the end.
+
+    Params:
+      waveform: A WaveformColumns, whose events may be in any order.
+      period_sec: A real number indicating the length of the time range. The time range always
+          starts at 0.
+
+    Return:
+      A WaveformColumns, sorted by time (and by value for the events at the same time).
+    """
+
+    # We cannot continue if there is no sample points in data - we assume the device outputs
+    # 0 all the time.
+    if len(waveform) == 0:
+        return WaveformColumns([0., period_sec], [0, 0])
+
+    # make events in an ascending order. Captured waveforms are usually sorted already, which is
+    # much cheaper to check than to sort
+    times = waveform.times
+    values = waveform.values
+    if not _is_sorted_by_time_and_value(times, values):
+        order = numpy.lexsort((values, times))
+        times = times[order]
+        values = values[order]
+
+    # the events in [0, period_sec] are times[sidx:eidx], and the ones at time 0 are
+    # times[sidx:zidx]
+    sidx, zidx, eidx = (int(idx) for idx in numpy.searchsorted(
+            times, [0., numpy.nextafter(0., 1.), numpy.nextafter(period_sec, numpy.inf)]))
+    eidx = max(eidx, sidx)
+
+    # If there is an event right before time 0, then it is the waveform value at time 0. It is
+    # placed among the events at time 0 in the order by value.
+    has_early_event = sidx > 0 and period_sec >= 0.
+    # If the first event value starts later than time 0, fill in bus value 0 till the first
+    # event
+    has_zero_event = not has_early_event and eidx > sidx and times[sidx] != 0.
+    num_events = eidx - sidx + int(has_early_event) + int(has_zero_event)
+    if num_events == 0:
+        raise Exception('No event within the period')
+
+    # Add a dummy end pin value event (with the event value of the last event)
+    last_time = times[eidx - 1] if eidx > sidx else 0.
+    has_end_event = last_time < period_sec
+
+    # the events in the range can be returned as they are if no event is added
+    if not (has_early_event or has_zero_event or has_end_event):
+        return WaveformColumns(times[sidx:eidx], values[sidx:eidx])
+
+    new_times = numpy.empty(num_events + int(has_end_event), dtype=numpy.float64)
+    new_values = numpy.empty(num_events + int(has_end_event), dtype=numpy.uint32)
+    head = int(has_zero_event)
+    if has_early_event:
+        early_value = values[sidx - 1]
+        insert_idx = sidx + int(numpy.searchsorted(values[sidx:zidx], early_value, side='right'))
+        new_times[:insert_idx - sidx] = times[sidx:insert_idx]
+        new_values[:insert_idx - sidx] = values[sidx:insert_idx]
+        new_times[insert_idx - sidx] = 0.
+        new_values[insert_idx - sidx] = early_value
+        head = insert_idx - sidx + 1
+        sidx = insert_idx
+    elif has_zero_event:
+        new_times[0] = 0.
+        new_values[0] = 0
+
+    new_times[head:num_events] = times[sidx:eidx]
+    new_values[head:num_events] = values[sidx:eidx]
+    if has_end_event:
+        new_times[-1] = period_sec
+        new_values[-1] = new_values[num_events - 1]
+
+    return WaveformColumns(new_times, new_values)
+
+
+def _is_sorted_by_time_and_value(times, values):
+    time_diffs = numpy.diff(times)
+    if not (time_diffs >= 0.).all():
+        return False
+    same_time_idxs = numpy.flatnonzero(time_diffs == 0.)
+    return bool((values[same_time_idxs] <= values[same_time_idxs + 1]).all())
+
+
 class WaveformQueryBase(object):
 
+    # the maximum number of pin sets whose transition index is kept
+    TRANSITION_INDEX_CACHE_SIZE = 16
+
     def __init__(self):
         raise Exception("Does not expect to be directly instantiated ")
 
@@ -19,22 +661,7 @@ class WaveformQueryBase(object):
 
     def _clean_waveform(self, data, period_sec):
         """
-        This method crops the events that are beyond the specified time range, or if the specified
-        waveform is too short, the method will extend the waveform to align with the two ends of
-        the time range. That means, the first event of the cleaned waveform will be at time 0, and
-        the last one will be at time period_sec.
-
-        Boundary handling:
-          - If there is no event in data, it will be filled in a waveform of 0 from begin to the
-            end.
-          - If the waveform starts earlier than time 0, a new event at time 0 will be created. The
-            waveform value of this new event is set to whatever it has to be (the previous event
-            value). All the events before time 0 will be truncated.
-          - If the waveform starts later then time 0, a value of 0 will be filled in between time 0
-            to the original waveform start time
-          - If the waveform stops later than period_sec, the method will crop after time period_sec
-          - If the waveform stops before than period_sec, it assumes the device keeps output the
-          - same value till the end.
+        The list-based version of _clean_waveform_columns().
 
         Params:
           data: A list of tuples. Each tuple contains two elements, a real number indicating the
@@ -45,35 +672,13 @@ class WaveformQueryBase(object):
         Return:
           A list of tuples. Same format as data.
         """
+        return self._clean_waveform_columns(self._as_columns(data), period_sec).to_list()
 
-        # clone the data passed in
-        new_data = list(data)
-
-        # We cannot continue if there is no sample points in data - we assume the device outputs
-        # 0 all the time.
-        if len(new_data) == 0:
-            new_data = [(0.0, 0), (period_sec, 0)]
-
-        # If there is an event right before time 0, then it is the waveform value at time 0.
-        early_events = [e for e in new_data if e[0] < 0.]
-        if len(early_events) > 0:
-            target_event = max(early_events)  # the event right before time 0
-            new_data.append((0.0, target_event[1]))
-
-        # make events in an ascending order, and filter out anything not withing the range
-        new_data.sort()
-        new_data = list(filter(lambda x: 0. <= x[0] and x[0] <= period_sec, new_data))
-            
-        # If the first event value starts later than time 0, fill in bus value 0 till the first
-        # event
-        if new_data[0][0] != 0.:
-            new_data[0:0] = [(0.0, 0)]
-
-        # Add a dummy end pin value event (with the event value of the last event)
-        if new_data[-1][0] < period_sec:
-            new_data.append((period_sec, new_data[-1][1]))
-
-        return new_data
+    def _clean_waveform_columns(self, waveform, period_sec):
+        """
+        See clean_waveform_columns().
+        """
+        return clean_waveform_columns(waveform, period_sec)
 
     def _get_event_series(self, data, pin_indexes, start_time_sec=None, end_time_sec=None):
         """
@@ -84,8 +689,8 @@ class WaveformQueryBase(object):
         timestamp of the last event (theorically to be period length.)
 
         Params:
-          data: A list of tuples representing the waveform. This method assumes that data is
-              cleaned by _cleaned_waveform().
+          data: A WaveformColumns or a list of tuples representing the waveform. This method
+              assumes that data is cleaned by _cleaned_waveform().
           pin_indexes: Can be an integer or a list of integers. Representing how a new bus is
               arranged, the first element is the most significant value.
           start_time_sec: A Float number
@@ -94,41 +699,103 @@ class WaveformQueryBase(object):
           A list of (time, bus_value) representing a time series. Align with both start_time_sec
               and end_time_sec. Will filter out duplicate transitions.
         """
+        return self._get_event_series_columns(
+                self._as_columns(data), pin_indexes, start_time_sec, end_time_sec).to_list()
+
+    def _get_event_series_columns(self, waveform, pin_indexes, start_time_sec=None,
+            end_time_sec=None):
+        """
+        The same as _get_event_series(), but takes and returns a WaveformColumns.
+        """
 
         # convert pin_indexes to a list if it is an integer
         if type(pin_indexes) is int:
             pin_indexes = [pin_indexes]
 
-        start_time_sec, end_time_sec = self._refine_time_bounds(data, start_time_sec, end_time_sec)
+        # the whole waveform is answered by the transition index
+        if start_time_sec is None and end_time_sec is None:
+            index = self._get_transition_index(waveform, pin_indexes)
+            if index.times[-1] < waveform.times[-1]:
+                return WaveformColumns(numpy.concatenate((index.times, waveform.times[-1:])),
+                        numpy.concatenate((index.values, index.values[-1:])))
+            return WaveformColumns(index.times, index.values)
 
-        # get bus value based on pin configurations
-        series_data = [(t, self._rearrange_bus(pin_indexes, bus_value)) for t, bus_value in data]
+        start_time_sec, end_time_sec = self._refine_time_bounds(
+                waveform, start_time_sec, end_time_sec)
 
         # get transitions within the range
-        middle_idx_events = list(filter(
-            lambda x: start_time_sec <= x[1][0] and x[1][0] <= end_time_sec,
-            enumerate(series_data),
-        ))
-        candidate_events = [e for _, e in middle_idx_events]
+        sidx = int(numpy.searchsorted(waveform.times, start_time_sec, side='left'))
+        eidx = int(numpy.searchsorted(waveform.times, end_time_sec, side='right'))
+        return self._get_window_series(
+                waveform, pin_indexes, start_time_sec, end_time_sec, sidx, eidx)
+
+    def _get_event_series_batch(self, data, pin_indexes, time_windows_sec):
+        """
+        The batch version of _get_event_series(). The time bounds of all the windows are looked
+        up at once.
+
+        Params:
+          data: A WaveformColumns or a list of tuples representing the waveform. This method
+              assumes that data is cleaned by _cleaned_waveform().
+          pin_indexes: Can be an integer or a list of integers.
+          time_windows_sec: A list of (start_time_sec, end_time_sec), or a numpy array of shape
+              (n, 2)
+        Returns:
+          A list of WaveformColumns, one per window
+        """
+        waveform = self._as_columns(data)
+
+        # convert pin_indexes to a list if it is an integer
+        if type(pin_indexes) is int:
+            pin_indexes = [pin_indexes]
+
+        windows = numpy.asarray(time_windows_sec, dtype=numpy.float64).reshape((-1, 2))
+        start_times = numpy.maximum(windows[:, 0], waveform.times[0])
+        end_times = numpy.minimum(windows[:, 1], waveform.times[-1])
+        sidxs = numpy.searchsorted(waveform.times, start_times, side='left')
+        eidxs = numpy.searchsorted(waveform.times, end_times, side='right')
+        return [self._get_window_series(waveform, pin_indexes, start_time_sec, end_time_sec,
+                    sidx, eidx)
+                for start_time_sec, end_time_sec, sidx, eidx in zip(
+                    start_times.tolist(), end_times.tolist(), sidxs.tolist(), eidxs.tolist())]
+
+    def _get_window_series(self, waveform, pin_indexes, start_time_sec, end_time_sec, sidx, eidx):
+        """
+        Params:
+          sidx, eidx: the range of the events within [start_time_sec, end_time_sec]
+        Returns:
+          A WaveformColumns, see _get_event_series()
+        """
+        if start_time_sec > end_time_sec:
+            raise Exception('The time range is empty')
+        times = waveform.times
+
+        # Include the event before the range in case the range does not start at an event
+        bidx = max(sidx - 1, 0)
+
+        # get bus value based on pin configurations
+        bus_values = self._rearrange_bus(pin_indexes, waveform.values[bidx:eidx])
+        candidate_times = times[sidx:eidx]
+        candidate_values = bus_values[sidx - bidx:]
 
         # handle start boundary
-        sidx = middle_idx_events[0][0]
-        if sidx > 0 and candidate_events[0][0] > start_time_sec:
-            candidate_events[0:0] = [(start_time_sec, series_data[sidx - 1][1])]
+        if sidx > 0 and (len(candidate_times) == 0 or candidate_times[0] > start_time_sec):
+            candidate_times = numpy.concatenate(([start_time_sec], candidate_times))
+            candidate_values = numpy.concatenate((bus_values[:1], candidate_values))
 
         # filter out repeating transitions
-        ret_events = []
-        ret_events.append(candidate_events[0])
-        for cur_event in candidate_events[1:]:
-            t, bus_value = cur_event
-            if bus_value != ret_events[-1][1]:
-                ret_events.append(cur_event)
+        is_transition = numpy.empty(len(candidate_values), dtype=bool)
+        is_transition[:1] = True
+        numpy.not_equal(candidate_values[1:], candidate_values[:-1], out=is_transition[1:])
+        ret_times = candidate_times[is_transition]
+        ret_values = candidate_values[is_transition]
 
         # handle end boundary
-        if ret_events[-1][0] < end_time_sec:
-            ret_events.append((end_time_sec, ret_events[-1][1]))
+        if ret_times[-1] < end_time_sec:
+            ret_times = numpy.concatenate((ret_times, [end_time_sec]))
+            ret_values = numpy.concatenate((ret_values, ret_values[-1:]))
         
-        return ret_events
+        return WaveformColumns(ret_times, ret_values)
 
     def _get_rising_edge_events(self, data, pin_index, start_time_sec=None, end_time_sec=None):
         """
@@ -137,27 +804,16 @@ class WaveformQueryBase(object):
         start_time_sec and end_time_sec.
 
         Params:
-          data: A list of tuples representing the waveform. This method assumes that data is
-              cleaned by _cleaned_waveform().
+          data: A WaveformColumns or a list of tuples representing the waveform. This method
+              assumes that data is cleaned by _cleaned_waveform().
           pin_index: An integer.
           start_time_sec: A Float number
           end_time_sec: A Float number
         Returns:
           A list of real numbers representing the timestamps of all the rising edges.
         """
-
-        start_time_sec, end_time_sec = self._refine_time_bounds(data, start_time_sec, end_time_sec)
-        event_series = self._get_event_series(data, pin_index)
-        
-        # detailed_events is a list of (timestamp, prev_value, cur_value)
-        detailed_events = zip(
-                [t for t, _ in event_series[1:]],
-                [v for _, v in event_series[:-1]],
-                [v for _, v in event_series[1:]],
-        )
-
-        return [t for t, prev, cur in detailed_events
-                if start_time_sec <= t and t <= end_time_sec and prev == 0 and cur == 1]
+        return self._get_edge_times(self._as_columns(data), pin_index, True,
+                start_time_sec, end_time_sec).tolist()
 
     def _get_falling_edge_events(self, data, pin_index, start_time_sec=None, end_time_sec=None):
         """
@@ -166,35 +822,370 @@ class WaveformQueryBase(object):
         start_time_sec and end_time_sec.
 
         Params:
-          data: A list of tuples representing the waveform. This method assumes that data is
-              cleaned by _cleaned_waveform().
+          data: A WaveformColumns or a list of tuples representing the waveform. This method
+              assumes that data is cleaned by _cleaned_waveform().
           pin_index: An integer.
           start_time_sec: A Float number
           end_time_sec: A Float number
         Returns:
           A list of real numbers representing the timestamps of all the rising edges.
         """
+        return self._get_edge_times(self._as_columns(data), pin_index, False,
+                start_time_sec, end_time_sec).tolist()
 
-        start_time_sec, end_time_sec = self._refine_time_bounds(data, start_time_sec, end_time_sec)
-        event_series = self._get_event_series(data, pin_index)
-        
-        # detailed_events is a list of (timestamp, prev_value, cur_value)
-        detailed_events = zip(
-                [t for t, _ in event_series[1:]],
-                [v for _, v in event_series[:-1]],
-                [v for _, v in event_series[1:]],
-        )
+    def _get_edge_times(self, waveform, pin_index, rising, start_time_sec=None,
+            end_time_sec=None):
+        """
+        Params:
+          waveform: A WaveformColumns cleaned by _clean_waveform_columns()
+          pin_index: An integer.
+          rising: True for rising edges, False for falling edges
+        Returns:
+          A numpy array of the timestamps of the edges within the time range
+        """
+
+        start_time_sec, end_time_sec = self._refine_time_bounds(
+                waveform, start_time_sec, end_time_sec)
+
+        edge_times = self._get_transition_index(waveform, [pin_index]).get_edge_times(rising)
+        sidx = int(numpy.searchsorted(edge_times, start_time_sec, side='left'))
+        eidx = int(numpy.searchsorted(edge_times, end_time_sec, side='right'))
+        return edge_times[sidx:eidx]
+
+    def _get_pulse_widths(self, data, pin_index, high=True, start_time_sec=None,
+            end_time_sec=None):
+        """
+        Get the widths of the pulses of a certain pin whose both edges are within the specified
+        time range. We use the same definition in _get_event_series() for start_time_sec and
+        end_time_sec.
+
+        Params:
+          high: True for the high pulses (rising to falling edge), False for the low ones
+        Returns:
+          (start_times, widths): numpy arrays of the pulse start timestamps and the widths
+        """
+
+        edge_times, edge_values = self._get_edges(
+                self._as_columns(data), pin_index, start_time_sec, end_time_sec)
+
+        # the edges of a single pin alternate, thus a pulse ends at the next edge
+        start_idxs = numpy.flatnonzero(edge_values[:-1] == (1 if high else 0))
+        start_times = edge_times[start_idxs]
+        return (start_times, edge_times[start_idxs + 1] - start_times)
+
+    def _get_pulse_periods(self, data, pin_index, start_time_sec=None, end_time_sec=None):
+        """
+        Get the periods, i.e., the time between consecutive rising edges, of a certain pin within
+        the specified time range.
+
+        Returns:
+          (start_times, periods): numpy arrays of the period start timestamps and the lengths
+        """
+
+        rising_edges = self._get_edge_times(
+                self._as_columns(data), pin_index, True, start_time_sec, end_time_sec)
+        return (rising_edges[:-1], numpy.diff(rising_edges))
+
+    def _get_duty_cycles(self, data, pin_index, start_time_sec=None, end_time_sec=None):
+        """
+        Get the duty cycle of every period (see _get_pulse_periods()) of a certain pin within
+        the specified time range.
+
+        Returns:
+          (start_times, duty_cycles): numpy arrays, duty cycles are between 0 and 1, NaN for
+              the periods of zero length, i.e., glitches of several edges at the same time
+        """
+
+        start_times, periods, high_widths = self._get_pwm_cycles(
+                self._as_columns(data), pin_index, start_time_sec, end_time_sec)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            return (start_times, high_widths / periods)
+
+    def _get_pwm_statistics(self, data, pin_index, start_time_sec=None, end_time_sec=None):
+        """
+        Measure the PWM signal on a certain pin within the specified time range. Only the
+        complete periods are considered.
+
+        Returns:
+          A dictionary of
+            - num_periods: the number of complete periods
+            - frequency_hz: the number of periods divided by their total length, None if the
+                  total length is 0
+            - duty_cycle: the total high time divided by the total length of the periods, None
+                  if the total length is 0
+            - period_sec, high_width_sec, low_width_sec, duty_cycles: the distributions of the
+                  per-period measurements, see describe_distribution(). The standard deviation
+                  and the range of period_sec are the period jitter. duty_cycles leaves out the
+                  periods of zero length.
+        """
+
+        start_times, periods, high_widths = self._get_pwm_cycles(
+                self._as_columns(data), pin_index, start_time_sec, end_time_sec)
+        total_time = float(periods.sum())
+        is_positive = periods > 0.
+        return {
+            'num_periods': len(periods),
+            'frequency_hz': len(periods) / total_time if total_time > 0. else None,
+            'duty_cycle': float(high_widths.sum()) / total_time if total_time > 0. else None,
+            'period_sec': describe_distribution(periods),
+            'high_width_sec': describe_distribution(high_widths),
+            'low_width_sec': describe_distribution(periods - high_widths),
+            'duty_cycles': describe_distribution(
+                    high_widths[is_positive] / periods[is_positive]),
+        }
+
+    def _get_sliding_pwm_measurements(self, data, pin_index, window_sec, step_sec=None,
+            start_time_sec=None, end_time_sec=None):
+        """
+        Measure the PWM signal on a certain pin in windows of window_sec, one every step_sec
+        (default: window_sec), within the specified time range. A window counts the periods
+        which are entirely inside it.
+
+        Returns:
+          (window_start_times, frequencies_hz, duty_cycles, num_periods): numpy arrays, one
+              element per window. frequencies_hz and duty_cycles are NaN in the windows without
+              a complete period of non-zero length.
+        """
+
+        waveform = self._as_columns(data)
+        start_time_sec, end_time_sec = self._refine_time_bounds(
+                waveform, start_time_sec, end_time_sec)
+        if window_sec <= 0.:
+            raise Exception('window_sec has to be positive')
+        if step_sec is None:
+            step_sec = window_sec
+        if step_sec <= 0.:
+            raise Exception('step_sec has to be positive')
+
+        # tolerate the rounding error when the last window ends at end_time_sec
+        num_windows = int(numpy.floor(
+                (end_time_sec - start_time_sec - window_sec) / step_sec + 1e-9)) + 1
+        window_starts = start_time_sec + numpy.arange(max(num_windows, 0)) * step_sec
+
+        cycle_starts, periods, high_widths = self._get_pwm_cycles(
+                waveform, pin_index, start_time_sec, end_time_sec)
+        cycle_ends = cycle_starts + periods
+
+        # the periods inside a window are consecutive, thus their sums are the differences of
+        # the cumulative sums
+        first_idxs = numpy.searchsorted(cycle_starts, window_starts, side='left')
+        end_idxs = numpy.searchsorted(cycle_ends, window_starts + window_sec, side='right')
+        end_idxs = numpy.maximum(end_idxs, first_idxs)
+        period_sums = numpy.concatenate(([0.], numpy.cumsum(periods)))
+        high_width_sums = numpy.concatenate(([0.], numpy.cumsum(high_widths)))
+
+        num_periods = end_idxs - first_idxs
+        total_times = period_sums[end_idxs] - period_sums[first_idxs]
+        total_high_times = high_width_sums[end_idxs] - high_width_sums[first_idxs]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            frequencies = numpy.where(total_times > 0., num_periods / total_times, numpy.nan)
+            duty_cycles = numpy.where(total_times > 0., total_high_times / total_times, numpy.nan)
+        return (window_starts, frequencies, duty_cycles, num_periods)
+
+    def _get_pwm_cycles(self, waveform, pin_index, start_time_sec, end_time_sec):
+        """
+        Returns:
+          (start_times, periods, high_widths): numpy arrays of the complete periods, i.e., from a
+              rising edge to the next one, within the time range
+        """
+
+        edge_times, edge_values = self._get_edges(
+                waveform, pin_index, start_time_sec, end_time_sec)
+
+        # a falling edge always follows a rising edge which is not the last one
+        rising_idxs = numpy.flatnonzero(edge_values == 1)
+        start_idxs = rising_idxs[:-1]
+        start_times = edge_times[start_idxs]
+        return (start_times, numpy.diff(edge_times[rising_idxs]),
+                edge_times[start_idxs + 1] - start_times)
+
+    def _get_edges(self, waveform, pin_index, start_time_sec, end_time_sec):
+        """
+        Returns:
+          (edge_times, edge_values): numpy arrays of the edges of a certain pin within the time
+              range in event order, the values are 1 for the rising edges and 0 for the falling
+              ones. Unlike the timestamps, the order tells the edges at the same time apart.
+        """
+
+        start_time_sec, end_time_sec = self._refine_time_bounds(
+                waveform, start_time_sec, end_time_sec)
+
+        index = self._get_transition_index(waveform, [pin_index])
+        # the first transition is the initial value, not an edge
+        edge_times = index.times[1:]
+        sidx = int(numpy.searchsorted(edge_times, start_time_sec, side='left'))
+        eidx = int(numpy.searchsorted(edge_times, end_time_sec, side='right'))
+        return (edge_times[sidx:eidx], index.values[1:][sidx:eidx])
+
+    def _compare_waveforms(self, data, other_data, pin_indexes, other_pin_indexes=None,
+            tolerance_sec=0., offset_sec=0., max_offset_sec=None, start_time_sec=None,
+            end_time_sec=None):
+        """
+        Compare a captured waveform against a reference one pin by pin. The two waveforms can
+        come from readers of different formats, as long as both are cleaned and in seconds.
+
+        Params:
+          data: the reference, a WaveformColumns or a list of tuples
+          other_data: the captured waveform, a WaveformColumns or a list of tuples
+          pin_indexes: Can be an integer or a list of integers, the pins of the reference
+          other_pin_indexes: the pins of the captured waveform to compare with pin_indexes, one
+              for one. The default is pin_indexes.
+          tolerance_sec: a captured edge within tolerance_sec of a reference edge of the same
+              direction is on time, and the mismatches no longer than it are not reported
+          offset_sec: a captured event at time t is compared with the reference at
+              t - offset_sec, e.g., the known delay of the capture
+          max_offset_sec: if not None, offset_sec is replaced by the offset within
+              offset_sec +/- max_offset_sec which minimizes the fraction of mismatch time over
+              all the pins, e.g., when the capture did not start with the reference
+          start_time_sec, end_time_sec: the time range to compare, in the time of the reference.
+              By default, it is where both waveforms are defined.
+        Returns:
+          A WaveformComparison
+        """
+
+        waveform = self._as_columns(data)
+        other_waveform = self._as_columns(other_data)
+
+        # convert pin_indexes to a list if it is an integer
+        if type(pin_indexes) is int:
+            pin_indexes = [pin_indexes]
+        if other_pin_indexes is None:
+            other_pin_indexes = pin_indexes
+        elif type(other_pin_indexes) is int:
+            other_pin_indexes = [other_pin_indexes]
+        if len(other_pin_indexes) != len(pin_indexes):
+            raise Exception('pin_indexes and other_pin_indexes have different lengths')
+        if tolerance_sec < 0.:
+            raise Exception('tolerance_sec cannot be negative')
+
+        indexes = [(self._get_transition_index(waveform, [p]),
+                self._get_transition_index(other_waveform, [q]))
+                for p, q in zip(pin_indexes, other_pin_indexes)]
+
+        if max_offset_sec is not None and max_offset_sec > 0.:
+            edge_pairs = [(index.get_edge_times(rising),
+                    other_index.get_edge_times(rising) - offset_sec)
+                    for index, other_index in indexes for rising in (True, False)]
+            candidates = [offset_sec] + [offset_sec + c for c in estimate_time_offset(
+                    edge_pairs, max_offset_sec, max(tolerance_sec, max_offset_sec / 1024.))]
+
+            # the fraction instead of the total, which a smaller overlap would make shorter
+            best_fraction = None
+            for candidate in candidates:
+                start, end = self._get_comparison_range(
+                        waveform, other_waveform, candidate, start_time_sec, end_time_sec)
+                if end <= start:
+                    continue
+                mismatch_sec = sum(get_mismatch_time(index.times, index.values,
+                        other_index.times - candidate, other_index.values, start, end)
+                        for index, other_index in indexes)
+                fraction = mismatch_sec / (end - start)
+                if best_fraction is None or fraction < best_fraction:
+                    best_fraction = fraction
+                    offset_sec = candidate
+
+        start, end = self._get_comparison_range(
+                waveform, other_waveform, offset_sec, start_time_sec, end_time_sec)
+        if end <= start:
+            raise Exception('The waveforms do not overlap in the time range')
+
+        pins = []
+        for (index, other_index), pin_index, other_pin_index in zip(
+                indexes, pin_indexes, other_pin_indexes):
+            starts, ends = get_mismatch_intervals(index.times, index.values,
+                    other_index.times - offset_sec, other_index.values, start, end)
+            is_reported = ends - starts > tolerance_sec
+
+            edge_times = []
+            edge_errors = []
+            num_extra_edges = 0
+            for rising in (True, False):
+                reference_edges = self._slice_times(index.get_edge_times(rising), start, end)
+                other_edges = self._slice_times(other_index.get_edge_times(rising) - offset_sec,
+                        start - tolerance_sec, end + tolerance_sec)
+                edge_times.append(reference_edges)
+                edge_errors.append(match_edges(reference_edges, other_edges, tolerance_sec))
+
+                # the reference edges just outside the range can match the captured ones inside
+                other_edges = self._slice_times(other_edges, start, end)
+                num_extra_edges += int(numpy.isnan(match_edges(other_edges,
+                        self._slice_times(index.get_edge_times(rising),
+                            start - tolerance_sec, end + tolerance_sec),
+                        tolerance_sec)).sum())
+
+            edge_times = numpy.concatenate(edge_times)
+            order = numpy.argsort(edge_times, kind='stable')
+            pins.append(PinComparison(pin_index, other_pin_index, starts[is_reported],
+                    ends[is_reported], edge_times[order], numpy.concatenate(edge_errors)[order],
+                    num_extra_edges))
+
+        return WaveformComparison(offset_sec, start, end, pins)
+
+    def _get_comparison_range(self, waveform, other_waveform, offset_sec, start_time_sec,
+            end_time_sec):
+        """
+        Returns:
+          (start_time_sec, end_time_sec): the time range where both waveforms are defined, the
+              other one shifted by offset_sec, within the specified time range if any
+        """
+
+        start = max(float(waveform.times[0]), float(other_waveform.times[0]) - offset_sec)
+        end = min(float(waveform.times[-1]), float(other_waveform.times[-1]) - offset_sec)
+        if start_time_sec is not None:
+            start = max(start, start_time_sec)
+        if end_time_sec is not None:
+            end = min(end, end_time_sec)
+        return (start, end)
+
+    def _slice_times(self, times, start_time_sec, end_time_sec):
+        sidx = int(numpy.searchsorted(times, start_time_sec, side='left'))
+        eidx = int(numpy.searchsorted(times, end_time_sec, side='right'))
+        return times[sidx:eidx]
+
+    def _get_transition_index(self, waveform, pin_indexes):
+        """
+        Build the TransitionIndex of a pin set on first use. For the waveform of the reader,
+        i.e., self.data, the indexes of the most recently used TRANSITION_INDEX_CACHE_SIZE pin
+        sets are kept. Other waveforms, such as the WaveformColumns which the list-based methods
+        build on every call, are not cached.
+
+        Params:
+          waveform: A WaveformColumns cleaned by _clean_waveform_columns()
+          pin_indexes: A list of integers, the first element is the most significant value
+        """
+        if waveform is not getattr(self, 'data', None):
+            return self._build_transition_index(waveform, pin_indexes)
+
+        if getattr(self, '_transition_index_cache', None) is None:
+            self._transition_index_cache = collections.OrderedDict()
+        cache = self._transition_index_cache
 
-        return [t for t, prev, cur in detailed_events
-                if start_time_sec <= t and t <= end_time_sec and prev == 1 and cur == 0]
+        # self.data may be replaced, e.g., when the reader loads another file
+        key = tuple(pin_indexes)
+        if key in cache and cache[key][0] is waveform:
+            cache.move_to_end(key)
+            return cache[key][1]
+
+        index = self._build_transition_index(waveform, pin_indexes)
+        cache[key] = (waveform, index)
+        while len(cache) > self.TRANSITION_INDEX_CACHE_SIZE:
+            cache.popitem(last=False)
+        return index
+
+    def _build_transition_index(self, waveform, pin_indexes):
+        bus_values = self._rearrange_bus(pin_indexes, waveform.values)
+        is_transition = numpy.empty(len(bus_values), dtype=bool)
+        is_transition[:1] = True
+        numpy.not_equal(bus_values[1:], bus_values[:-1], out=is_transition[1:])
+        return TransitionIndex(waveform.times[is_transition], bus_values[is_transition])
     
     def _get_bus_value(self, data, pin_indexes, query_time_sec):
         """
         Get the bus value of the waveform at a certain time point.
 
         Params:
-          data: A list of tuples representing the waveform. This method assumes that data is
-              cleaned by _cleaned_waveform().
+          data: A WaveformColumns or a list of tuples representing the waveform. This method
+              assumes that data is cleaned by _cleaned_waveform().
           pin_indexes: Can be an integer or a list of integers. Representing how a new bus is
               arranged, the first element is the most significant value.
           query_time_sec: A Float number. The time point to be queried.
@@ -202,15 +1193,119 @@ class WaveformQueryBase(object):
           An integer indicating the bus value, or None if the time is beyond the bound
         """
 
-        if query_time_sec < data[0][0] or query_time_sec > data[-1][0]:
+        waveform = self._as_columns(data)
+        if query_time_sec < waveform.times[0] or query_time_sec > waveform.times[-1]:
             return None
 
         # convert pin_indexes to a list if it is an integer
         if type(pin_indexes) is int:
             pin_indexes = [pin_indexes]
 
-        idx = bisect.bisect_right(data, (query_time_sec, 1 << 32))
-        return self._rearrange_bus(pin_indexes, data[idx-1][1])
+        idx = int(numpy.searchsorted(waveform.times, query_time_sec, side='right'))
+        return self._rearrange_bus(pin_indexes, int(waveform.values[idx-1]))
+
+    def _get_bus_values(self, data, pin_indexes, query_times_sec):
+        """
+        The batch version of _get_bus_value().
+
+        Params:
+          data: A WaveformColumns or a list of tuples representing the waveform. This method
+              assumes that data is cleaned by _cleaned_waveform().
+          pin_indexes: Can be an integer or a list of integers.
+          query_times_sec: An array-like of the time points to be queried, in any order.
+        Returns:
+          A numpy array of int64 bus values, -1 for the time points beyond the bound
+        """
+
+        waveform = self._as_columns(data)
+
+        # convert pin_indexes to a list if it is an integer
+        if type(pin_indexes) is int:
+            pin_indexes = [pin_indexes]
+
+        # the value at a time point is the value of the last transition not after it
+        index = self._get_transition_index(waveform, pin_indexes)
+        query_times = numpy.asarray(query_times_sec, dtype=numpy.float64)
+        idxs = numpy.searchsorted(index.times, query_times, side='right') - 1
+        out_of_bound = (query_times < waveform.times[0]) | (query_times > waveform.times[-1])
+        idxs[out_of_bound] = 0
+
+        values = index.values[idxs].astype(numpy.int64)
+        values[out_of_bound] = -1
+        return values
+
+    def _sample_bus_values(self, data, pin_indexes, interval_sec, start_time_sec=None,
+            end_time_sec=None):
+        """
+        Sample the bus value on a uniform grid from start_time_sec to end_time_sec (inclusive if
+        it is on the grid). We use the same definition in _get_event_series() for start_time_sec
+        and end_time_sec.
+
+        Returns:
+          (times, values): numpy arrays of the grid timestamps and the bus values
+        """
+
+        waveform = self._as_columns(data)
+        start_time_sec, end_time_sec = self._refine_time_bounds(
+                waveform, start_time_sec, end_time_sec)
+        if interval_sec <= 0.:
+            raise Exception('interval_sec has to be positive')
+
+        # tolerate the rounding error when end_time_sec is on the grid
+        num_samples = int(numpy.floor((end_time_sec - start_time_sec) / interval_sec + 1e-9)) + 1
+        times = start_time_sec + numpy.arange(max(num_samples, 0)) * interval_sec
+        return (times, self._get_bus_values(waveform, pin_indexes, times))
+
+    def _get_decimated_series(self, data, pin_indexes, num_buckets, start_time_sec=None,
+            end_time_sec=None, pyramid=None):
+        """
+        Reduce the events within the specified time range to num_buckets buckets of the same
+        width, e.g., one per pixel of a plot. We use the same definition in _get_event_series()
+        for start_time_sec and end_time_sec.
+
+        Params:
+          pyramid: a DecimationPyramid of the pin set. If specified, wide windows are answered
+              by the pyramid.
+        Returns:
+          A DecimatedSeries
+        """
+
+        waveform = self._as_columns(data)
+        start_time_sec, end_time_sec = self._refine_time_bounds(
+                waveform, start_time_sec, end_time_sec)
+        if num_buckets < 1:
+            raise Exception('num_buckets has to be positive')
+        if start_time_sec >= end_time_sec:
+            raise Exception('The time range is empty')
+
+        # convert pin_indexes to a list if it is an integer
+        if type(pin_indexes) is int:
+            pin_indexes = [pin_indexes]
+
+        if pyramid is not None:
+            if pyramid.pin_indexes != list(pin_indexes):
+                raise Exception('The pyramid is built for other pins')
+            result = pyramid.query(num_buckets, start_time_sec, end_time_sec)
+            if result is not None:
+                return result
+
+        index = self._get_transition_index(waveform, pin_indexes)
+        edges = numpy.linspace(start_time_sec, end_time_sec, num_buckets + 1)
+        return decimate_transitions(index.times, index.values, edges)
+
+    def _build_decimation_pyramid(self, data, pin_indexes, period_sec,
+            num_finest_buckets=DecimationPyramid.DEFAULT_NUM_FINEST_BUCKETS):
+        """
+        Returns:
+          A DecimationPyramid of the pin set
+        """
+
+        # convert pin_indexes to a list if it is an integer
+        if type(pin_indexes) is int:
+            pin_indexes = [pin_indexes]
+
+        index = self._get_transition_index(self._as_columns(data), pin_indexes)
+        return DecimationPyramid.build(index, period_sec, pin_indexes, num_finest_buckets)
 
     ########################################################################
     #   Private helper functions. Should never be called from subclasses   #
@@ -224,7 +1319,7 @@ class WaveformQueryBase(object):
 
         Params:
           pin_indexes: a list presenting pins to be considered
-          original_bus_value: an integer
+          original_bus_value: an integer, or a numpy array of integers to rearrange all of them
         """
         ret = 0
         for i in pin_indexes:
@@ -232,6 +1327,11 @@ class WaveformQueryBase(object):
             ret |= ((original_bus_value & (1 << i)) >> i)
         return ret
 
+    def _as_columns(self, data):
+        if isinstance(data, WaveformColumns):
+            return data
+        return WaveformColumns.from_events(data)
+
     def _refine_time_bounds(self, data, start_time_sec, end_time_sec):
         """
         If start_time_sec is None or earlier than the first event, set it to the beginning
@@ -241,14 +1341,17 @@ class WaveformQueryBase(object):
           (new_start_time_sec, new_end_time_sec)
         """
 
+        first_time_sec = data[0][0]
+        last_time_sec = data[-1][0]
+
         # replace the default value
         if start_time_sec is None:
-            start_time_sec = data[0][0]
+            start_time_sec = first_time_sec
         if end_time_sec is None:
-            end_time_sec = data[-1][0]
+            end_time_sec = last_time_sec
 
         # correct the time bounds if they are not correctly set
-        start_time_sec = max(data[0][0], start_time_sec)
-        end_time_sec = min(data[-1][0], end_time_sec)
+        start_time_sec = max(first_time_sec, start_time_sec)
+        end_time_sec = min(last_time_sec, end_time_sec)
         
         return (start_time_sec, end_time_sec)
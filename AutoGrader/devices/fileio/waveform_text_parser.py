@@ -0,0 +1,97 @@
+import io
+import re
+
+import numpy
+
+
+"""
+Vectorized parsing of the waveform section of the text waveform files, i.e., the comma-separated
+rows after the "==" line. The readers try this first and fall back to their line-by-line parser
+if it raises, so it only has to accept a subset of what the line-by-line parser accepts: every
+row must have exactly the expected columns, and blank rows are rejected.
+"""
+
+_SEPARATOR_LINE_PATTERN = re.compile(rb'^==[^\n]*(\n|$)', re.M)
+_BLANK_LINE_PATTERN = re.compile(rb'\n[ \t\r\x0b\x0c]*\n')
+_WHITESPACE = b' \t\n\r\x0b\x0c'
+
+
+def find_waveform_section(raw_content, num_skipped_lines=0):
+    """
+    Params:
+      raw_content: the file content in bytes
+      num_skipped_lines: the number of lines between the "==" line and the waveform, e.g., the
+          column names
+    Return:
+      (header_end, data_start)
+        - header_end: the offset right after the "==" line
+        - data_start: the offset of the first row of the waveform
+    """
+    matches = _SEPARATOR_LINE_PATTERN.search(raw_content)
+    if not matches:
+        raise Exception('No "==" line')
+    header_end = data_start = matches.end()
+    for _ in range(num_skipped_lines):
+        line_end = raw_content.find(b'\n', data_start)
+        data_start = len(raw_content) if line_end == -1 else line_end + 1
+    return (header_end, data_start)
+
+
+def load_columns(raw_content, data_start, dtype):
+    """
+    Params:
+      raw_content: the file content in bytes
+      data_start: the offset of the first row
+      dtype: a structured numpy dtype with one field per column
+    Return:
+      A numpy structured array, one element per row
+    """
+    # trailing whitespace is ignored as the line-by-line parsers strip the content
+    data_end = len(raw_content)
+    while data_end > data_start and raw_content[data_end - 1] in _WHITESPACE:
+        data_end -= 1
+    if data_end == data_start:
+        raise Exception('No waveform data')
+
+    # the line-by-line parsers reject blank rows, which numpy.loadtxt() would skip
+    if _BLANK_LINE_PATTERN.search(raw_content, max(data_start - 1, 0), data_end) is not None:
+        raise Exception('Blank row in waveform data')
+
+    stream = io.BytesIO(raw_content)
+    stream.seek(data_start)
+    return numpy.loadtxt(stream, delimiter=',', dtype=dtype, comments=None, ndmin=1)
+
+
+def parse_hex(tokens):
+    """
+    Params:
+      tokens: a list or a numpy array of hexadecimal numbers in bytes, at most 8 digits.
+          Surrounding whitespace is ignored.
+    Return:
+      A numpy array of uint32
+    """
+    digits = numpy.char.strip(numpy.asarray(tokens, dtype=bytes))
+    lengths = numpy.char.str_len(digits)
+    if len(digits) > 0 and lengths.max() > 8:
+        raise Exception('Hexadecimal value is too long')
+    if (lengths == 0).any():
+        raise Exception('Empty hexadecimal value')
+    chars = digits.view(numpy.uint8).reshape((len(digits), digits.dtype.itemsize))
+    nibbles = _HEX_DIGIT_VALUES[chars]
+    if (nibbles == -1).any():
+        raise Exception('Invalid hexadecimal value')
+
+    # shorter tokens are padded with zero bytes, which have to be skipped
+    values = numpy.zeros(len(digits), dtype=numpy.uint32)
+    for col in range(min(chars.shape[1], 8)):
+        is_digit = chars[:, col] != 0
+        values[is_digit] = values[is_digit] * 16 + nibbles[is_digit, col].astype(numpy.uint32)
+    return values
+
+
+_HEX_DIGIT_VALUES = numpy.full(256, -1, dtype=numpy.int8)
+_HEX_DIGIT_VALUES[0] = 0
+for _i, _c in enumerate(b'0123456789abcdef'):
+    _HEX_DIGIT_VALUES[_c] = _i
+for _i, _c in enumerate(b'ABCDEF'):
+    _HEX_DIGIT_VALUES[_c] = 10 + _i
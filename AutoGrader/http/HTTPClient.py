@@ -11,13 +11,15 @@ class HTTPClient(object):
         self.remote_http = 'http%s://%s%s' % (http_s, remote_host, port_prefix)
         self.report_listening_port = server_listening_port
 
-    def send_tb_summary(self, testbed_type, status):
+    def send_tb_summary(self, testbed_type, status, queue_length=0, estimated_wait_sec=0.):
         try:
             r = requests.post(self.remote_http + '/tb/send-summary/',
                     data={
                             'localport': self.report_listening_port,
                             'testbed_type': testbed_type,
                             'status': status,
+                            'queue_length': queue_length,
+                            'estimated_wait_sec': '%.1f' % estimated_wait_sec,
                     },
                     headers={'content-type': "application/x-www-form-urlencoded"},
                     timeout=1.0,
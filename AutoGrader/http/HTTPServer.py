@@ -62,6 +62,7 @@ class HTTPServer(object):
         if self.hardware_engine.request_grade_task(input_files, secret_code, execution_time):
             return "Will grade assignment"
         else:
+            print('HTTPServer: Error: task queue is full')
             request.setResponseCode(400)
             return "Abort"
             
@@ -184,5 +185,9 @@ class HTTPServer(object):
             return "ERROR_NOHARDWARE"
         else:
             print('Tester status requested')
+            # queue info is reported in headers so that the body stays a plain status string
+            request.setHeader('X-Queue-Length', str(self.hardware_engine.get_queue_length()))
+            request.setHeader('X-Estimated-Wait-Sec',
+                    '%.1f' % self.hardware_engine.get_estimated_wait_sec())
             return self.hardware_engine.get_status()
 
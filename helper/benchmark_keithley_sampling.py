@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of the Keithley2602A sampling engine against a local fake TSP server. The fake server
+accepts the same commands as the on-board script ("TSB_Script.run()" and "measure()"), serves
+requests one at a time with a fixed service time, and delays every reply by a network round
+trip time. It reports the sample rate and the jitter of the sample intervals for the original
+synchronous loop and for the current engine with several configurations.
+
+Usage: ./benchmark_keithley_sampling.py [duration_sec]
+       ./benchmark_keithley_sampling.py --serve port   (run the fake server only)
+"""
+
+import os
+import sys
+import time
+import heapq
+import types
+import socket
+import threading
+import tempfile
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from AutoGrader.TaskClock import TaskClock
+from AutoGrader.devices.Keithley2602A import Keithley2602A
+
+
+class FakeTSPServer(object):
+    def __init__(self, port=0, service_time_sec=0.0005, rtt_sec=0.002, sensing_time_sec=0.001,
+            power_watt=0.05):
+        self.service_time_sec = service_time_sec
+        self.rtt_sec = rtt_sec
+        self.reply = b'1\t%f\t%f\n' % (sensing_time_sec, power_watt * sensing_time_sec)
+
+        self.server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_sock.bind(('127.0.0.1', port))
+        self.server_sock.listen(1)
+        self.port = self.server_sock.getsockname()[1]
+
+    def start(self):
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            conn, _ = self.server_sock.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._handle_connection(conn)
+
+    def _handle_connection(self, conn):
+        due_replies = []  # heap of reply times
+        lock = threading.Condition()
+        closed = [False]
+
+        def sender():
+            while True:
+                with lock:
+                    while not due_replies and not closed[0]:
+                        lock.wait()
+                    if closed[0]:
+                        return
+                    due_time = due_replies[0]
+                wait_sec = due_time - time.monotonic()
+                if wait_sec > 0:
+                    time.sleep(wait_sec)
+                with lock:
+                    heapq.heappop(due_replies)
+                try:
+                    conn.send(self.reply)
+                except OSError:
+                    return
+
+        threading.Thread(target=sender, daemon=True).start()
+
+        buf = b''
+        last_done_time = 0.
+        while True:
+            try:
+                data = conn.recv(4096)
+            except OSError:
+                data = b''
+            if not data:
+                break
+            buf += data
+            lines = buf.split(b'\n')
+            buf = lines.pop()
+            now = time.monotonic()
+            for line in lines:
+                if line.strip() != b'measure()':
+                    continue
+                # requests are served in order, one at a time
+                last_done_time = max(now + self.rtt_sec / 2., last_done_time) \
+                        + self.service_time_sec
+                with lock:
+                    heapq.heappush(due_replies, last_done_time + self.rtt_sec / 2.)
+                    lock.notify()
+        with lock:
+            closed[0] = True
+            lock.notify()
+        conn.close()
+
+
+def legacy_execute(keithley):
+    # the synchronous loop before the sampling engine, without printing
+    keithley.sock.settimeout(None)
+    while keithley.is_running:
+        keithley.sock.send(b"measure()\n")
+        buf = keithley.sock.recv(4096)
+        for line in buf.decode('ascii').strip().split('\n'):
+            _, sensing_time, energy = tuple(map(float, line.split('\t')))
+            keithley._record_samples([(0., sensing_time, energy)],
+                    keithley.hardware_engine.task_clock.get_time_sec())
+
+
+def run(label, port, duration_sec, execute=None, **config):
+    out_file = tempfile.NamedTemporaryFile(delete=False)
+    out_file.close()
+    file_folder, file_name = os.path.split(out_file.name)
+    config.update({'host': '127.0.0.1', 'port': port, 'output_energy_file': file_name})
+    hardware_engine = types.SimpleNamespace(task_clock=TaskClock())
+    keithley = Keithley2602A('benchmark', config, hardware_engine, file_folder)
+    keithley.on_before_execution()
+    if execute is None:
+        execute = Keithley2602A.on_execute
+    else:
+        keithley.measurement_done.set()
+    keithley._reset_trace()
+
+    thread = threading.Thread(target=execute, args=(keithley,))
+    thread.start()
+    time.sleep(duration_sec)
+    sys.stdout = open(os.devnull, 'w')
+    keithley.on_terminate()
+    sys.stdout = sys.__stdout__
+    thread.join()
+    keithley.on_reset_after_execution()
+    os.remove(out_file.name)
+
+    ages = keithley.energy_trace.get()[:, 0]
+    intervals_ms = numpy.diff(ages) * 1000.
+    print('%-26s %9.1f samples/sec  interval %7.3f ms  jitter(std) %7.3f ms  p99 %7.3f ms' % (
+        label, len(ages) / duration_sec, intervals_ms.mean(), intervals_ms.std(),
+        numpy.percentile(intervals_ms, 99)))
+
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == '--serve':
+        server = FakeTSPServer(port=int(sys.argv[2]))
+        print('Fake TSP server listening on port %d' % server.port)
+        server._serve()
+        return
+
+    duration_sec = float(sys.argv[1]) if len(sys.argv) > 1 else 3.
+    server = FakeTSPServer()
+    server.start()
+    print('service time %.2f ms, round trip time %.2f ms' % (
+        server.service_time_sec * 1000., server.rtt_sec * 1000.))
+    run('legacy synchronous', server.port, duration_sec, execute=legacy_execute)
+    run('pipeline depth 1', server.port, duration_sec, pipeline_depth=1)
+    run('pipeline depth 4', server.port, duration_sec, pipeline_depth=4)
+    run('pipeline depth 4, 500 Hz', server.port, duration_sec, pipeline_depth=4,
+            sample_rate_hz=500)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+"""
+Micro-benchmark of Mbed._read_serial against a pty-backed fake serial port. A writer thread
+pushes bytes into the master side of a pty as fast as the pty accepts them, and the capture
+loop reads from the slave side through pyserial. It reports the capture rate and the CPU time
+spent by the reading thread per MB, for the original byte-by-byte loop and the current one.
+
+Usage: ./benchmark_mbed_serial_capture.py [num_mb]
+"""
+
+import os
+import sys
+import time
+import threading
+import tempfile
+
+import serial
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from AutoGrader.devices.Mbed import Mbed
+from AutoGrader.devices.TerminationCondition import create_termination_conditions
+
+
+def legacy_read_serial(mbed):
+    # the byte-by-byte loop before the capture path was batched
+    while mbed.alive:
+        b = mbed.dev.read(1)
+        if not b:
+            continue
+
+        if mbed.byte_written < mbed.log_size:
+            mbed.byte_written += 1
+            mbed.f_serial.write(b)
+            mbed.f_serial.flush()
+
+
+def run(read_func, num_bytes):
+    master_fd, slave_fd = os.openpty()
+    dev = serial.Serial(os.ttyname(slave_fd), baudrate=115200, timeout=0.01)
+
+    # build an Mbed instance without touching the board
+    mbed = Mbed.__new__(Mbed)
+    mbed.name = 'benchmark'
+    mbed.dev = dev
+    mbed.log_size = num_bytes
+    mbed.byte_written = 0
+    mbed.alive = True
+    mbed.termination_conditions = create_termination_conditions([])
+    out_file = tempfile.NamedTemporaryFile(delete=False)
+    mbed.f_serial = out_file
+
+    payload = (b'student output line %d\n' * 64) % tuple(range(64))
+
+    def writer():
+        sent = 0
+        while sent < num_bytes:
+            sent += os.write(master_fd, payload[:num_bytes - sent])
+
+    cpu_time = [0.]
+
+    def reader():
+        start_cpu = time.thread_time()
+        read_func(mbed)
+        cpu_time[0] = time.thread_time() - start_cpu
+
+    reader_thread = threading.Thread(target=reader)
+    reader_thread.start()
+    start_time = time.time()
+    threading.Thread(target=writer, daemon=True).start()
+    while mbed.byte_written < num_bytes:
+        time.sleep(0.01)
+    elapsed_time = time.time() - start_time
+    mbed.alive = False
+    reader_thread.join()
+
+    for f in [dev, out_file]:
+        try:
+            f.close()
+        except Exception:
+            pass
+    os.close(master_fd)
+    os.close(slave_fd)
+    os.remove(out_file.name)
+
+    mb = num_bytes / 1e6
+    return (num_bytes / elapsed_time, cpu_time[0] / mb)
+
+
+def main():
+    num_mb = float(sys.argv[1]) if len(sys.argv) > 1 else 1.
+    num_bytes = int(num_mb * 1e6)
+    for label, func in [('byte-by-byte', legacy_read_serial), ('batched', Mbed._read_serial)]:
+        rate, cpu_per_mb = run(func, num_bytes)
+        print('%-14s %12.0f bytes/sec %10.3f CPU sec/MB' % (label, rate, cpu_per_mb))
+
+
+if __name__ == '__main__':
+    main()
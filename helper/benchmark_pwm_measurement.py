@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of the PWM measurements of WaveformQueryBase on a synthetic 5-minute capture of a
+1 kHz PWM signal with jitter. It compares them with the loops a grader used to write over the
+rising and falling edge lists, and checks that both get the same results.
+
+Usage: ./benchmark_pwm_measurement.py [frequency_hz] [duration_sec]
+"""
+
+import os
+import sys
+import time
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from AutoGrader.devices.fileio.waveform_query_base import WaveformQueryBase, WaveformColumns
+
+
+class Waveform(WaveformQueryBase):
+    def __init__(self, times, values, period_sec):
+        self.period_sec = period_sec
+        self.data = self._clean_waveform_columns(WaveformColumns(times, values), period_sec)
+
+
+def make_pwm_waveform(frequency_hz, duration_sec):
+    # pin 0 is the PWM output with jittered periods and a slowly changing duty cycle, pin 1
+    # toggles independently
+    random_state = numpy.random.RandomState(0)
+    num_periods = int(duration_sec * frequency_hz)
+    periods = (1. / frequency_hz) * (1. + random_state.normal(0., 0.01, num_periods))
+    rising_times = numpy.concatenate(([0.], numpy.cumsum(periods)[:-1]))
+    duty_cycles = 0.5 + 0.3 * numpy.sin(rising_times * 0.1)
+    falling_times = rising_times + periods * duty_cycles
+
+    times = numpy.empty(2 * num_periods)
+    times[0::2] = rising_times
+    times[1::2] = falling_times
+    values = numpy.empty(2 * num_periods, dtype=numpy.uint32)
+    values[0::2] = 1
+    values[1::2] = 0
+    values |= (random_state.rand(2 * num_periods) < 0.5).astype(numpy.uint32) << 1
+    return Waveform(times, values, duration_sec)
+
+
+def legacy_pwm_statistics(waveform, pin_index):
+    rising_edges = waveform._get_rising_edge_events(waveform.data, pin_index)
+    falling_edges = waveform._get_falling_edge_events(waveform.data, pin_index)
+    periods = []
+    duty_cycles = []
+    falling_idx = 0
+    for i in range(len(rising_edges) - 1):
+        while falling_edges[falling_idx] < rising_edges[i]:
+            falling_idx += 1
+        period = rising_edges[i + 1] - rising_edges[i]
+        periods.append(period)
+        duty_cycles.append((falling_edges[falling_idx] - rising_edges[i]) / period)
+    mean_period = sum(periods) / len(periods)
+    jitter = (sum((p - mean_period) ** 2 for p in periods) / len(periods)) ** 0.5
+    return (1. / mean_period, sum(duty_cycles) / len(duty_cycles), jitter)
+
+
+def measure(label, func, repeat):
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    elapsed_ms = (time.perf_counter() - start_time) / repeat * 1000.
+    print('  %-44s %10.3f ms' % (label, elapsed_ms))
+    return result
+
+
+def main():
+    frequency_hz = float(sys.argv[1]) if len(sys.argv) > 1 else 1000.
+    duration_sec = float(sys.argv[2]) if len(sys.argv) > 2 else 300.
+
+    waveform = make_pwm_waveform(frequency_hz, duration_sec)
+    print('%d events, %.0f Hz, %.0f sec' % (len(waveform.data), frequency_hz, duration_sec))
+
+    legacy = measure('legacy loops over edge lists', lambda: legacy_pwm_statistics(
+            waveform, 0), 1)
+
+    def cold_statistics():
+        waveform._transition_index_cache = None
+        return waveform._get_pwm_statistics(waveform.data, 0)
+
+    stats = measure('statistics, building the pin index', cold_statistics, 3)
+    measure('statistics', lambda: waveform._get_pwm_statistics(waveform.data, 0), 10)
+    measure('pulse widths', lambda: waveform._get_pulse_widths(waveform.data, 0), 10)
+    measure('sliding, 1 sec windows every 100 ms', lambda: waveform._get_sliding_pwm_measurements(
+            waveform.data, 0, 1., 0.1), 10)
+
+    print('frequency %.6f Hz (legacy %.6f), duty cycle %.6f (legacy mean %.6f), '
+            'jitter %.3e sec (legacy %.3e)' % (
+            stats['frequency_hz'], legacy[0], stats['duty_cycles']['mean'], legacy[1],
+            stats['period_sec']['std'], legacy[2]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+"""
+Replay benchmark of the STM32 packet decoder. A byte stream, either recorded from the tester
+or synthesized with occasional corrupted bytes, is fed in the chunk size one UART read would
+return every 10 ms at 460800 baud. It compares the original per-packet loop with
+STM32PacketDecoder, and reports the throughput as a multiple of real time.
+
+Usage: ./benchmark_stm32_packet_decoder.py [recorded_stream_file]
+"""
+
+import os
+import sys
+import time
+import random
+import struct
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from AutoGrader.devices.STM32 import STM32
+from AutoGrader.devices.STM32PacketDecoder import STM32PacketDecoder
+
+BAUD_RATE = 460800
+BYTES_PER_SEC = BAUD_RATE / 10  # 8N1 framing
+READ_INTERVAL_SEC = 0.01
+
+
+def synthesize_stream(num_packets, corruption_interval=1000):
+    random.seed(0)
+    chunks = []
+    for i in range(num_packets):
+        pkt = struct.pack('=ccIHc', STM32.START_DELIM, b'D', i * 10, random.randrange(1 << 16),
+                STM32.STOP_DELIM)
+        if corruption_interval and i % corruption_interval == corruption_interval - 1:
+            pkt = pkt[1:]  # lose a byte
+        chunks.append(pkt)
+    return b''.join(chunks)
+
+
+def legacy_decode(chunks):
+    # the original _reading_thread loop, without printing
+    num_packets = 0
+    num_bad_frames = 0
+    rx_buffer = b''
+    for chunk in chunks:
+        rx_buffer += chunk
+        while len(rx_buffer) >= STM32.TOTAL_PKT_LEN:
+            if rx_buffer[0:1] == STM32.START_DELIM and rx_buffer[8:9] == STM32.STOP_DELIM:
+                struct.unpack('<cLH', rx_buffer[1:8])
+                num_packets += 1
+            else:
+                num_bad_frames += 1
+            rx_buffer = rx_buffer[9:]
+    return {'decoded_packets': num_packets, 'bad_frames': num_bad_frames}
+
+
+def decoder_decode(chunks):
+    decoder = STM32PacketDecoder(STM32.PACKET_DTYPE, STM32.START_DELIM, STM32.STOP_DELIM)
+    for chunk in chunks:
+        decoder.feed(chunk)
+    return decoder.get_stats()
+
+
+def run(stream):
+    chunk_size = int(BYTES_PER_SEC * READ_INTERVAL_SEC)
+    chunks = [stream[i:i+chunk_size] for i in range(0, len(stream), chunk_size)]
+    stream_duration_sec = len(stream) / BYTES_PER_SEC
+    print('%d bytes in %d chunks of %d bytes, %.1f sec at %d baud' % (
+        len(stream), len(chunks), chunk_size, stream_duration_sec, BAUD_RATE))
+
+    for label, func in [('legacy', legacy_decode), ('decoder', decoder_decode)]:
+        start_time = time.perf_counter()
+        stats = func(chunks)
+        elapsed_sec = time.perf_counter() - start_time
+        print('  %-8s %8.3f sec %8.1fx real time  %s' % (
+            label, elapsed_sec, stream_duration_sec / elapsed_sec, stats))
+
+
+def main():
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'rb') as f:
+            run(f.read())
+    else:
+        print('clean stream:')
+        run(synthesize_stream(200000, corruption_interval=None))
+        print('stream with a lost byte every 1000 packets:')
+        run(synthesize_stream(200000, corruption_interval=1000))
+
+
+if __name__ == '__main__':
+    main()
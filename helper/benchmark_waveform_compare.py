@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of WaveformQueryBase._compare_waveforms() on a synthetic reference waveform and a
+capture of it, shifted by an unknown offset, with timing jitter and a few glitches. It compares
+it with the loop a grader used to write, which walks both event lists to add up the mismatch
+time of every pin, and checks that both get the same mismatch when the offset is known.
+
+Usage: ./benchmark_waveform_compare.py [num_events] [num_pins]
+"""
+
+import os
+import sys
+import time
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from AutoGrader.devices.fileio.waveform_query_base import WaveformQueryBase, WaveformColumns
+
+
+class Waveform(WaveformQueryBase):
+    def __init__(self, times, values, period_sec):
+        self.period_sec = period_sec
+        self.data = self._clean_waveform_columns(WaveformColumns(times, values), period_sec)
+
+
+def make_waveforms(num_events, num_pins, offset_sec, jitter_sec, num_glitches):
+    random_state = numpy.random.RandomState(0)
+    period_sec = 300.
+    times = numpy.cumsum(random_state.uniform(0.1, 1.9, num_events)) * (
+            period_sec / (num_events + 1))
+    values = random_state.randint(0, 1 << num_pins, num_events).astype(numpy.uint32)
+    reference = Waveform(times, values, period_sec)
+
+    captured_times = times + offset_sec + random_state.uniform(-jitter_sec, jitter_sec, num_events)
+    captured_values = values.copy()
+    glitch_idxs = random_state.randint(0, num_events, num_glitches)
+    captured_values[glitch_idxs] ^= 1
+    keep = captured_times >= 0.
+    capture = Waveform(captured_times[keep], captured_values[keep], period_sec + 1.)
+    return (reference, capture)
+
+
+def legacy_mismatch_sec(reference, capture, pin_indexes, offset_sec, start_time_sec,
+        end_time_sec):
+    events = [(t, 0, v) for t, v in reference.data] + [
+            (t - offset_sec, 1, v) for t, v in capture.data]
+    events.sort()
+    total = 0.
+    for pin_index in pin_indexes:
+        current = [None, None]
+        last_time = start_time_sec
+        for t, source, value in events:
+            t = min(max(t, start_time_sec), end_time_sec)
+            if current[0] is not None and current[1] is not None and current[0] != current[1]:
+                total += t - last_time
+            last_time = t
+            current[source] = (value >> pin_index) & 1
+        if current[0] != current[1]:
+            total += end_time_sec - last_time
+    return total
+
+
+def measure(label, func, repeat):
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    elapsed_ms = (time.perf_counter() - start_time) / repeat * 1000.
+    print('  %-44s %10.3f ms' % (label, elapsed_ms))
+    return result
+
+
+def main():
+    num_events = int(sys.argv[1]) if len(sys.argv) > 1 else 600000
+    num_pins = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    offset_sec = 0.0123
+    reference, capture = make_waveforms(num_events, num_pins, offset_sec, 2e-6, 10)
+    pin_indexes = list(range(num_pins))
+    print('%d events, %d pins' % (len(reference.data), num_pins))
+
+    aligned = measure('offset known', lambda: reference._compare_waveforms(
+            reference.data, capture.data, pin_indexes, tolerance_sec=1e-5,
+            offset_sec=offset_sec), 3)
+    searched = measure('best-fit offset within 50 ms', lambda: reference._compare_waveforms(
+            reference.data, capture.data, pin_indexes, tolerance_sec=1e-5,
+            max_offset_sec=0.05), 3)
+
+    # the comparison leaves out the mismatches within the tolerance, the loop does not
+    raw = reference._compare_waveforms(
+            reference.data, capture.data, pin_indexes, offset_sec=offset_sec)
+    legacy = measure('legacy loop over both event lists', lambda: legacy_mismatch_sec(
+            reference, capture, pin_indexes, offset_sec, raw.start_time_sec,
+            raw.end_time_sec), 1)
+
+    print('best-fit offset %.9f sec (actual %.9f), mismatch beyond the tolerance %.6f sec, '
+            'raw mismatch %.9f sec (legacy %.9f), missing/extra edges %s' % (
+            searched.offset_sec, offset_sec, searched.get_mismatch_sec(),
+            raw.get_mismatch_sec(), legacy,
+            [(pin.num_missing_edges, pin.num_extra_edges) for pin in aligned.pins]))
+
+
+if __name__ == '__main__':
+    main()
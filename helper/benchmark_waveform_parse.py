@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of parsing the STM32 and Logic Saleae text waveform files. It compares the vectorized
+parser which the readers try first with the line-by-line parser, and reports the parse time and
+the peak memory allocated during parsing.
+
+Usage: ./benchmark_waveform_parse.py [num_events]
+"""
+
+import os
+import sys
+import time
+import random
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from AutoGrader.devices.fileio.stm32_waveform_file_reader import STM32WaveformFileReader
+from AutoGrader.devices.fileio.logic_saleae_waveform_file_reader import LogicSaleaeWaveformFileReader
+
+
+def make_stm32_content(num_events):
+    tick_frequency = 5000
+    times = sorted(random.randrange(num_events * 10) for _ in range(num_events))
+    rows = ['68, %d, %d' % (t, random.randrange(16)) for t in times]
+    return ('Period: %f\nTick frequency: %f\nDisplay start\nCTL,0\nVAL,3,2,1\nDisplay end\n==\n'
+            % (num_events * 10 / tick_frequency, tick_frequency) + '\n'.join(rows)).encode('ascii')
+
+
+def make_logic_saleae_content(num_events):
+    times = sorted(random.uniform(0., 100.) for _ in range(num_events))
+    rows = ['%.15f, %x' % (t, random.randrange(256)) for t in times]
+    return ('Period: 100\nDisplay start\nCTL,0\nVAL,7,6,5,4\nDisplay end\n==\nTime[s], Data[Hex]\n'
+            + '\n'.join(rows)).encode('ascii')
+
+
+def measure(label, func):
+    start_time = time.perf_counter()
+    func()
+    elapsed_sec = time.perf_counter() - start_time
+
+    # tracing slows down the parsers, thus the peak memory is measured by a separate run
+    tracemalloc.start()
+    func()
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('  %-28s %8.3f sec %10.1f MB' % (label, elapsed_sec, peak_bytes / 1e6))
+
+
+def parse_line_by_line(reader_class, raw_content):
+    reader = reader_class.__new__(reader_class)
+    reader._initialize_instance_variables()
+    if not reader._parse_content(raw_content.decode('ascii')):
+        raise Exception('Failed to parse')
+
+
+def parse_fast(reader_class, raw_content):
+    reader = reader_class.__new__(reader_class)
+    reader._initialize_instance_variables()
+    if not reader._parse_content_fast(raw_content):
+        raise Exception('Failed to parse')
+
+
+def main():
+    num_events = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    random.seed(0)
+
+    for reader_class, make_content in [
+            (STM32WaveformFileReader, make_stm32_content),
+            (LogicSaleaeWaveformFileReader, make_logic_saleae_content),
+    ]:
+        raw_content = make_content(num_events)
+        print('%s, %d events, %.1f MB:' % (
+                reader_class.__name__, num_events, len(raw_content) / 1e6))
+        measure('line by line', lambda: parse_line_by_line(reader_class, raw_content))
+        measure('vectorized', lambda: parse_fast(reader_class, raw_content))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of the WaveformQueryBase queries on a large synthetic waveform, as grading scripts
+query the same waveform many times. It compares the list-of-tuples implementation before the
+columnar storage with the current one. Edge queries are answered by a per-pin index, which is
+built by the first query on a pin. The batched queries are compared with issuing the same
+queries one by one.
+
+Usage: ./benchmark_waveform_query.py [num_events]
+"""
+
+import os
+import sys
+import time
+import random
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from AutoGrader.devices.fileio.waveform_query_base import WaveformQueryBase, WaveformColumns
+
+
+class Waveform(WaveformQueryBase):
+    def __init__(self, events, period_sec):
+        self.period_sec = period_sec
+        self.data = self._clean_waveform_columns(WaveformColumns.from_events(events), period_sec)
+
+
+def legacy_get_event_series(query, data, pin_indexes, start_time_sec, end_time_sec):
+    # _get_event_series() before the columnar storage
+    series_data = [(t, query._rearrange_bus(pin_indexes, v)) for t, v in data]
+    middle_idx_events = list(filter(
+        lambda x: start_time_sec <= x[1][0] and x[1][0] <= end_time_sec,
+        enumerate(series_data),
+    ))
+    candidate_events = [e for _, e in middle_idx_events]
+    sidx = middle_idx_events[0][0]
+    if sidx > 0 and candidate_events[0][0] > start_time_sec:
+        candidate_events[0:0] = [(start_time_sec, series_data[sidx - 1][1])]
+    ret_events = [candidate_events[0]]
+    for cur_event in candidate_events[1:]:
+        if cur_event[1] != ret_events[-1][1]:
+            ret_events.append(cur_event)
+    if ret_events[-1][0] < end_time_sec:
+        ret_events.append((end_time_sec, ret_events[-1][1]))
+    return ret_events
+
+
+def legacy_get_rising_edge_events(query, data, pin_index, start_time_sec, end_time_sec):
+    event_series = legacy_get_event_series(query, data, [pin_index], data[0][0], data[-1][0])
+    detailed_events = zip(
+            [t for t, _ in event_series[1:]],
+            [v for _, v in event_series[:-1]],
+            [v for _, v in event_series[1:]],
+    )
+    return [t for t, prev, cur in detailed_events
+            if start_time_sec <= t and t <= end_time_sec and prev == 0 and cur == 1]
+
+
+def measure(label, func, repeat):
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    elapsed_ms = (time.perf_counter() - start_time) / repeat * 1000.
+    print('  %-44s %10.3f ms' % (label, elapsed_ms))
+
+
+def main():
+    num_events = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    period_sec = 100.
+    random.seed(0)
+    times = sorted(random.uniform(0., period_sec) for _ in range(num_events))
+    events = [(t, random.randrange(16)) for t in times]
+
+    start_time = time.perf_counter()
+    waveform = Waveform(events, period_sec)
+    print('%d events, cleaned in %.3f sec' % (num_events, time.perf_counter() - start_time))
+    legacy_data = waveform.data.to_list()
+
+    window = (50., 50.01)
+    print('legacy list of tuples:')
+    measure('event series, 10 ms window', lambda: legacy_get_event_series(
+            waveform, legacy_data, [3, 2], *window), 3)
+    measure('rising edges, 10 ms window', lambda: legacy_get_rising_edge_events(
+            waveform, legacy_data, 1, *window), 3)
+
+    print('columnar:')
+    raw_waveform = WaveformColumns.from_events(events)
+    shuffled_order = numpy.random.RandomState(0).permutation(num_events)
+    shuffled_waveform = WaveformColumns(
+            raw_waveform.times[shuffled_order], raw_waveform.values[shuffled_order])
+    measure('cleaning, sorted input', lambda: waveform._clean_waveform_columns(
+            raw_waveform, period_sec), 20)
+    measure('cleaning, shuffled input', lambda: waveform._clean_waveform_columns(
+            shuffled_waveform, period_sec), 3)
+
+    def cold_rising_edges():
+        waveform._transition_index_cache = None
+        waveform._get_edge_times(waveform.data, 1, True, *window)
+
+    measure('rising edges, building the pin index', cold_rising_edges, 20)
+    measure('event series, 10 ms window', lambda: waveform._get_event_series_columns(
+            waveform.data, [3, 2], *window), 1000)
+    measure('event series, 10 ms window (list API)', lambda: waveform._get_event_series(
+            waveform.data, [3, 2], *window), 1000)
+    measure('rising edges, 10 ms window', lambda: waveform._get_edge_times(
+            waveform.data, 1, True, *window), 1000)
+    measure('rising edges, whole waveform', lambda: waveform._get_edge_times(
+            waveform.data, 1, True), 20)
+    measure('event series, whole waveform', lambda: waveform._get_event_series_columns(
+            waveform.data, [3, 2]), 20)
+    measure('bus value', lambda: waveform._get_bus_value(waveform.data, [3, 2], 42.), 1000)
+
+    print('batched:')
+    query_times = numpy.linspace(0., period_sec, 10000)
+    measure('bus value x10000, one by one', lambda: [waveform._get_bus_value(
+            waveform.data, [3, 2], t) for t in query_times.tolist()], 3)
+    measure('bus value x10000', lambda: waveform._get_bus_values(
+            waveform.data, [3, 2], query_times), 20)
+    measure('bus value sampled every 1 ms', lambda: waveform._sample_bus_values(
+            waveform.data, [3, 2], 0.001), 20)
+    windows = [(t, t + 0.01) for t in numpy.linspace(0., period_sec - 0.01, 1000).tolist()]
+    measure('event series, 1000 windows of 10 ms', lambda: waveform._get_event_series_batch(
+            waveform.data, [3, 2], windows), 3)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+"""
+Build the decimation pyramids of a waveform file (text or binary) and save them beside it, so
+that a plotting tool can call load_decimation_pyramids() on the reader instead of building them
+every time it opens the file.
+
+The readers are shared with serapis, so serapis has to be importable.
+
+Usage: ./build_decimation_pyramid.py <waveform_file> [pyramid_file]
+  The default pyramid file is <waveform_file>.pyramid.npz
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from AutoGrader.devices.fileio.binary_waveform_file_reader import BinaryWaveformFileReader
+from convert_waveform_file import is_binary_file, read_text_file
+
+
+PYRAMID_FILE_SUFFIX = '.pyramid.npz'
+
+
+def main():
+    if len(sys.argv) not in [2, 3]:
+        print('Usage: %s <waveform_file> [pyramid_file]' % sys.argv[0])
+        sys.exit(1)
+
+    waveform_path = sys.argv[1]
+    pyramid_path = sys.argv[2] if len(sys.argv) == 3 else waveform_path + PYRAMID_FILE_SUFFIX
+
+    if is_binary_file(waveform_path):
+        reader = BinaryWaveformFileReader(waveform_path)
+        if not reader.is_successfully_parsed():
+            raise Exception('%s: %s' % (waveform_path, reader.get_error_description()))
+    else:
+        reader, _ = read_text_file(waveform_path)
+
+    start_time = time.perf_counter()
+    reader.build_decimation_pyramids(pyramid_path)
+    print('%d pyramids built in %.3f sec, saved to %s' % (
+            len(reader.display_params), time.perf_counter() - start_time, pyramid_path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+"""
+Randomized equivalence check of clean_waveform_columns() against the list-of-tuples
+implementation of _clean_waveform() before the columnar storage. The inputs are short random
+waveforms with unsorted events, duplicate timestamps, duplicate events, and events before time
+0 and after the period, for random periods including 0. Both implementations either raise, or
+return the same events.
+
+Negative periods are left out. Both implementations raise on them, except for an empty
+waveform, for which clean_waveform_columns() returns the two boundary events.
+
+Usage: ./check_clean_waveform.py [num_cases] [seed]
+"""
+
+import os
+import sys
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from AutoGrader.devices.fileio.waveform_query_base import clean_waveform_columns, WaveformColumns
+
+
+def legacy_clean_waveform(data, period_sec):
+    # _clean_waveform() before the columnar storage
+    new_data = list(data)
+    if len(new_data) == 0:
+        new_data = [(0.0, 0), (period_sec, 0)]
+
+    early_events = [e for e in new_data if e[0] < 0.]
+    if len(early_events) > 0:
+        target_event = max(early_events)
+        new_data.append((0.0, target_event[1]))
+
+    new_data.sort()
+    new_data = list(filter(lambda x: 0. <= x[0] and x[0] <= period_sec, new_data))
+
+    if new_data[0][0] != 0.:
+        new_data[0:0] = [(0.0, 0)]
+
+    if new_data[-1][0] < period_sec:
+        new_data.append((period_sec, new_data[-1][1]))
+
+    return new_data
+
+
+def random_case(rnd):
+    # a small pool of timestamps makes duplicate timestamps and events likely
+    time_pool = [-2., -1., -0.5, 0., 0.5, 1., 1.5, 2., 3.]
+    num_events = rnd.randrange(0, 8)
+    events = []
+    for _ in range(num_events):
+        t = rnd.choice(time_pool) if rnd.random() < 0.8 else rnd.uniform(-1., 3.)
+        events.append((t, rnd.randrange(4)))
+    if rnd.random() < 0.4:
+        events.sort()
+    period_sec = rnd.choice([0., 0.5, 1., 1.5, 2., 3., rnd.uniform(0., 4.)])
+    return events, period_sec
+
+
+def run(func):
+    try:
+        return func()
+    except Exception as e:
+        return 'raises %s' % type(e).__name__
+
+
+def main():
+    num_cases = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    rnd = random.Random(seed)
+
+    num_mismatches = 0
+    for _ in range(num_cases):
+        events, period_sec = random_case(rnd)
+        expected = run(lambda: legacy_clean_waveform(events, period_sec))
+        actual = run(lambda: clean_waveform_columns(
+                WaveformColumns.from_events(events), period_sec).to_list())
+
+        # the exception types differ, only whether it raises matters
+        if isinstance(expected, str) and isinstance(actual, str):
+            continue
+        if expected != actual:
+            num_mismatches += 1
+            if num_mismatches <= 5:
+                print('mismatch: events=%s period_sec=%s' % (events, period_sec))
+                print('  legacy:  %s' % (expected,))
+                print('  columns: %s' % (actual,))
+
+    print('%d mismatches in %d cases' % (num_mismatches, num_cases))
+    if num_mismatches > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
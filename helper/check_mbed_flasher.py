@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+"""
+Check MbedFlasher against a fake board: a temporary mount folder, a fake mount table, a fake
+sysfs block folder and a fake tty. The mount commands edit the fake mount table, and a board
+thread makes the block device disappear and come back once a firmware is copied, as a real
+board does when it re-enumerates after flashing.
+
+It checks that
+  - a healthy board is flashed without sleeping for the fixed delays, and
+  - a readiness signal which is never observed costs no more than the fixed delay of its step,
+    unless timeout_sec is set longer, and
+  - prepare_firmware() burns the blank and the testing firmware once, and skips burning when
+    the board already holds the testing firmware.
+
+The fixed delays are shortened so that the check runs in a few seconds.
+
+Usage: ./check_mbed_flasher.py
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from AutoGrader.devices.MbedFlasher import MbedFlasher
+
+
+UMOUNT_CODE = """
+import sys
+mounts_file_path, dev_path = sys.argv[1:]
+with open(mounts_file_path) as f:
+    lines = [l for l in f if l.split()[0] != dev_path]
+with open(mounts_file_path, 'w') as f:
+    f.writelines(lines)
+"""
+
+MOUNT_CODE = """
+import sys
+mounts_file_path, dev_path, mount_path = sys.argv[1:]
+with open(mounts_file_path, 'a') as f:
+    f.write('%s %s vfat rw 0 0\\n' % (dev_path, mount_path.replace(' ', '\\\\040')))
+"""
+
+REENUMERATION_SEC = 0.2
+
+
+class FakeBoard(object):
+    def __init__(self, root_path, mount_works=True):
+        # a space in the mount path exercises the escaping of the mount table
+        self.mount_path = os.path.join(root_path, 'MBED DISK')
+        self.mounts_file_path = os.path.join(root_path, 'mounts')
+        self.sysfs_block_path = os.path.join(root_path, 'block')
+        self.dev_path = os.path.join(root_path, 'sdz')
+        self.usb_path = os.path.join(root_path, 'ttyACM9')
+
+        os.makedirs(self.mount_path)
+        os.makedirs(os.path.join(self.sysfs_block_path, 'sdz'))
+        with open(self.usb_path, 'w'):
+            pass
+        with open(self.mounts_file_path, 'w') as f:
+            f.write('%s %s vfat rw 0 0\n' % (self.dev_path, self.mount_path.replace(' ', '\\040')))
+        with open(os.path.join(self.mount_path, 'old_firmware.bin'), 'wb') as f:
+            f.write(b'old')
+
+        self.mount_works = mount_works
+        self.alive = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def create_flasher(self, flasher_class, timeout_sec=None):
+        flasher = flasher_class('fake', self.mount_path, self.dev_path, self.usb_path,
+                timeout_sec=timeout_sec, mounts_file_path=self.mounts_file_path,
+                sysfs_block_path=self.sysfs_block_path)
+        flasher.UMOUNT_CMD = [sys.executable, '-c', UMOUNT_CODE, self.mounts_file_path]
+        if self.mount_works:
+            flasher.MOUNT_CMD = [sys.executable, '-c', MOUNT_CODE, self.mounts_file_path]
+        else:
+            flasher.MOUNT_CMD = [sys.executable, '-c', 'pass']
+        return flasher
+
+    def stop(self):
+        self.alive = False
+        self.thread.join()
+
+    def _run(self):
+        # flash every new firmware file, i.e., re-enumerate and consume the file
+        block_path = os.path.join(self.sysfs_block_path, 'sdz')
+        while self.alive:
+            firmware_files = [f for f in os.listdir(self.mount_path)
+                    if f.endswith('.bin') and f != 'old_firmware.bin']
+            if firmware_files:
+                os.rmdir(block_path)
+                for f in firmware_files:
+                    os.remove(os.path.join(self.mount_path, f))
+                time.sleep(REENUMERATION_SEC)
+                os.makedirs(block_path)
+            time.sleep(0.01)
+
+
+class FastFallbackFlasher(MbedFlasher):
+    FALLBACK_DELAY_SEC = 0.5
+    FALLBACK_BOOT_DELAY_SEC = 0.5
+    POLL_INTERVAL_SEC = 0.01
+
+
+def burn(root_path, firmware_path, mount_works=True, timeout_sec=None):
+    board = FakeBoard(root_path, mount_works=mount_works)
+    flasher = board.create_flasher(FastFallbackFlasher, timeout_sec=timeout_sec)
+    start_time = time.time()
+    success = flasher.burn_firmware(firmware_path, firmware_short_desp='testing')
+    elapsed_time = time.time() - start_time
+    board.stop()
+    return success, elapsed_time
+
+
+def prepare_twice(root_path, blank_firmware_path, firmware_path):
+    board = FakeBoard(root_path)
+    flasher = board.create_flasher(FastFallbackFlasher)
+    burnt_paths = []
+    burn_firmware = flasher.burn_firmware
+
+    def recording_burn_firmware(firmware_path, firmware_short_desp=None):
+        burnt_paths.append(firmware_path)
+        return burn_firmware(firmware_path, firmware_short_desp=firmware_short_desp)
+
+    flasher.burn_firmware = recording_burn_firmware
+    burnt_flags = [flasher.prepare_firmware(blank_firmware_path, firmware_path)
+            for _ in range(2)]
+    board.stop()
+    return burnt_flags, burnt_paths
+
+
+def check(condition, message):
+    if not condition:
+        raise Exception('check failed: %s' % message)
+    print('ok: %s' % message)
+
+
+def main():
+    fallback_sec = FastFallbackFlasher.FALLBACK_DELAY_SEC
+    slack_sec = 0.3
+
+    root_path = tempfile.mkdtemp()
+    try:
+        firmware_path = os.path.join(root_path, 'testing.bin')
+        with open(firmware_path, 'wb') as f:
+            f.write(os.urandom(4096))
+
+        success, healthy_sec = burn(os.path.join(root_path, 'healthy'), firmware_path)
+        check(success, 'a healthy board reports all the readiness signals')
+        check(healthy_sec < REENUMERATION_SEC + slack_sec,
+                'a healthy board is flashed in %.2f sec, without the fixed delays' % healthy_sec)
+
+        # the mount table never lists the board again, "mounted" cannot be detected
+        success, failed_sec = burn(os.path.join(root_path, 'no_mount'), firmware_path,
+                mount_works=False)
+        check(not success, 'a missing readiness signal is reported')
+        check(failed_sec < healthy_sec + fallback_sec + slack_sec,
+                'a missing readiness signal costs %.2f sec, bounded by the fixed delay of '
+                '%.2f sec' % (failed_sec - healthy_sec, fallback_sec))
+
+        # an explicit timeout_sec longer than the fixed delay is waited for in full
+        timeout_sec = 2 * fallback_sec
+        success, failed_sec = burn(os.path.join(root_path, 'no_mount_timeout'), firmware_path,
+                mount_works=False, timeout_sec=timeout_sec)
+        check(not success and failed_sec >= timeout_sec,
+                'with timeout_sec=%.2f, a missing readiness signal costs %.2f sec' % (
+                    timeout_sec, failed_sec - healthy_sec))
+
+        blank_firmware_path = os.path.join(root_path, 'blank.bin')
+        with open(blank_firmware_path, 'wb') as f:
+            f.write(os.urandom(4096))
+        burnt_flags, burnt_paths = prepare_twice(os.path.join(root_path, 'prepare'),
+                blank_firmware_path, firmware_path)
+        check(burnt_flags == [True, False] and
+                burnt_paths == [blank_firmware_path, firmware_path],
+                'the second prepare_firmware() skips burning the same testing firmware')
+    finally:
+        shutil.rmtree(root_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+"""
+Convert a waveform file between the text formats and the binary format, e.g., to make old
+backups memory-mappable, or to read a binary file with the tools which only know the text
+formats.
+
+  - A text file (STM32 or Logic Saleae) or a binary file in the records layout is converted
+    into the columns layout, which BinaryWaveformFileReader memory-maps.
+  - A binary file in the columns layout is converted into the STM32 text format if it knows
+    the tick frequency of the original waveform, otherwise into the Logic Saleae text format.
+
+Both directions go through the cleaned waveform, thus the output has the boundary events at 0
+and at the period, and the events which do not show in the waveform, such as the STM32 events
+other than the waveform ones, are not kept. The readers get the same waveform from either file,
+except that the STM32 text format rounds the timestamps to ticks.
+
+The readers are shared with serapis, so serapis has to be importable.
+
+Usage: ./convert_waveform_file.py <input_file> <output_file>
+"""
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from AutoGrader.devices.fileio import binary_waveform_format
+from AutoGrader.devices.fileio.binary_waveform_file_reader import BinaryWaveformFileReader
+from AutoGrader.devices.fileio.stm32_waveform_file_reader import STM32WaveformFileReader
+from AutoGrader.devices.fileio.stm32_waveform_file_writer import STM32WaveformFileWriter
+from AutoGrader.devices.fileio.logic_saleae_waveform_file_reader import LogicSaleaeWaveformFileReader
+from AutoGrader.devices.fileio.logic_saleae_waveform_file_writer import LogicSaleaeWaveformFileWriter
+
+
+def is_binary_file(file_path):
+    with open(file_path, 'rb') as f:
+        return f.read(len(binary_waveform_format.MAGIC)) == binary_waveform_format.MAGIC
+
+
+def read_text_file(file_path):
+    with open(file_path, 'rb') as f:
+        raw_content = f.read()
+
+    # only the STM32 format has the tick frequency in the second line
+    lines = raw_content.lstrip().split(b'\n', 2)
+    is_stm32_format = len(lines) > 1 and lines[1].startswith(b'Tick frequency')
+    if is_stm32_format:
+        reader = STM32WaveformFileReader(raw_content)
+    else:
+        reader = LogicSaleaeWaveformFileReader(raw_content)
+
+    if not reader.is_successfully_parsed():
+        raise Exception('%s: %s' % (file_path, reader.get_error_description()))
+    return (reader, reader.get_tick_frequency() if is_stm32_format else 0.)
+
+
+def convert_to_columns(input_path, output_path):
+    if is_binary_file(input_path):
+        reader = BinaryWaveformFileReader(input_path)
+        if not reader.is_successfully_parsed():
+            raise Exception('%s: %s' % (input_path, reader.get_error_description()))
+        tick_frequency = reader.get_tick_frequency()
+    else:
+        reader, tick_frequency = read_text_file(input_path)
+
+    binary_waveform_format.write_columns(output_path, reader.period_sec, tick_frequency,
+            reader.display_params, reader.data.times, reader.data.values)
+
+
+def convert_to_text(input_path, output_path):
+    reader = BinaryWaveformFileReader(input_path)
+    if not reader.is_successfully_parsed():
+        raise Exception('%s: %s' % (input_path, reader.get_error_description()))
+
+    if reader.get_tick_frequency() > 0.:
+        tick_frequency = reader.get_tick_frequency()
+        writer = STM32WaveformFileWriter(output_path)
+        writer.set_period_sec(reader.get_period_sec())
+        writer.set_tick_frequency(tick_frequency)
+        for display_param in reader.display_params:
+            writer.add_display_param(display_param['name'], display_param['pins'])
+        writer.open_stream()
+        ticks = (reader.data.times * tick_frequency).round()
+        writer.append_events([68] * len(ticks), ticks.astype('int64'), reader.data.values)
+        writer.close_stream()
+    else:
+        # the writer takes the data exported by Logic Saleae
+        tmp_fd, tmp_raw_data_path = tempfile.mkstemp(suffix='.csv')
+        try:
+            with os.fdopen(tmp_fd, 'w') as f:
+                f.write('Time[s], Data[Hex]\n')
+                for t, value in reader.data:
+                    f.write('%r, %x\n' % (t, value))
+
+            writer = LogicSaleaeWaveformFileWriter(output_path)
+            writer.set_period_sec(reader.get_period_sec())
+            for display_param in reader.display_params:
+                writer.add_display_param(display_param['name'], display_param['pins'])
+            writer.set_raw_data_path(tmp_raw_data_path)
+            writer.marshal()
+        finally:
+            os.remove(tmp_raw_data_path)
+
+
+def main():
+    if len(sys.argv) != 3:
+        print('Usage: %s <input_file> <output_file>' % sys.argv[0])
+        sys.exit(1)
+
+    input_path, output_path = sys.argv[1:]
+    with open(input_path, 'rb') as f:
+        is_columns_layout = False
+        if is_binary_file(input_path):
+            is_columns_layout = (binary_waveform_format.unpack_header(f)['layout']
+                    == binary_waveform_format.LAYOUT_COLUMNS)
+
+    if is_columns_layout:
+        convert_to_text(input_path, output_path)
+    else:
+        convert_to_columns(input_path, output_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -13,7 +13,12 @@ from AutoGrader.http import HTTPServer, HTTPClient
 # send testbed summary
 def send_summary(http_client, config, hardware_engine):
     try:
-        http_client.send_tb_summary(config['testbed_type'], hardware_engine.get_status())
+        http_client.send_tb_summary(
+                config['testbed_type'],
+                hardware_engine.get_status(),
+                queue_length=hardware_engine.get_queue_length(),
+                estimated_wait_sec=hardware_engine.get_estimated_wait_sec(),
+        )
     except Exception as e:
         #TODO: delete these
         import traceback
@@ -38,9 +43,10 @@ def main():
     # define the working order
     file_folder = os.path.join('.', 'uploads')
     backup_root_folder = os.path.join('.', 'upload_backups')
+    queue_folder = os.path.join('.', 'task_queue')
 
     # get hardware engine
-    hardware_engine = HardwareEngineHttp(config, file_folder, backup_root_folder)
+    hardware_engine = HardwareEngineHttp(config, file_folder, backup_root_folder, queue_folder)
     http_server.add_hardware(hardware_engine)
     hardware_engine.add_http_client(http_client)
 
@@ -59,6 +65,9 @@ def main():
             args=[http_client, config, hardware_engine])
     scheduler.start()
 
+    # resume the tasks which were queued before the last shutdown
+    hardware_engine.start_queued_tasks()
+
     # start server
     http_server.start()
 